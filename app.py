@@ -2,8 +2,10 @@ import streamlit as st
 import pandas as pd
 
 # Importazioni modularizzate
-from database.connection import get_data, save_data
+from database.connection import get_data, save_data, load_bundle
 from services.portfolio_service import calculate_portfolio_view, calculate_liquidity, get_historical_portfolio
+from services.portfolio_frame import get_portfolio_frame, PORTFOLIO_TABLES
+from services.data_service import update_portfolio_daily
 from ui.components import make_sidebar
 from ui.dashboard_components import render_kpis, render_composition_tabs, render_assets_table, render_historical_chart
 
@@ -11,27 +13,31 @@ st.set_page_config(page_title="Portfolio Pro", layout="wide", page_icon="🚀")
 make_sidebar()
 st.title("🚀 Dashboard Portafoglio")
 
-@st.cache_data(show_spinner="Caricamento dati...")
+DASHBOARD_TABLES = {"budget": "budget", "asset_exposure": "asset_exposure", "daily": "portfolio_daily"}
+
 def load_all_data():
-    """Carica tutti i dataframe necessari in un'unica funzione con cache."""
-    return {
-        "transactions": get_data("transactions"),
-        "mapping": get_data("mapping"),
-        "prices": get_data("prices"),
-        "budget": get_data("budget"),
-        "asset_allocation": get_data("asset_allocation")
-    }
+    """
+    Raccoglie i dataframe della dashboard leggendo in parallelo anche le tabelle del PortfolioFrame.
+    Ogni get_data legge dall'archivio condiviso per versione di tabella (cache_resource):
+    non serve una seconda cache che ne serializzi una copia per sessione.
+    """
+    with st.spinner("Caricamento dati..."):
+        frames, _ = load_bundle({**DASHBOARD_TABLES, **{t: t for t in PORTFOLIO_TABLES}})
+    return {name: frames[name] for name in DASHBOARD_TABLES}
 
 data = load_all_data()
-df_trans, df_map, df_prices, df_budget, df_alloc = data.values()
+df_budget, df_exposure, df_daily = data.values()
+# Posizioni (vista holdings_current), mappatura e ultimi prezzi: costruiti una volta per versione dei dati
+# (le tabelle sono già state lette dal bundle e arrivano dall'archivio condiviso)
+pf = get_portfolio_frame()
+df_holdings = pf.holdings
 
-if df_trans.empty:
+if pf.empty:
     st.info("👋 Benvenuto! Il database è vuoto. Vai su 'Gestione Dati' per importare il CSV.")
     st.stop()
 
-all_isins = df_trans['isin'].unique()
-mapped_isins = df_map['isin'].unique() if not df_map.empty else []
-missing_isins = [i for i in all_isins if i not in mapped_isins]
+# Le posizioni del PortfolioFrame sono già unite alla mappatura: ticker nullo = ISIN non mappato
+missing_isins = df_holdings.loc[df_holdings['ticker'].isna(), 'isin'].unique().tolist()
 
 if missing_isins:
     st.warning(f"⚠️ Ci sono {len(missing_isins)} nuovi asset da mappare!")
@@ -39,7 +45,7 @@ if missing_isins:
         new_mappings = []
         CATEGORIE_ASSET = ["Azionario", "Obbligazionario", "Gold", "Liquidità"]
         for isin in missing_isins:
-            prod_name = df_trans[df_trans['isin'] == isin]['product'].iloc[0]
+            prod_name = df_holdings[df_holdings['isin'] == isin]['product'].iloc[0]
             st.write(f"**{prod_name}** ({isin})")
             col1, col2 = st.columns(2)
             ticker_input = col1.text_input("Ticker Yahoo", key=f"ticker_{isin}", placeholder="es. SWDA.MI")
@@ -48,23 +54,28 @@ if missing_isins:
                 new_mappings.append({'isin': isin, 'ticker': ticker_input.strip(), 'category': category_input})
         if st.form_submit_button("💾 Salva e Aggiorna"):
             if new_mappings:
-                new_df = pd.DataFrame(new_mappings)
-                df_final = pd.concat([df_map, new_df], ignore_index=True).drop_duplicates(subset=['isin'], keep='last')
-                save_data(df_final, "mapping")
+                save_data(pd.DataFrame(new_mappings), "mapping", method='upsert')
+                update_portfolio_daily()
                 st.success("Mappatura salvata! Ricarico la pagina...")
                 st.rerun()
     st.stop() 
 
+# Primo avvio (o tabella svuotata): costruisce la valorizzazione giornaliera una volta sola.
+if df_daily.empty:
+    with st.spinner("Prima costruzione dello storico di portafoglio..."):
+        if update_portfolio_daily() > 0:
+            df_daily = get_data("portfolio_daily")
+
 # --- CALCOLI PRINCIPALI ---
 with st.spinner("Calcolo indicatori..."):
     # 1. Calcola la vista degli ASSET (senza liquidità) per i KPI.
-    assets_view = calculate_portfolio_view(df_trans, df_map, df_prices)
+    assets_view = calculate_portfolio_view(pf)
     
     # 2. Calcola la liquidità separatamente.
-    final_liquidity, liquidity_label = calculate_liquidity(df_budget, df_trans)
+    final_liquidity, liquidity_label = calculate_liquidity(df_budget, pf.cash_flows)
     
     # 3. Calcola lo storico.
-    hdf = get_historical_portfolio(df_trans, df_map, df_prices)
+    hdf = get_historical_portfolio(df_daily)
 
 # 4. Crea una vista COMPLETA (full_view) per i grafici, aggiungendo la liquidità.
 full_view = assets_view.copy()
@@ -74,6 +85,6 @@ if final_liquidity > 0:
 
 # --- RENDERIZZAZIONE COMPONENTI UI ---
 render_kpis(assets_view)
-render_composition_tabs(full_view, df_alloc)
+render_composition_tabs(full_view, df_exposure)
 render_historical_chart(hdf)
 render_assets_table(full_view)
@@ -0,0 +1,124 @@
+"""
+Benchmark del motore di simulazione shadow (services/benchmark_service.py).
+
+Confronta il vecchio ciclo giorno per giorno con il motore vettoriale su un
+portafoglio sintetico di 10 anni e 50 ticker, verificando che l'output coincida.
+
+Uso:
+    python -m benchmarks.bench_benchmark_simulation [--years 10] [--tickers 50]
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from services.benchmark_service import simulate_benchmark
+
+def legacy_simulation(df_full, df_prices, bench_hist, fx_hist, bench_currency, start_date, end_date):
+    """Il ciclo originale di run_benchmark_simulation, tenuto come riferimento."""
+    timeline = pd.date_range(start=start_date, end=end_date, freq='D').normalize()
+    my_val_history, bench_val_history = [], []
+    pivot_user = pd.DataFrame()
+    if not df_prices.empty:
+        pivot_user = df_prices.pivot_table(index='date', columns='ticker', values='close_price', aggfunc='last').sort_index().ffill()
+
+    trans_grouped = df_full.groupby('date')
+    user_qty, bench_qty = {}, 0.0
+    log_transactions = []
+
+    for d in timeline:
+        daily_cash = 0
+        if d in trans_grouped.groups:
+            moves = trans_grouped.get_group(d)
+            daily_cash = -moves['local_value'].sum()
+            for _, row in moves.iterrows():
+                tk = row['ticker']
+                if pd.notna(tk):
+                    user_qty[tk] = user_qty.get(tk, 0) + row['quantity']
+
+        if daily_cash != 0:
+            try:
+                idx = bench_hist.index.asof(d)
+                if pd.notna(idx):
+                    p_bench = bench_hist.at[idx]
+                    if pd.notna(p_bench) and p_bench > 0:
+                        fx_rate = fx_hist.at[idx] if fx_hist is not None and pd.notna(fx_hist.at[idx]) else 1.0
+                        cash_in_local = daily_cash * fx_rate
+                        qty_bench = cash_in_local / p_bench
+                        bench_qty += qty_bench
+                        log_transactions.append({'Data': d, 'Tipo': 'BENCHMARK', 'Importo': daily_cash, 'Quantità': qty_bench, 'Prezzo': p_bench, 'Valuta': bench_currency})
+            except Exception: pass
+
+        val_user = sum(q * pivot_user.at[pivot_user.index.asof(d), tk] for tk, q in user_qty.items() if q > 0.001 and tk in pivot_user.columns and pd.notna(pivot_user.index.asof(d)))
+
+        val_bench = 0
+        try:
+            idx = bench_hist.index.asof(d)
+            if pd.notna(idx):
+                p_bench = bench_hist.at[idx]
+                if pd.notna(p_bench):
+                    fx_rate = fx_hist.at[idx] if fx_hist is not None and pd.notna(fx_hist.at[idx]) else 1.0
+                    val_bench = bench_qty * p_bench / fx_rate
+        except Exception: pass
+
+        my_val_history.append(val_user)
+        bench_val_history.append(val_bench)
+
+    df_chart = pd.DataFrame({'Data': timeline, 'Tu': my_val_history, 'Benchmark': bench_val_history})
+    df_chart = df_chart[(df_chart['Tu'] > 0) | (df_chart['Benchmark'] > 0)].reset_index(drop=True)
+    df_log = pd.DataFrame(log_transactions).round(2)
+    return df_chart, df_log
+
+def make_portfolio(years: int, n_tickers: int, seed: int = 42):
+    """Genera transazioni mensili, prezzi giornalieri (giorni lavorativi), benchmark e cambio."""
+    rng = np.random.default_rng(seed)
+    start = pd.Timestamp("2015-01-02")
+    end = start + pd.DateOffset(years=years)
+    bdays = pd.bdate_range(start, end)
+    tickers = [f"TCK{i:02d}.MI" for i in range(n_tickers)]
+
+    walks = 50 * np.exp(np.cumsum(rng.normal(0.0002, 0.01, size=(len(bdays), n_tickers)), axis=0))
+    df_prices = pd.DataFrame(walks, index=bdays, columns=tickers).stack().rename('close_price').reset_index()
+    df_prices.columns = ['date', 'ticker', 'close_price']
+
+    # Un acquisto al mese per ticker (con ingresso scaglionato) e qualche vendita parziale
+    rows = []
+    for month in pd.date_range(start, end, freq='MS'):
+        for i, tk in enumerate(tickers):
+            if month < start + pd.DateOffset(months=i):
+                continue
+            day = month + pd.Timedelta(days=int(rng.integers(0, 27)))
+            qty = float(rng.integers(1, 10)) * (-0.5 if rng.random() < 0.1 else 1.0)
+            rows.append({'date': day, 'ticker': tk, 'quantity': qty, 'local_value': -qty * 50.0})
+    df_full = pd.DataFrame(rows)
+
+    bench = pd.Series(80 * np.exp(np.cumsum(rng.normal(0.0003, 0.009, size=len(bdays)))), index=bdays)
+    full_idx = pd.date_range(bdays.min(), bdays.max(), freq='D')
+    bench_hist = bench.reindex(full_idx).ffill()
+    fx_hist = pd.Series(1.1 + 0.05 * np.sin(np.arange(len(bdays)) / 200), index=bdays).reindex(full_idx).ffill()
+    return df_full, df_prices, bench_hist, fx_hist, df_full['date'].min(), df_prices['date'].max()
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark della simulazione shadow: ciclo vs vettoriale")
+    parser.add_argument("--years", type=int, default=10)
+    parser.add_argument("--tickers", type=int, default=50)
+    args = parser.parse_args()
+
+    df_full, df_prices, bench_hist, fx_hist, start_date, end_date = make_portfolio(args.years, args.tickers)
+    print(f"Portafoglio sintetico: {args.years} anni, {args.tickers} ticker, {len(df_full)} transazioni, {len(df_prices)} prezzi")
+
+    t0 = time.perf_counter()
+    legacy_chart, legacy_log = legacy_simulation(df_full, df_prices, bench_hist, fx_hist, 'USD', start_date, end_date)
+    t_legacy = time.perf_counter() - t0
+
+    t0 = time.perf_counter()
+    chart, log = simulate_benchmark(df_full, df_prices, bench_hist, fx_hist, 'USD', start_date, end_date)
+    t_vector = time.perf_counter() - t0
+
+    pd.testing.assert_frame_equal(chart, legacy_chart, check_dtype=False, rtol=1e-9)
+    pd.testing.assert_frame_equal(log, legacy_log, check_dtype=False, rtol=1e-9)
+    print(f"Ciclo originale: {t_legacy:8.3f}s")
+    print(f"Vettoriale:      {t_vector:8.3f}s")
+    print(f"Speedup:         {t_legacy / t_vector:8.1f}x  (output identico)")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Benchmark dell'estrattore delle allocazioni JustETF (services/justetf_parser.py).
+
+Confronta il vecchio parsing con BeautifulSoup (albero completo della pagina) con
+l'estrattore mirato lxml, verificando che i dizionari restituiti coincidano.
+Le pagine sono quelle salvate in una cartella (<ISIN>.html, le stesse fixture di
+services.allocation_refresh) oppure, se non indicata, pagine sintetiche di dimensione realistica.
+
+Uso:
+    python -m benchmarks.bench_justetf_parser [--pages fixtures/justetf/] [--repeat 20]
+"""
+import argparse
+import time
+import numpy as np
+from pathlib import Path
+from bs4 import BeautifulSoup
+from services.justetf_parser import extract_allocations
+
+def legacy_parse(html):
+    """Il parsing originale di fetch_justetf_allocation_robust, tenuto come riferimento."""
+    geo_dict, sec_dict = {}, {}
+    soup = BeautifulSoup(html, 'lxml')
+    h3_geo = soup.find('h3', string=lambda text: text and 'Paesi' in text)
+    if h3_geo:
+        table = h3_geo.find_next('table')
+        if table:
+            for row in table.find_all('tr'):
+                cols = row.find_all('td')
+                if len(cols) >= 2:
+                    key = cols[0].text.strip()
+                    val_str = cols[1].text.strip().replace('%', '').replace(',', '.')
+                    try:
+                        val = float(val_str)
+                        if val < 101: geo_dict[key] = val
+                    except (ValueError, TypeError):
+                        pass
+    h3_sec = soup.find('h3', string=lambda text: text and 'Settori' in text)
+    if h3_sec:
+        table = h3_sec.find_next('table')
+        if table:
+            for row in table.find_all('tr'):
+                cols = row.find_all('td')
+                if len(cols) >= 2:
+                    key = cols[0].text.strip()
+                    val_str = cols[1].text.strip().replace('%', '').replace(',', '.')
+                    try:
+                        val = float(val_str)
+                        if val < 101: sec_dict[key] = val
+                    except (ValueError, TypeError):
+                        pass
+    return geo_dict, sec_dict
+
+def make_page(seed: int) -> str:
+    """Pagina profilo sintetica: molto contenuto di contorno e le due tabelle a metà pagina."""
+    rng = np.random.default_rng(seed)
+    def table(prefix, n):
+        rows = "".join(f"<tr><td><a href='#'>{prefix} {i}</a></td><td>{rng.uniform(0, 30):.2f}%".replace('.', ',') + "</td></tr>" for i in range(n))
+        return f"<table class='table'><thead><tr><th>Nome</th><th>Peso</th></tr></thead><tbody>{rows}<tr><td colspan='2'>Mostra di più</td></tr></tbody></table>"
+    filler = "".join(
+        f"<div class='box'><h3>Sezione {i}</h3><p>{'Lorem ipsum dolor sit amet. ' * 20}</p>{table('Voce', 8)}</div>"
+        for i in range(60)
+    )
+    scripts = "<script>var data = [" + ",".join(str(x) for x in range(5000)) + "];</script>"
+    return (
+        f"<html><head><title>ETF</title>{scripts}</head><body>{filler[:len(filler)//2]}"
+        f"<div><h3>Paesi</h3>{table('Paese', 12)}</div>"
+        f"<div><h3>Settori</h3>{table('Settore', 11)}</div>"
+        f"{filler[len(filler)//2:]}</body></html>"
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del parser JustETF: BeautifulSoup vs lxml mirato")
+    parser.add_argument("--pages", type=Path, help="cartella di pagine salvate <ISIN>.html")
+    parser.add_argument("--synthetic", type=int, default=10, help="numero di pagine sintetiche se --pages non è indicato")
+    parser.add_argument("--repeat", type=int, default=10)
+    args = parser.parse_args()
+
+    if args.pages:
+        pages = [p.read_text(encoding="utf-8") for p in sorted(args.pages.glob("*.html"))]
+    else:
+        pages = [make_page(i) for i in range(args.synthetic)]
+    if not pages:
+        print("Nessuna pagina da analizzare.")
+        return
+    print(f"{len(pages)} pagine, {sum(len(p) for p in pages) / len(pages) / 1024:.0f} KB in media")
+
+    for page in pages:
+        assert extract_allocations(page) == legacy_parse(page), "Output diverso dal parser originale"
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        for page in pages: legacy_parse(page)
+    t_legacy = (time.perf_counter() - t0) / (args.repeat * len(pages))
+
+    t0 = time.perf_counter()
+    for _ in range(args.repeat):
+        for page in pages: extract_allocations(page)
+    t_fast = (time.perf_counter() - t0) / (args.repeat * len(pages))
+
+    print(f"BeautifulSoup: {t_legacy * 1000:8.2f} ms/pagina")
+    print(f"lxml mirato:   {t_fast * 1000:8.2f} ms/pagina")
+    print(f"Speedup:       {t_legacy / t_fast:8.1f}x  (output identico)")
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,26 @@
 import streamlit as st
 import pandas as pd
+import io
 import json
+import logging
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from sqlalchemy import text
-from typing import Optional, Dict, Any, Union
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
+from database.snapshot import SNAPSHOT_TABLES, load_table
+from database.migrations import run_migrations
+from typing import Optional, Dict, Any, Union, Sequence, Tuple
+
+DateLike = Union[str, pd.Timestamp]
+
+logger = logging.getLogger(__name__)
+
+# I DataFrame letti sono condivisi tra sessioni (vedi _read_table): con Copy-on-Write una modifica
+# fatta da un chiamante sulla propria vista non raggiunge mai la copia condivisa.
+# Da pandas 3 è sempre attivo e l'opzione è deprecata.
+if int(pd.__version__.split('.')[0]) < 3:
+    pd.set_option("mode.copy_on_write", True)
 
 # --- CONNESSIONE AL DATABASE (NEON/POSTGRESQL) ---
 @st.cache_resource
@@ -10,77 +28,677 @@ def get_db_connection():
     """
     Stabilisce la connessione al DB usando i secrets di Streamlit.
     Restituisce un oggetto connessione SQL di Streamlit.
+    Alla prima connessione del processo applica le migrazioni di schema mancanti.
     """
-    return st.connection("postgresql", type="sql")
+    conn = st.connection("postgresql", type="sql")
+    try:
+        run_migrations(conn.engine)
+    except Exception as e:
+        logger.warning("Migrazioni non applicate: %s", e)
+    return conn
 
-# --- LETTURA DATI (CON CACHE STRUTTURALE) ---
-@st.cache_data(ttl=600)
-def get_data(table_name: str) -> pd.DataFrame:
+# --- VERSIONI DELLE TABELLE (INVALIDAZIONE MIRATA DELLA CACHE) ---
+@st.cache_resource
+def _get_version_registry() -> Tuple[Dict[str, int], threading.Lock]:
+    """
+    Registro condiviso da tutte le sessioni del processo: tabella -> versione.
+    Ogni scrittura incrementa solo la versione della tabella toccata.
     """
-    Legge un'intera tabella dal database e restituisce un DataFrame.
-    Converte automaticamente le colonne 'date' in datetime.
+    return {}, threading.Lock()
+
+def get_table_version(table_name: str) -> int:
+    """Restituisce la versione corrente di una tabella (0 se mai scritta)."""
+    versions, _ = _get_version_registry()
+    return versions.get(table_name, 0)
+
+def get_table_versions(*table_names: str) -> Tuple[int, ...]:
     """
+    Restituisce le versioni delle tabelle indicate, da usare come chiave di cache
+    per le funzioni che dipendono da più tabelle.
+    """
+    return tuple(get_table_version(t) for t in table_names)
+
+def bump_table_version(table_name: str) -> None:
+    """Invalida le letture in cache di una sola tabella incrementandone la versione."""
+    versions, lock = _get_version_registry()
+    with lock:
+        versions[table_name] = versions.get(table_name, 0) + 1
+
+# --- VISTE MATERIALIZZATE ---
+# Vista -> tabelle da cui dipende: una scrittura su una di esse aggiorna la vista.
+MATERIALIZED_VIEWS: Dict[str, Tuple[str, ...]] = {
+    'holdings_current': ('transactions', 'mapping'),
+    'last_price_per_ticker': ('prices',),
+}
+
+def refresh_dependent_views(table_name: str) -> None:
+    """
+    Aggiorna le viste materializzate che dipendono dalla tabella appena scritta
+    e ne incrementa la versione. CONCURRENTLY non blocca le letture in corso.
+    """
+    views = [v for v, deps in MATERIALIZED_VIEWS.items() if table_name in deps]
+    if not views:
+        return
     conn = get_db_connection()
-    try:
-        # ttl=5 per evitare query troppo frequenti se chiamato in loop, 
-        # ma la cache principale è gestita da @st.cache_data
-        df = conn.query(f'SELECT * FROM "{table_name}";', ttl=5)
-        if not df.empty and 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'])
+    with conn.session as s:
+        for view in views:
+            s.execute(text(f"REFRESH MATERIALIZED VIEW CONCURRENTLY {_quote_ident(view)};"))
+        s.commit()
+    for view in views:
+        bump_table_version(view)
+
+def _quote_ident(name: str) -> str:
+    """Quota un identificatore SQL (tabella o colonna) per evitare injection."""
+    return '"' + str(name).replace('"', '""') + '"'
+
+def _build_select(table_name: str,
+                  columns: Optional[Sequence[str]] = None,
+                  tickers: Optional[Sequence[str]] = None,
+                  isins: Optional[Sequence[str]] = None,
+                  start_date: Optional[DateLike] = None,
+                  end_date: Optional[DateLike] = None) -> Tuple[str, Dict[str, Any]]:
+    """
+    Costruisce la SELECT con proiezione delle colonne e filtri spinti lato SQL.
+    Restituisce il testo della query e i parametri da passare al driver.
+    """
+    cols_sql = ", ".join(_quote_ident(c) for c in columns) if columns else "*"
+    where, params = [], {}
+    if tickers is not None:
+        where.append('"ticker" = ANY(:tickers)')
+        params['tickers'] = list(tickers)
+    if isins is not None:
+        where.append('"isin" = ANY(:isins)')
+        params['isins'] = list(isins)
+    if start_date is not None:
+        where.append('"date" >= :start_date')
+        params['start_date'] = pd.Timestamp(start_date).date()
+    if end_date is not None:
+        where.append('"date" <= :end_date')
+        params['end_date'] = pd.Timestamp(end_date).date()
+
+    sql = f"SELECT {cols_sql} FROM {_quote_ident(table_name)}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    return sql + ";", params
+
+# --- SCHEMA TIPIZZATO DELLE LETTURE ---
+# Le colonne NUMERIC arrivano dal driver come Decimal in colonne object: somme, prodotti e pivot
+# diventano cicli Python. Alla lettura si convertono in float64, i codici ripetuti in category e
+# 'date' in datetime normalizzato a mezzanotte. mapping resta object perché è modificata negli editor.
+TABLE_SCHEMAS: Dict[str, Dict[str, Tuple[str, ...]]] = {
+    'transactions': {'float': ('quantity', 'local_value', 'fees'), 'category': ('isin', 'currency')},
+    'prices': {'float': ('close_price',), 'category': ('ticker',)},
+    'benchmark_prices': {'float': ('close_price',), 'category': ('ticker',)},
+    'last_price_per_ticker': {'float': ('close_price',)},
+    'budget': {'float': ('amount',), 'category': ('type', 'category')},
+    'networth_history': {'float': ('net_worth', 'goal')},
+    'portfolio_daily': {'float': ('value', 'invested')},
+    'holdings_current': {'float': ('quantity', 'local_value')},
+    'asset_exposure': {'float': ('weight',), 'category': ('ticker', 'dimension')},
+}
+
+@st.cache_resource
+def _get_memory_report() -> Dict[str, Dict[str, float]]:
+    """Registro condiviso: tabella -> memoria dell'ultima lettura prima e dopo l'applicazione dello schema."""
+    return {}
+
+def apply_schema(df: pd.DataFrame, table_name: str) -> pd.DataFrame:
+    """
+    Applica a un DataFrame letto da 'table_name' i tipi di TABLE_SCHEMAS (float64, category)
+    e normalizza 'date'. Registra la memoria risparmiata rispetto ai tipi grezzi (vedi get_memory_report).
+    """
+    if df.empty:
         return df
+    schema = TABLE_SCHEMAS.get(table_name, {})
+    before = df.memory_usage(deep=True).sum()
+    for col in schema.get('float', ()):
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce').astype('float64')
+    for col in schema.get('category', ()):
+        if col in df.columns:
+            df[col] = df[col].astype('category')
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'], errors='coerce').dt.normalize()
+    after = df.memory_usage(deep=True).sum()
+    _get_memory_report()[table_name] = {"rows": len(df), "before_mb": before / 1024 ** 2, "after_mb": after / 1024 ** 2}
+    if before > after:
+        logger.debug("Schema %s: %d righe, %.2f MB -> %.2f MB", table_name, len(df), before / 1024 ** 2, after / 1024 ** 2)
+    return df
+
+def get_memory_report() -> pd.DataFrame:
+    """Memoria per tabella dell'ultima lettura, prima e dopo lo schema tipizzato, con il risparmio."""
+    report = pd.DataFrame.from_dict(_get_memory_report(), orient='index')
+    if report.empty:
+        return pd.DataFrame(columns=['table', 'rows', 'before_mb', 'after_mb', 'saved_mb'])
+    report['saved_mb'] = report['before_mb'] - report['after_mb']
+    return report.rename_axis('table').reset_index().sort_values('saved_mb', ascending=False)
+
+@st.cache_resource(ttl=600, max_entries=64, show_spinner=False)
+def _read_table(table_name: str,
+                version: int,
+                columns: Optional[Sequence[str]] = None,
+                tickers: Optional[Sequence[str]] = None,
+                isins: Optional[Sequence[str]] = None,
+                start_date: Optional[DateLike] = None,
+                end_date: Optional[DateLike] = None) -> pd.DataFrame:
+    """
+    Esegue la lettura vera e propria. 'version' non viene usato nel corpo:
+    serve solo a far parte della chiave di cache, così una scrittura sulla
+    tabella invalida unicamente le sue letture.
+
+    Il risultato è un unico DataFrame per processo, condiviso da tutte le sessioni
+    (cache_resource, niente copie serializzate per ogni chiamante): non va mai
+    modificato, get_data ne restituisce una vista.
+    """
+    conn = get_db_connection()
+    sql, params = _build_select(table_name, columns, tickers, isins, start_date, end_date)
+    is_full_read = columns is None and not params
+    try:
+        # Letture complete delle tabelle principali: snapshot locale + sole righe cambiate.
+        if is_full_read and table_name in SNAPSHOT_TABLES:
+            try:
+                df = load_table(conn.engine, table_name, TABLE_KEYS.get(table_name, ()))
+                if df is not None:
+                    return apply_schema(df, table_name)
+            except Exception as e:
+                logger.warning("Snapshot locale non disponibile per %r, lettura diretta: %s", table_name, e)
+        # Lettura diretta dall'engine: conn.query terrebbe in cache una seconda copia serializzata
+        df = pd.read_sql(text(sql), conn.engine, params=params)
+        return apply_schema(df, table_name)
     except Exception:
         return pd.DataFrame()
 
+def clear_read_cache() -> None:
+    """Svuota l'archivio condiviso delle letture (es. nel processo di sync, dove le scritture dell'app non incrementano le versioni)."""
+    _read_table.clear()
+
+def get_data(table_name: str,
+             columns: Optional[Sequence[str]] = None,
+             tickers: Optional[Sequence[str]] = None,
+             isins: Optional[Sequence[str]] = None,
+             start_date: Optional[DateLike] = None,
+             end_date: Optional[DateLike] = None) -> pd.DataFrame:
+    """
+    Legge una tabella dal database e restituisce un DataFrame tipizzato (vedi apply_schema):
+    NUMERIC in float64, codici ripetuti in category, 'date' normalizzata a mezzanotte.
+
+    Args:
+        table_name: Nome della tabella da leggere.
+        columns: Colonne da proiettare. Default tutte.
+        tickers: Se indicato, solo le righe con 'ticker' in questa lista.
+        isins: Se indicato, solo le righe con 'isin' in questa lista.
+        start_date: Se indicato, solo le righe con 'date' >= start_date.
+        end_date: Se indicato, solo le righe con 'date' <= end_date.
+
+    I filtri vengono eseguiti in SQL e ogni combinazione distinta di argomenti
+    ha la sua voce di cache, così una pagina su un singolo asset trasferisce
+    solo le righe di quel ticker. La cache è legata alla versione della tabella.
+
+    Restituisce una vista (copia superficiale) del DataFrame condiviso: i dati non vengono
+    copiati e, grazie a Copy-on-Write, le modifiche del chiamante restano locali.
+    """
+    df = _read_table(table_name, get_table_version(table_name), columns, tickers, isins, start_date, end_date)
+    return df.copy(deep=False)
+
+# --- CARICAMENTO CONCORRENTE DI PIÙ TABELLE ---
+BUNDLE_WORKERS = 4  # sotto il pool_size predefinito di SQLAlchemy (5)
+
+TableSpec = Union[str, Dict[str, Any]]
+
+def load_bundle(specs: Dict[str, TableSpec], max_workers: int = BUNDLE_WORKERS) -> Tuple[Dict[str, pd.DataFrame], Dict[str, float]]:
+    """
+    Legge più tabelle in parallelo con get_data, ognuna su una connessione del pool.
+
+    'specs' associa un nome a una tabella oppure a un dizionario di argomenti di get_data
+    con la chiave 'table' (es. {"prices": {"table": "prices", "tickers": [t]}}).
+    Il tempo totale è quello della lettura più lenta invece della somma delle letture;
+    le tabelle già nell'archivio condiviso tornano subito.
+    Restituisce i DataFrame e il tempo in secondi di ogni lettura, nello stesso ordine di 'specs'.
+    """
+    ctx = get_script_run_ctx()
+
+    def _load(spec: TableSpec) -> Tuple[pd.DataFrame, float]:
+        kwargs = {"table_name": spec} if isinstance(spec, str) else {"table_name": spec["table"], **{k: v for k, v in spec.items() if k != "table"}}
+        t0 = time.perf_counter()
+        df = get_data(**kwargs)
+        return df, time.perf_counter() - t0
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max_workers, initializer=lambda: add_script_run_ctx(threading.current_thread(), ctx)) as pool:
+        futures = {name: pool.submit(_load, spec) for name, spec in specs.items()}
+        results = {name: f.result() for name, f in futures.items()}
+    frames = {name: df for name, (df, _) in results.items()}
+    timings = {name: elapsed for name, (_, elapsed) in results.items()}
+    elapsed = time.perf_counter() - started
+    logger.debug("Bundle %d tabelle in %.2fs (somma %.2fs): %s", len(specs), elapsed, sum(timings.values()),
+                 ", ".join(f"{name} {t:.2f}s" for name, t in timings.items()))
+    return frames, timings
+
+def get_last_prices_before(before_date: DateLike, not_before: Optional[DateLike] = None) -> pd.DataFrame:
+    """
+    Restituisce l'ultima chiusura di ogni ticker strettamente precedente a 'before_date'
+    (e non anteriore a 'not_before'). Serve ai ricalcoli incrementali per proseguire
+    il forward-fill dei prezzi senza rileggere tutto lo storico. Non usa la cache.
+    """
+    sql = """
+        SELECT DISTINCT ON (ticker) ticker, date, close_price
+        FROM prices
+        WHERE date < :before AND (CAST(:not_before AS DATE) IS NULL OR date >= :not_before)
+        ORDER BY ticker, date DESC;
+    """
+    params = {'before': pd.Timestamp(before_date).date(), 'not_before': pd.Timestamp(not_before).date() if not_before is not None else None}
+    df = pd.read_sql(text(sql), get_db_connection().engine, params=params)
+    if not df.empty:
+        df['date'] = pd.to_datetime(df['date'])
+    return df
+
+PRICE_TABLES = ("prices", "benchmark_prices")
+
+def get_price_coverage(tickers: Sequence[str], gap_days: int, table_name: str = "prices") -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Copertura dello storico prezzi per i ticker dati, calcolata interamente in SQL:
+    - prima e ultima chiusura per ticker (MIN/MAX(date) ... GROUP BY ticker);
+    - buchi interni, cioè coppie di chiusure consecutive distanti più di 'gap_days' giorni.
+    'table_name' è una delle tabelle di prezzi (PRICE_TABLES).
+    Restituisce (ticker/first_date/last_date, ticker/prev_date/next_date). Non usa la cache.
+    """
+    if table_name not in PRICE_TABLES:
+        raise ValueError(f"Tabella prezzi non valida: {table_name}")
+    table = _quote_ident(table_name)
+    last_sql = f"""
+        SELECT ticker, MIN(date) AS first_date, MAX(date) AS last_date
+        FROM {table}
+        WHERE ticker = ANY(:tickers)
+        GROUP BY ticker;
+    """
+    gaps_sql = f"""
+        SELECT ticker, prev_date, date AS next_date
+        FROM (
+            SELECT ticker, date, LAG(date) OVER (PARTITION BY ticker ORDER BY date) AS prev_date
+            FROM {table}
+            WHERE ticker = ANY(:tickers)
+        ) s
+        WHERE date - prev_date > :gap_days
+        ORDER BY ticker, prev_date;
+    """
+    params = {'tickers': list(tickers), 'gap_days': int(gap_days)}
+    with get_db_connection().engine.connect() as c:
+        last_dates = pd.read_sql(text(last_sql), c, params=params)
+        gaps = pd.read_sql(text(gaps_sql), c, params=params)
+    for df, cols in ((last_dates, ['first_date', 'last_date']), (gaps, ['prev_date', 'next_date'])):
+        for col in cols:
+            df[col] = pd.to_datetime(df[col])
+    return last_dates, gaps
+
+def get_checked_gaps(tickers: Sequence[str], table_name: str = "prices", max_age_days: int = 7) -> pd.DataFrame:
+    """
+    Intervalli ticker/start_date/end_date scaricati senza ottenere chiusure negli ultimi 'max_age_days'
+    giorni (vedi record_checked_gaps): quelli più vecchi tornano nel piano e vengono verificati di nuovo.
+    Non usa la cache: la legge il planner insieme a get_price_coverage.
+    """
+    sql = """
+        SELECT ticker, start_date, end_date
+        FROM price_gaps_checked
+        WHERE table_name = :table_name AND ticker = ANY(:tickers)
+          AND checked_at >= NOW() - make_interval(days => :max_age_days);
+    """
+    params = {'table_name': table_name, 'tickers': list(tickers), 'max_age_days': int(max_age_days)}
+    with get_db_connection().engine.connect() as c:
+        checked = pd.read_sql(text(sql), c, params=params)
+    for col in ('start_date', 'end_date'):
+        checked[col] = pd.to_datetime(checked[col])
+    return checked
+
+def record_checked_gaps(gaps: pd.DataFrame, table_name: str = "prices") -> None:
+    """
+    Registra (o rinnova la data di verifica de) gli intervalli ticker/start_date/end_date
+    per cui il provider non ha restituito chiusure.
+    """
+    if gaps.empty:
+        return
+    if table_name not in PRICE_TABLES:
+        raise ValueError(f"Tabella prezzi non valida: {table_name}")
+    sql = text("""
+        INSERT INTO price_gaps_checked (table_name, ticker, start_date, end_date)
+        VALUES (:table_name, :ticker, :start_date, :end_date)
+        ON CONFLICT (table_name, ticker, start_date, end_date) DO UPDATE SET checked_at = NOW();
+    """)
+    rows = [{'table_name': table_name, 'ticker': t, 'start_date': s, 'end_date': e}
+            for t, s, e in zip(gaps['ticker'], pd.to_datetime(gaps['start_date']).dt.date, pd.to_datetime(gaps['end_date']).dt.date)]
+    with get_db_connection().engine.begin() as c:
+        c.execute(sql, rows)
+
+# --- SCRITTURA BULK (COPY FROM STDIN) ---
+BULK_BATCH_ROWS = 50_000
+UNDEFINED_TABLE_PGCODE = "42P01"
+# Marcatore dei valori mancanti nel CSV di COPY: con il default (campo vuoto) anche le stringhe
+# vuote diventerebbero NULL, mentre to_sql le salvava come ''.
+COPY_NULL = r"\N"
+
+def _copy_frame(cursor, df: pd.DataFrame, table_name: str, batch_size: int = BULK_BATCH_ROWS) -> None:
+    """
+    Invia un DataFrame a una tabella esistente con COPY FROM STDIN usando il cursore dato.
+    Il frame viene serializzato in CSV a blocchi di al massimo 'batch_size' righe,
+    così la memoria usata resta limitata anche per backfill molto grandi.
+    NaN/None diventano NULL, le stringhe vuote restano ''.
+    """
+    cols_sql = ", ".join(_quote_ident(c) for c in df.columns)
+    copy_sql = f"COPY {_quote_ident(table_name)} ({cols_sql}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')"
+    for start in range(0, len(df), batch_size):
+        buf = io.StringIO()
+        df.iloc[start:start + batch_size].to_csv(buf, index=False, header=False, na_rep=COPY_NULL)
+        buf.seek(0)
+        cursor.copy_expert(copy_sql, buf)
+
+def bulk_insert(df: pd.DataFrame, table_name: str, batch_size: int = BULK_BATCH_ROWS) -> Dict[str, float]:
+    """
+    Accoda le righe di un DataFrame a una tabella esistente con COPY FROM STDIN,
+    in un'unica transazione e a blocchi di dimensione limitata.
+
+    Non invalida la cache: usare save_data(..., method='append') dall'app.
+    Restituisce le statistiche della scrittura: righe, secondi e righe al secondo.
+    """
+    if df.empty:
+        return {"rows": 0, "seconds": 0.0, "rows_per_sec": 0.0}
+
+    raw = get_db_connection().engine.raw_connection()
+    started = time.perf_counter()
+    try:
+        cursor = raw.cursor()
+        _copy_frame(cursor, df, table_name, batch_size)
+        cursor.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    elapsed = time.perf_counter() - started
+    stats = {"rows": len(df), "seconds": elapsed, "rows_per_sec": len(df) / elapsed if elapsed > 0 else float(len(df))}
+    logger.debug("COPY %s: %d righe in %.2fs (%.0f righe/s)", table_name, stats['rows'], elapsed, stats['rows_per_sec'])
+    return stats
+
+# --- UPSERT (INSERT ... ON CONFLICT) ---
+# Chiave naturale di ogni tabella, usata per ON CONFLICT e per le cancellazioni mirate.
+TABLE_KEYS: Dict[str, Tuple[str, ...]] = {
+    'transactions': ('id',),
+    'mapping': ('isin',),
+    'prices': ('ticker', 'date'),
+    'benchmark_prices': ('ticker', 'date'),
+    'budget': ('id',),
+    'settings': ('key',),
+    'asset_allocation': ('ticker',),
+    'asset_exposure': ('ticker', 'dimension', 'key'),
+    'networth_history': ('date',),
+    'portfolio_daily': ('date',),
+}
+# Tabelle con chiave SERIAL: le righe nuove arrivano senza chiave e la genera il DB.
+SERIAL_KEY_TABLES = {'budget'}
+
+def _integral_keys(df: pd.DataFrame, keys: Sequence[str]) -> pd.DataFrame:
+    """
+    Le chiavi intere con valori mancanti diventano float in pandas ('5.0'),
+    che COPY rifiuta per una colonna INTEGER: le riportiamo a Int64.
+    """
+    df = df.copy()
+    for k in keys:
+        if pd.api.types.is_float_dtype(df[k]):
+            df[k] = df[k].astype('Int64')
+    return df
+
+def upsert_data(df: pd.DataFrame, table_name: str, delete_keys: Optional[pd.DataFrame] = None) -> Dict[str, int]:
+    """
+    Inserisce o aggiorna le righe di 'df' in base alla chiave naturale della tabella
+    (TABLE_KEYS) e cancella le righe indicate in 'delete_keys', tutto in una transazione.
+
+    Le righe passano da tabelle temporanee caricate con COPY, poi:
+        DELETE ... USING <chiavi da cancellare>
+        INSERT ... SELECT ... ON CONFLICT (<chiave>) DO UPDATE
+    Il costo dipende quindi dalle righe modificate e non dalla dimensione della tabella,
+    e la tabella non viene mai ricreata: chiavi primarie e tipi restano quelli di setup.py.
+
+    Non invalida la cache: usare save_data(..., method='upsert') dall'app.
+    Restituisce il numero di righe scritte e cancellate.
+    """
+    keys = TABLE_KEYS[table_name]
+    table_sql = _quote_ident(table_name)
+    keys_sql = ", ".join(_quote_ident(k) for k in keys)
+    delete_keys = delete_keys if delete_keys is not None else pd.DataFrame(columns=list(keys))
+
+    new_rows = pd.DataFrame()
+    if table_name in SERIAL_KEY_TABLES and not df.empty:
+        missing_key = df[list(keys)].isna().any(axis=1)
+        new_rows = df[missing_key].drop(columns=list(keys))
+        df = df[~missing_key]
+    # ON CONFLICT non può toccare due volte la stessa riga nello stesso comando.
+    df = df.drop_duplicates(subset=list(keys), keep='last') if not df.empty else df
+
+    raw = get_db_connection().engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        deleted = 0
+        if not delete_keys.empty:
+            cursor.execute(f"CREATE TEMP TABLE _delete_stage ON COMMIT DROP AS SELECT {keys_sql} FROM {table_sql} WITH NO DATA;")
+            _copy_frame(cursor, _integral_keys(delete_keys[list(keys)], keys), "_delete_stage")
+            match = " AND ".join(f"t.{_quote_ident(k)} = d.{_quote_ident(k)}" for k in keys)
+            cursor.execute(f"DELETE FROM {table_sql} AS t USING _delete_stage AS d WHERE {match};")
+            deleted = cursor.rowcount
+
+        if not df.empty:
+            cols = list(df.columns)
+            cols_sql = ", ".join(_quote_ident(c) for c in cols)
+            updates = [c for c in cols if c not in keys]
+            on_conflict = "DO UPDATE SET " + ", ".join(f"{_quote_ident(c)} = EXCLUDED.{_quote_ident(c)}" for c in updates) if updates else "DO NOTHING"
+            cursor.execute(f"CREATE TEMP TABLE _upsert_stage ON COMMIT DROP AS SELECT {cols_sql} FROM {table_sql} WITH NO DATA;")
+            _copy_frame(cursor, _integral_keys(df, keys), "_upsert_stage")
+            cursor.execute(f"INSERT INTO {table_sql} ({cols_sql}) SELECT {cols_sql} FROM _upsert_stage ON CONFLICT ({keys_sql}) {on_conflict};")
+
+        if not new_rows.empty:
+            _copy_frame(cursor, new_rows, table_name)
+
+        cursor.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    return {"upserted": len(df) + len(new_rows), "deleted": deleted}
+
+# --- IMPORT TRANSAZIONI (STAGING + ON CONFLICT DO NOTHING) ---
+IMPORT_LOCK_KEY = 720_603
+
+def import_transactions(df: pd.DataFrame) -> Dict[str, Any]:
+    """
+    Importa transazioni già convertite passando da una tabella temporanea di staging:
+    - COPY delle righe candidate in _import_stage;
+    - INSERT ... SELECT ... ON CONFLICT (id) DO NOTHING delle righe con un ID non ancora presente,
+      tenendo per ogni chiave di contenuto (data, ISIN, quantità, controvalore) solo le occorrenze
+      oltre quelle già presenti con un ID che nessuna riga importata ha riconosciuto: così non si
+      duplicano le righe salvate con i vecchi ID posizionali, e un'operazione nuova identica a una
+      già salvata non viene scambiata per quest'ultima.
+
+    Il confronto avviene nel database con l'indice (isin, date): il costo dipende dalle righe
+    importate e non dalla dimensione dello storico. Un advisory lock di transazione serializza
+    gli import concorrenti (es. due schede del browser).
+
+    Non invalida la cache: usare save_data(..., method='import') dall'app.
+    Restituisce righe inserite, righe scartate, prima data inserita e tempi.
+    """
+    stats: Dict[str, Any] = {"rows": 0, "skipped": len(df), "first_date": None, "seconds": 0.0, "rows_per_sec": 0.0}
+    if df.empty:
+        return stats
+    df = df.drop_duplicates(subset=['id'], keep='first')
+    cols_sql = ", ".join(_quote_ident(c) for c in df.columns)
+    same_content = (
+        "t.date = s.date AND t.isin = s.isin "
+        "AND ROUND(t.quantity, 6) = ROUND(s.quantity, 6) AND ROUND(t.local_value, 6) = ROUND(s.local_value, 6)"
+    )
+
+    raw = get_db_connection().engine.raw_connection()
+    started = time.perf_counter()
+    try:
+        cursor = raw.cursor()
+        cursor.execute(f"SELECT pg_advisory_xact_lock({IMPORT_LOCK_KEY});")
+        cursor.execute(f"CREATE TEMP TABLE _import_stage ON COMMIT DROP AS SELECT {cols_sql} FROM transactions WITH NO DATA;")
+        _copy_frame(cursor, df, "_import_stage")
+        cursor.execute(f"""
+            INSERT INTO transactions ({cols_sql})
+            SELECT {cols_sql} FROM (
+                SELECT s.*, ROW_NUMBER() OVER (
+                    PARTITION BY s.date, s.isin, ROUND(s.quantity, 6), ROUND(s.local_value, 6) ORDER BY s.id
+                ) - 1 AS occurrence
+                FROM _import_stage s
+                WHERE NOT EXISTS (SELECT 1 FROM transactions t WHERE t.id = s.id)
+            ) s
+            WHERE s.occurrence >= (
+                SELECT COUNT(*) FROM transactions t
+                WHERE {same_content} AND NOT EXISTS (SELECT 1 FROM _import_stage x WHERE x.id = t.id)
+            )
+            ON CONFLICT (id) DO NOTHING
+            RETURNING date;
+        """)
+        inserted_dates = [row[0] for row in cursor.fetchall()]
+        cursor.close()
+        raw.commit()
+    except Exception:
+        raw.rollback()
+        raise
+    finally:
+        raw.close()
+
+    elapsed = time.perf_counter() - started
+    stats.update(rows=len(inserted_dates), skipped=len(df) - len(inserted_dates), seconds=elapsed,
+                 first_date=pd.Timestamp(min(inserted_dates)) if inserted_dates else None,
+                 rows_per_sec=len(df) / elapsed if elapsed > 0 else float(len(df)))
+    logger.debug("Import transactions: %d inserite, %d già presenti, in %.2fs", stats['rows'], stats['skipped'], elapsed)
+    return stats
+
 # --- SALVATAGGIO DATI ---
-def save_data(df: pd.DataFrame, table_name: str, method: str = 'replace') -> None:
+def save_data(df: pd.DataFrame, table_name: str, method: str = 'replace', delete_keys: Optional[pd.DataFrame] = None) -> Optional[Dict[str, float]]:
     """
-    Salva un DataFrame in una tabella e pulisce la cache globale.
+    Salva un DataFrame in una tabella e invalida la cache della sola tabella scritta.
     
     Args:
         df: DataFrame da salvare.
         table_name: Nome della tabella target.
-        method: 'replace' o 'append'. Default 'replace'.
+        method: 'replace', 'append', 'upsert' o 'import'. Default 'replace'.
+            'append' usa COPY FROM STDIN (vedi bulk_insert) e ripiega su to_sql
+            solo se la tabella non esiste ancora.
+            'upsert' aggiorna/inserisce per chiave naturale (vedi upsert_data).
+            'import' (solo transactions) inserisce le sole righe nuove (vedi import_transactions).
+        delete_keys: Solo per 'upsert', chiavi delle righe da cancellare.
+
+    Returns:
+        Le statistiche di scrittura per 'append', 'upsert' e 'import', altrimenti None.
     """
-    if df.empty:
-        return
+    has_deletes = method == 'upsert' and delete_keys is not None and not delete_keys.empty
+    if df.empty and not has_deletes:
+        return None
 
     conn = get_db_connection()
     try:
-        # Assicura che le date siano datetime corretti
+        # Assicura che le date siano datetime corretti (senza modificare il DataFrame del chiamante)
         if 'date' in df.columns:
-            df['date'] = pd.to_datetime(df['date'])
+            df = df.assign(date=pd.to_datetime(df['date']))
+        if delete_keys is not None and 'date' in delete_keys.columns:
+            delete_keys = delete_keys.assign(date=pd.to_datetime(delete_keys['date']))
         
-        # Mapping va sempre rimpiazzato per evitare duplicati sporchi
-        if table_name == 'mapping': 
-            method = 'replace'
-            
-        df.to_sql(name=table_name, con=conn.engine, if_exists=method, index=False)
+        # Mapping non va mai accodato per evitare duplicati sporchi: si aggiorna per ISIN
+        if table_name == 'mapping' and method == 'append': 
+            method = 'upsert'
+
+        stats = None
+        if method == 'upsert':
+            stats = upsert_data(df, table_name, delete_keys)
+        elif method == 'import':
+            if table_name != 'transactions':
+                raise ValueError("method='import' è disponibile solo per la tabella transactions")
+            stats = import_transactions(df)
+        elif method == 'append':
+            try:
+                stats = bulk_insert(df, table_name)
+            except Exception as e:
+                if getattr(e, 'pgcode', None) != UNDEFINED_TABLE_PGCODE:
+                    raise
+                # Tabella non ancora creata: to_sql la crea al primo salvataggio.
+                df.to_sql(name=table_name, con=conn.engine, if_exists=method, index=False)
+        else:
+            df.to_sql(name=table_name, con=conn.engine, if_exists=method, index=False)
         
-        # Pulisce la cache di TUTTE le funzioni @st.cache_data.
-        st.cache_data.clear()
+        # Invalida solo le letture (e i calcoli derivati) che dipendono da questa tabella.
+        bump_table_version(table_name)
     except Exception as e:
         st.error(f"Errore durante il salvataggio della tabella '{table_name}': {e}")
+        return None
 
-def save_allocation_json(ticker: str, geo_dict: Dict[str, float], sec_dict: Dict[str, float]) -> None:
+    # La scrittura è già confermata: un errore nel refresh delle viste non deve farla
+    # risultare fallita. Le viste restano alla versione precedente fino al prossimo refresh.
+    try:
+        refresh_dependent_views(table_name)
+    except Exception as e:
+        st.warning(f"Dati di '{table_name}' salvati, ma l'aggiornamento delle viste derivate non è riuscito: {e}")
+        for view, deps in MATERIALIZED_VIEWS.items():
+            if table_name in deps:
+                bump_table_version(view)
+    return stats
+
+def _exposure_frame(allocations: Dict[str, Tuple[Dict[str, float], Dict[str, float]]]) -> pd.DataFrame:
+    """Allocazioni {ticker: (geo, sec)} in righe ticker/dimension/key/weight, scartando i pesi non numerici."""
+    rows = [(ticker, dim, key, weight)
+            for ticker, (geo, sec) in allocations.items()
+            for dim, values in (("geo", geo), ("sec", sec))
+            for key, weight in (values or {}).items()]
+    df = pd.DataFrame(rows, columns=["ticker", "dimension", "key", "weight"])
+    df["weight"] = pd.to_numeric(df["weight"], errors="coerce")
+    return df.dropna(subset=["weight"])
+
+def save_allocations(allocations: Dict[str, Tuple[Dict[str, float], Dict[str, float]]]) -> Optional[int]:
     """
-    Salva i dizionari di allocazione come JSON nel DB usando UPSERT.
+    Salva le allocazioni {ticker: (geo, sec)} in un'unica transazione:
+    - UPSERT dei JSON in asset_allocation (con last_updated = NOW());
+    - sostituzione delle righe dei ticker in asset_exposure, il formato lungo usato per le aggregazioni.
+    Restituisce il numero di ticker salvati, None in caso di errore.
     """
-    conn = get_db_connection()
-    geo_json = json.dumps(geo_dict, ensure_ascii=False)
-    sec_json = json.dumps(sec_dict, ensure_ascii=False)
-    
-    query = text("""
-        INSERT INTO asset_allocation (ticker, geography_json, sector_json, last_updated)
-        VALUES (:t, :g, :s, NOW())
-        ON CONFLICT (ticker) DO UPDATE 
-        SET geography_json = :g, sector_json = :s, last_updated = NOW();
-    """)
-    
+    if not allocations:
+        return 0
+    df_alloc = pd.DataFrame([
+        {"ticker": t, "geography_json": json.dumps(geo, ensure_ascii=False), "sector_json": json.dumps(sec, ensure_ascii=False)}
+        for t, (geo, sec) in allocations.items()
+    ])
+    df_exposure = _exposure_frame(allocations)
+
+    raw = get_db_connection().engine.raw_connection()
     try:
-        with conn.session as s:
-            s.execute(query, {'t': ticker, 'g': geo_json, 's': sec_json})
-            s.commit()
-        
-        st.cache_data.clear()
+        cursor = raw.cursor()
+        cursor.execute("CREATE TEMP TABLE _alloc_stage (ticker VARCHAR(50), geography_json TEXT, sector_json TEXT) ON COMMIT DROP;")
+        _copy_frame(cursor, df_alloc, "_alloc_stage")
+        cursor.execute("""
+            INSERT INTO asset_allocation (ticker, geography_json, sector_json, last_updated)
+            SELECT ticker, geography_json, sector_json, NOW() FROM _alloc_stage
+            ON CONFLICT (ticker) DO UPDATE
+            SET geography_json = EXCLUDED.geography_json, sector_json = EXCLUDED.sector_json, last_updated = NOW();
+        """)
+        cursor.execute("DELETE FROM asset_exposure WHERE ticker = ANY(%s);", (list(allocations),))
+        if not df_exposure.empty:
+            _copy_frame(cursor, df_exposure, "asset_exposure")
+        cursor.close()
+        raw.commit()
     except Exception as e:
-        st.error(f"Errore salvataggio JSON per {ticker}: {e}")
\ No newline at end of file
+        raw.rollback()
+        st.error(f"Errore salvataggio allocazioni per {', '.join(allocations)}: {e}")
+        return None
+    finally:
+        raw.close()
+
+    bump_table_version("asset_allocation")
+    bump_table_version("asset_exposure")
+    return len(allocations)
+
+def save_allocation_json(ticker: str, geo_dict: Dict[str, float], sec_dict: Dict[str, float]) -> None:
+    """
+    Salva i dizionari di allocazione di un asset (JSON in asset_allocation e righe in asset_exposure).
+    """
+    save_allocations({ticker: (geo_dict, sec_dict)})
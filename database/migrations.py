@@ -0,0 +1,313 @@
+import json
+from sqlalchemy import text
+from typing import List, Tuple, Dict, Any, Callable
+
+# Chiave dell'advisory lock che serializza le migrazioni tra più processi/repliche
+MIGRATION_LOCK_KEY = 720_601
+
+# Elenco ordinato delle migrazioni: (versione, descrizione, comandi SQL).
+# Una migrazione già applicata non viene più eseguita: le modifiche allo schema
+# vanno sempre aggiunte come nuova versione in fondo alla lista.
+MIGRATIONS: List[Tuple[int, str, List[str]]] = [
+    (1, "Tabelle di base", [
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            id VARCHAR(255) PRIMARY KEY,
+            date DATE,
+            product VARCHAR(255),
+            isin VARCHAR(50),
+            quantity NUMERIC(20, 10),
+            local_value NUMERIC(20, 10),
+            fees NUMERIC(20, 10),
+            currency VARCHAR(10)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS mapping (
+            isin VARCHAR(50) PRIMARY KEY,
+            ticker VARCHAR(50),
+            category VARCHAR(50)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS prices (
+            ticker VARCHAR(50),
+            date DATE,
+            close_price NUMERIC(20, 10),
+            PRIMARY KEY (ticker, date)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS budget (
+            id SERIAL PRIMARY KEY,
+            date DATE,
+            type VARCHAR(50),
+            category VARCHAR(100),
+            amount NUMERIC(20, 2),
+            note TEXT
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS settings (
+            key VARCHAR(50) PRIMARY KEY,
+            value TEXT
+        );
+        """,
+    ]),
+    (2, "Tabelle asset_allocation e networth_history", [
+        """
+        CREATE TABLE IF NOT EXISTS asset_allocation (
+            ticker VARCHAR(50) PRIMARY KEY,
+            geography_json TEXT,
+            sector_json TEXT,
+            last_updated TIMESTAMP DEFAULT NOW()
+        );
+        """,
+        "ALTER TABLE asset_allocation ADD COLUMN IF NOT EXISTS last_updated TIMESTAMP DEFAULT NOW();",
+        """
+        CREATE TABLE IF NOT EXISTS networth_history (
+            date DATE PRIMARY KEY,
+            net_worth NUMERIC(20, 2),
+            goal NUMERIC(20, 2)
+        );
+        """,
+        "ALTER TABLE networth_history ADD COLUMN IF NOT EXISTS net_worth NUMERIC(20, 2);",
+        "ALTER TABLE networth_history ADD COLUMN IF NOT EXISTS goal NUMERIC(20, 2);",
+    ]),
+    (3, "Chiavi naturali per l'UPSERT sulle tabelle ricreate da to_sql", [
+        # I vecchi salvataggi con method='replace' ricreavano le tabelle senza chiavi:
+        # si rimuovono i duplicati e si ripristinano gli indici univoci usati da ON CONFLICT.
+        "DELETE FROM mapping a USING mapping b WHERE a.isin = b.isin AND a.ctid < b.ctid;",
+        "CREATE UNIQUE INDEX IF NOT EXISTS mapping_isin_key ON mapping (isin);",
+        "DELETE FROM networth_history a USING networth_history b WHERE a.date = b.date AND a.ctid < b.ctid;",
+        "CREATE UNIQUE INDEX IF NOT EXISTS networth_history_date_key ON networth_history (date);",
+        "CREATE SEQUENCE IF NOT EXISTS budget_id_seq;",
+        "SELECT setval('budget_id_seq', COALESCE((SELECT MAX(id) FROM budget), 0) + 1, false);",
+        "ALTER TABLE budget ALTER COLUMN id SET DEFAULT nextval('budget_id_seq');",
+        "UPDATE budget SET id = nextval('budget_id_seq') WHERE id IS NULL;",
+        "CREATE UNIQUE INDEX IF NOT EXISTS budget_id_key ON budget (id);",
+    ]),
+    (4, "Indici per i pattern di accesso dell'app", [
+        "CREATE INDEX IF NOT EXISTS idx_prices_ticker_date ON prices (ticker, date DESC);",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_isin_date ON transactions (isin, date);",
+        "CREATE INDEX IF NOT EXISTS idx_transactions_date ON transactions (date);",
+        "CREATE INDEX IF NOT EXISTS idx_budget_date ON budget (date);",
+    ]),
+    (5, "Viste materializzate holdings_current e last_price_per_ticker", [
+        # Quantità e controvalore per ISIN/prodotto già uniti alla mappatura: poche decine di righe.
+        # Le posizioni chiuse restano, il filtro sulla quantità lo applicano i servizi.
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS holdings_current AS
+        SELECT t.isin,
+               COALESCE(t.product, '') AS product,
+               m.ticker,
+               m.category,
+               SUM(t.quantity) AS quantity,
+               SUM(t.local_value) AS local_value
+        FROM transactions t
+        LEFT JOIN mapping m ON m.isin = t.isin
+        GROUP BY t.isin, COALESCE(t.product, ''), m.ticker, m.category;
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS holdings_current_key ON holdings_current (isin, product);",
+        # Ultima chiusura per ticker: sfrutta idx_prices_ticker_date invece di ordinare tutta la tabella.
+        """
+        CREATE MATERIALIZED VIEW IF NOT EXISTS last_price_per_ticker AS
+        SELECT DISTINCT ON (ticker) ticker, date, close_price
+        FROM prices
+        ORDER BY ticker, date DESC;
+        """,
+        "CREATE UNIQUE INDEX IF NOT EXISTS last_price_per_ticker_key ON last_price_per_ticker (ticker);",
+    ]),
+    (6, "Valorizzazione giornaliera persistita del portafoglio", [
+        """
+        CREATE TABLE IF NOT EXISTS portfolio_daily (
+            date DATE PRIMARY KEY,
+            value NUMERIC(20, 4),
+            invested NUMERIC(20, 4),
+            category_values TEXT
+        );
+        """,
+    ]),
+    (7, "Stato delle sincronizzazioni eseguite in background", [
+        # Una riga per job (es. 'prices'): il processo di sync la aggiorna, l'interfaccia la legge soltanto.
+        """
+        CREATE TABLE IF NOT EXISTS sync_status (
+            job VARCHAR(50) PRIMARY KEY,
+            status VARCHAR(20),
+            started_at TIMESTAMP,
+            finished_at TIMESTAMP,
+            rows_written INTEGER,
+            message TEXT,
+            host VARCHAR(255)
+        );
+        """,
+    ]),
+    (8, "Storico locale di benchmark e tassi di cambio", [
+        # Serie dei benchmark e delle coppie EUR{valuta}=X usate dalla simulazione, estese in modo incrementale
+        """
+        CREATE TABLE IF NOT EXISTS benchmark_prices (
+            ticker VARCHAR(50),
+            date DATE,
+            close_price NUMERIC(20, 10),
+            PRIMARY KEY (ticker, date)
+        );
+        """,
+    ]),
+    (9, "Allocazioni in formato lungo (asset_exposure) e vista portfolio_exposure", [
+        # Una riga per (ticker, dimensione, voce): 'geo' per i paesi, 'sec' per i settori, peso in percentuale.
+        """
+        CREATE TABLE IF NOT EXISTS asset_exposure (
+            ticker VARCHAR(50),
+            dimension VARCHAR(10),
+            key VARCHAR(255),
+            weight NUMERIC(10, 4),
+            PRIMARY KEY (ticker, dimension, key)
+        );
+        """,
+        # Backfill dai JSON esistenti: una riga con JSON non valido viene saltata senza bloccare la migrazione.
+        """
+        DO $$
+        DECLARE r RECORD;
+        BEGIN
+            FOR r IN SELECT ticker, geography_json::text AS geo, sector_json::text AS sec FROM asset_allocation LOOP
+                BEGIN
+                    INSERT INTO asset_exposure (ticker, dimension, key, weight)
+                    SELECT r.ticker, d.dimension, e.key, e.value::numeric
+                    FROM (VALUES ('geo', NULLIF(r.geo, '')::jsonb), ('sec', NULLIF(r.sec, '')::jsonb)) AS d(dimension, doc),
+                         LATERAL jsonb_each_text(COALESCE(d.doc, '{}'::jsonb)) AS e
+                    ON CONFLICT DO NOTHING;
+                EXCEPTION WHEN others THEN
+                    RAISE NOTICE USING MESSAGE = 'Allocazione non convertibile per ' || r.ticker || ': ' || SQLERRM;
+                END;
+            END LOOP;
+        END $$;
+        """,
+        # Esposizione in euro dell'intero portafoglio: valore di mercato di ogni posizione per il peso della voce.
+        """
+        CREATE OR REPLACE VIEW portfolio_exposure AS
+        SELECT e.dimension, e.key, SUM(h.quantity * lp.close_price * e.weight / 100) AS value
+        FROM (
+            SELECT product, ticker, category, SUM(quantity) AS quantity
+            FROM holdings_current
+            WHERE ticker IS NOT NULL
+            GROUP BY product, ticker, category
+            HAVING SUM(quantity) > 0.001
+        ) h
+        JOIN last_price_per_ticker lp ON lp.ticker = h.ticker
+        JOIN asset_exposure e ON e.ticker = h.ticker
+        GROUP BY e.dimension, e.key;
+        """,
+    ]),
+    (10, "Rimozione della colonna inutilizzata category_values da portfolio_daily", [
+        # Creata dalla migrazione 6, non è mai stata letta dall'app: le migrazioni applicate non si modificano.
+        "ALTER TABLE portfolio_daily DROP COLUMN IF EXISTS category_values;",
+    ]),
+    (11, "Intervalli di prezzi già verificati e risultati vuoti", [
+        # Buchi interni (chiusure di borsa lunghe) e inizi di storico che il provider non copre:
+        # una riga per intervallo [start_date, end_date) scaricato senza ottenere chiusure.
+        """
+        CREATE TABLE IF NOT EXISTS price_gaps_checked (
+            table_name VARCHAR(50),
+            ticker VARCHAR(50),
+            start_date DATE,
+            end_date DATE,
+            checked_at TIMESTAMP DEFAULT NOW(),
+            PRIMARY KEY (table_name, ticker, start_date, end_date)
+        );
+        """,
+    ]),
+]
+
+def get_applied_versions(connection) -> set:
+    """Restituisce le versioni già applicate, creando la tabella di tracciamento se manca."""
+    connection.exec_driver_sql("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            description TEXT,
+            applied_at TIMESTAMP DEFAULT NOW()
+        );
+    """)
+    return {row[0] for row in connection.exec_driver_sql("SELECT version FROM schema_migrations;")}
+
+def run_migrations(engine, log: Callable[[str], None] = print) -> List[int]:
+    """
+    Applica in ordine le migrazioni mancanti, ognuna nella propria transazione.
+    Un advisory lock evita che due processi le eseguano in contemporanea.
+    Restituisce le versioni applicate in questa esecuzione.
+    """
+    applied_now = []
+    with engine.connect() as c:
+        # Lock a livello di sessione: sopravvive ai commit delle singole migrazioni
+        c.exec_driver_sql(f"SELECT pg_advisory_lock({MIGRATION_LOCK_KEY});")
+        c.commit()
+        try:
+            with c.begin():
+                applied = get_applied_versions(c)
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                log(f"Migrazione {version}: {description}...")
+                with c.begin():
+                    for statement in statements:
+                        c.exec_driver_sql(statement)
+                    c.execute(text("INSERT INTO schema_migrations (version, description) VALUES (:v, :d);"),
+                              {"v": version, "d": description})
+                applied_now.append(version)
+        finally:
+            c.rollback()
+            c.exec_driver_sql(f"SELECT pg_advisory_unlock({MIGRATION_LOCK_KEY});")
+            c.commit()
+    return applied_now
+
+# --- VERIFICA DEI PIANI DI ESECUZIONE ---
+# Query calde dell'app e indici che ci si aspetta vengano usati (basta uno).
+HOT_QUERIES: List[Dict[str, Any]] = [
+    {
+        "name": "Storico prezzi di un ticker in un intervallo",
+        "sql": "SELECT date, close_price FROM prices WHERE ticker = %(ticker)s AND date >= %(start)s ORDER BY date DESC",
+        "params": {"ticker": "SWDA.MI", "start": "2024-01-01"},
+        "expected_indexes": ("idx_prices_ticker_date", "prices_pkey"),
+    },
+    {
+        "name": "Transazioni di un ISIN in un intervallo",
+        "sql": "SELECT * FROM transactions WHERE isin = %(isin)s AND date >= %(start)s",
+        "params": {"isin": "IE00B4L5Y983", "start": "2024-01-01"},
+        "expected_indexes": ("idx_transactions_isin_date",),
+    },
+    {
+        "name": "Transazioni in un intervallo di date",
+        "sql": "SELECT * FROM transactions WHERE date BETWEEN %(start)s AND %(end)s",
+        "params": {"start": "2024-01-01", "end": "2024-12-31"},
+        "expected_indexes": ("idx_transactions_date",),
+    },
+]
+
+def _index_names(plan: Dict[str, Any]) -> List[str]:
+    """Raccoglie ricorsivamente gli indici citati da un piano EXPLAIN in JSON."""
+    names = [plan["Index Name"]] if "Index Name" in plan else []
+    for child in plan.get("Plans", []):
+        names.extend(_index_names(child))
+    return names
+
+def check_query_plans(engine) -> List[Dict[str, Any]]:
+    """
+    Esegue EXPLAIN sulle query calde e verifica che usino uno degli indici previsti.
+
+    Il sequential scan viene disabilitato per la sola transazione: su tabelle piccole
+    il planner lo preferirebbe comunque, mentre qui interessa sapere se l'indice è utilizzabile.
+    """
+    results = []
+    with engine.connect() as c:
+        with c.begin():
+            c.exec_driver_sql("SET LOCAL enable_seqscan = off;")
+            for q in HOT_QUERIES:
+                raw_plan = c.exec_driver_sql(f"EXPLAIN (FORMAT JSON) {q['sql']}", q["params"]).scalar()
+                plan = (json.loads(raw_plan) if isinstance(raw_plan, str) else raw_plan)[0]["Plan"]
+                used = _index_names(plan)
+                results.append({
+                    "query": q["name"],
+                    "expected_indexes": " | ".join(q["expected_indexes"]),
+                    "used_indexes": ", ".join(used) or "-",
+                    "ok": any(name in used for name in q["expected_indexes"]),
+                })
+    return results
@@ -0,0 +1,100 @@
+import os
+import json
+import time
+import pandas as pd
+from pathlib import Path
+from sqlalchemy import text
+from typing import Optional, Dict, Sequence
+
+try:
+    import pyarrow  # noqa: F401  (richiesto da pandas per il formato Parquet)
+    PARQUET_AVAILABLE = True
+except ImportError:
+    PARQUET_AVAILABLE = False
+
+# Cartella locale degli snapshot (una coppia .parquet/.json per tabella)
+SNAPSHOT_DIR = Path(os.environ.get("PORTFOLIO_SNAPSHOT_DIR", ".cache/snapshots"))
+# Tabelle lette per intero dalla dashboard e quindi servite dallo snapshot locale
+SNAPSHOT_TABLES = ("transactions", "prices", "budget", "mapping", "asset_allocation", "asset_exposure")
+
+def _paths(table_name: str) -> tuple[Path, Path]:
+    return SNAPSHOT_DIR / f"{table_name}.parquet", SNAPSHOT_DIR / f"{table_name}.json"
+
+def _read_marker(engine, table_name: str) -> Dict[str, int]:
+    """
+    Marcatore di modifica economico: numero di righe e massimo xmin della tabella.
+    xmin è l'id della transazione che ha scritto la riga, quindi cresce a ogni
+    INSERT o UPDATE; il conteggio intercetta le cancellazioni.
+    La query scorre la tabella sul server ma trasferisce una sola riga.
+    """
+    query = text(f'SELECT COUNT(*) AS n, COALESCE(MAX(xmin::text::bigint), 0) AS max_xmin FROM "{table_name}";')
+    with engine.connect() as c:
+        row = c.execute(query).one()
+    return {"rows": int(row.n), "max_xmin": int(row.max_xmin)}
+
+def _normalize_dates(df: pd.DataFrame) -> pd.DataFrame:
+    """Porta 'date' a datetime, così snapshot e righe nuove si confrontano per chiave."""
+    if 'date' in df.columns:
+        df['date'] = pd.to_datetime(df['date'])
+    return df
+
+def _load_snapshot(table_name: str) -> tuple[Optional[pd.DataFrame], Optional[Dict[str, int]]]:
+    data_path, meta_path = _paths(table_name)
+    if not data_path.exists() or not meta_path.exists():
+        return None, None
+    try:
+        meta = json.loads(meta_path.read_text())
+        return pd.read_parquet(data_path), meta
+    except Exception:
+        return None, None
+
+def _write_snapshot(table_name: str, df: pd.DataFrame, marker: Dict[str, int]) -> None:
+    """Scrive snapshot e marcatore in modo atomico (file temporaneo + rename)."""
+    SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+    data_path, meta_path = _paths(table_name)
+    out = df.copy()
+    # Le colonne JSON/JSONB arrivano come dict: Parquet le salva come testo,
+    # i lettori gestiscono già sia dict sia stringhe JSON.
+    for col in out.columns[out.dtypes == object]:
+        if out[col].map(lambda v: isinstance(v, (dict, list))).any():
+            out[col] = out[col].map(lambda v: json.dumps(v, ensure_ascii=False) if isinstance(v, (dict, list)) else v)
+    tmp_data, tmp_meta = data_path.with_suffix(".parquet.tmp"), meta_path.with_suffix(".json.tmp")
+    out.to_parquet(tmp_data, index=False)
+    tmp_meta.write_text(json.dumps({**marker, "saved_at": time.time()}))
+    os.replace(tmp_data, data_path)
+    os.replace(tmp_meta, meta_path)
+
+def load_table(engine, table_name: str, keys: Sequence[str]) -> Optional[pd.DataFrame]:
+    """
+    Restituisce una tabella completa partendo dallo snapshot locale.
+
+    - Marcatore invariato: la tabella viene letta solo dal disco.
+    - Righe nuove o aggiornate: si scaricano solo quelle con xmin successivo
+      allo snapshot e si fondono per chiave naturale ('keys').
+    - Cancellazioni o marcatore incoerente: si riscarica l'intera tabella.
+
+    Restituisce None se Parquet non è disponibile, così il chiamante usa la lettura classica.
+    """
+    if not PARQUET_AVAILABLE:
+        return None
+
+    marker = _read_marker(engine, table_name)
+    snap, meta = _load_snapshot(table_name)
+    if snap is not None and meta is not None:
+        if meta.get("rows") == marker["rows"] and meta.get("max_xmin") == marker["max_xmin"]:
+            return snap
+        if keys and marker["rows"] >= meta.get("rows", 0) and marker["max_xmin"] >= meta.get("max_xmin", 0):
+            delta = pd.read_sql(
+                text(f'SELECT * FROM "{table_name}" WHERE xmin::text::bigint > :x;'),
+                engine, params={"x": meta["max_xmin"]}
+            )
+            snap, delta = _normalize_dates(snap), _normalize_dates(delta)
+            merged = pd.concat([snap, delta], ignore_index=True).drop_duplicates(subset=list(keys), keep='last')
+            # Se i conti tornano non ci sono state cancellazioni: lo snapshot aggiornato è valido.
+            if len(merged) == marker["rows"]:
+                _write_snapshot(table_name, merged, marker)
+                return merged
+
+    full = _normalize_dates(pd.read_sql(text(f'SELECT * FROM "{table_name}";'), engine))
+    _write_snapshot(table_name, full, marker)
+    return full
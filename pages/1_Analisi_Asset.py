@@ -2,9 +2,10 @@ import streamlit as st
 import pandas as pd
 
 # Importazioni da moduli
-from database.connection import get_data
+from database.connection import load_bundle
 from ui.components import make_sidebar
-from services.asset_service import get_owned_assets, get_asset_kpis, get_asset_allocation_data
+from services.asset_service import get_asset_kpis, get_asset_allocation_data
+from services.portfolio_frame import get_portfolio_frame
 from ui.asset_analysis_components import (
     render_asset_selector, 
     render_asset_header, 
@@ -19,18 +20,15 @@ make_sidebar()
 st.title("🔎 Analisi per Singolo Asset")
 
 # --- 1. CARICAMENTO DATI ---
-with st.spinner("Caricamento dati..."):
-    df_trans = get_data("transactions")
-    df_map = get_data("mapping")
-    df_prices = get_data("prices")
-    df_alloc = get_data("asset_allocation")
+# PortfolioFrame condiviso con la dashboard: ledger e posizioni sono già calcolati per questa versione dei dati
+pf = get_portfolio_frame()
 
-if df_trans.empty or df_map.empty:
+if pf.holdings.empty or pf.holdings['ticker'].isna().all():
     st.warning("⚠️ Dati di transazioni o mappatura mancanti. Vai su 'Gestione Dati' per configurarli.")
     st.stop()
 
 # --- 2. LOGICA DI SELEZIONE ---
-owned_assets = get_owned_assets(df_trans, df_map)
+owned_assets = pf.owned_assets
 if owned_assets.empty:
     st.info("Nessun asset attualmente in portafoglio.")
     st.stop()
@@ -39,9 +37,19 @@ asset_options = owned_assets.apply(lambda x: f"{x['product']} ({x['ticker']})",
 ticker = render_asset_selector(asset_options)
 
 # --- 3. PREPARAZIONE DATI PER L'ASSET SELEZIONATO ---
-df_full = df_trans.merge(df_map, on='isin', how='left')
-df_asset_trans = df_full[df_full['ticker'] == ticker].sort_values('date', ascending=False)
-asset_prices = df_prices[df_prices['ticker'] == ticker].sort_values('date') if not df_prices.empty else pd.DataFrame()
+# Le transazioni dell'asset vengono dal ledger; prezzi e allocazione sono filtrati in SQL.
+df_asset_trans = pf.asset_ledger(ticker)
+with st.spinner("Caricamento storico asset..."):
+    frames, _ = load_bundle({
+        "prices": {"table": "prices", "columns": ["date", "close_price"], "tickers": [ticker]},
+        "alloc": {"table": "asset_allocation", "tickers": [ticker]},
+    })
+    asset_prices, df_alloc = frames["prices"], frames["alloc"]
+
+if not df_asset_trans.empty:
+    df_asset_trans = df_asset_trans.sort_values('date', ascending=False)
+if not asset_prices.empty:
+    asset_prices = asset_prices.sort_values('date')
 
 kpi_data = get_asset_kpis(ticker, owned_assets, df_asset_trans, asset_prices)
 kpi_data['ticker'] = ticker # Aggiungo il ticker per passarlo all'header
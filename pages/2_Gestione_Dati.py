@@ -1,6 +1,6 @@
 import streamlit as st
 from ui.components import make_sidebar
-from database.connection import get_data
+from database.connection import get_data, get_memory_report
 from ui.data_management_components import (
     render_import_tab,
     render_mapping_tab,
@@ -50,4 +50,14 @@ with tab5:
     render_allocation_tab()
 
 with tab6:
-    render_net_worth_tab()
\ No newline at end of file
+    render_net_worth_tab()
+
+# Memoria occupata dalle tabelle lette in questo processo, prima e dopo la tipizzazione
+with st.expander("🧮 Memoria dei dati caricati"):
+    st.dataframe(get_memory_report(), hide_index=True, use_container_width=True,
+        column_config={
+            "table": "Tabella", "rows": "Righe",
+            "before_mb": st.column_config.NumberColumn("Grezzo (MB)", format="%.2f"),
+            "after_mb": st.column_config.NumberColumn("Tipizzato (MB)", format="%.2f"),
+            "saved_mb": st.column_config.NumberColumn("Risparmio (MB)", format="%.2f")
+        })
@@ -1,7 +1,8 @@
 import streamlit as st
-from database.connection import get_data
+from database.connection import load_bundle, get_table_versions
 from ui.components import make_sidebar
-from services.benchmark_service import run_benchmark_simulation
+from services.benchmark_service import run_benchmark_simulation, update_benchmark_store, benchmark_series_tickers
+from services.portfolio_frame import get_portfolio_frame, PORTFOLIO_TABLES
 from ui.benchmark_components import (
     render_benchmark_selector,
     render_benchmark_kpis,
@@ -16,11 +17,13 @@ st.title("⚖️ Sfida il Mercato")
 
 # --- 1. CARICAMENTO DATI ---
 with st.spinner("Caricamento dati di portafoglio..."):
-    df_trans = get_data("transactions")
-    df_map = get_data("mapping")
-    df_prices = get_data("prices")
+    # Prezzi, transazioni (per il ledger della simulazione) e tabelle del PortfolioFrame in parallelo:
+    # il PortfolioFrame poi le trova già in cache
+    frames, _ = load_bundle({"prices": "prices", "transactions": "transactions", **{t: t for t in PORTFOLIO_TABLES}})
+    df_prices = frames["prices"]
+    pf = get_portfolio_frame()
 
-if df_trans.empty or df_map.empty:
+if pf.empty or pf.mapping.empty:
     st.warning("⚠️ Dati di transazioni o mappatura mancanti. Vai su 'Gestione Dati' per configurarli.")
     st.stop()
 
@@ -29,8 +32,15 @@ bench_ticker = render_benchmark_selector()
 
 if bench_ticker:
     try:
+        # Lo storico di benchmark e cambio è locale: si scaricano solo i giorni mancanti
+        with st.spinner(f"Aggiornamento storico di {bench_ticker}..."):
+            try:
+                update_benchmark_store(benchmark_series_tickers(bench_ticker), pf.ledger['date'].min())
+            except Exception as e:
+                st.warning(f"Aggiornamento dello storico non riuscito, uso i dati già salvati: {e}")
+
         with st.spinner(f"Calcolo simulazione su {bench_ticker}..."):
-            df_chart, df_log = run_benchmark_simulation(bench_ticker, df_trans, df_map, df_prices)
+            df_chart, df_log = run_benchmark_simulation(bench_ticker, get_table_versions("transactions", "mapping", "prices", "benchmark_prices"), pf, df_prices)
 
         if not df_chart.empty:
             # --- 3. RENDERIZZAZIONE COMPONENTI ---
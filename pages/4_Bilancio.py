@@ -1,13 +1,15 @@
 import streamlit as st
 import pandas as pd
-from database.connection import get_data
+from database.connection import load_bundle, get_table_versions
 from ui.components import make_sidebar
 from services.portfolio_service import calculate_liquidity
-from services.budget_service import get_monthly_summary
+from services.portfolio_frame import get_portfolio_frame, PORTFOLIO_TABLES
+from services.budget_service import get_budget_cube, get_monthly_summary
 from ui.budget_components import (
     render_month_selector,
     render_monthly_kpis,
     render_monthly_charts,
+    render_year_over_year,
     render_net_worth_section,
     render_transactions_editor
 )
@@ -18,14 +20,10 @@ st.title("💰 Bilancio & Patrimonio")
 
 # --- 1. CARICAMENTO DATI ---
 with st.spinner("Caricamento dati..."):
-    df_budget = get_data("budget")
-    df_trans = get_data("transactions")
-    df_nw = get_data("networth_history")
-
-# Normalizzazione date
-if not df_budget.empty: df_budget['date'] = pd.to_datetime(df_budget['date'], errors='coerce').dt.normalize()
-if not df_trans.empty: df_trans['date'] = pd.to_datetime(df_trans['date'], errors='coerce').dt.normalize()
-if not df_nw.empty: df_nw['date'] = pd.to_datetime(df_nw['date'], errors='coerce').dt.normalize()
+    frames, _ = load_bundle({"budget": "budget", "networth_history": "networth_history", **{t: t for t in PORTFOLIO_TABLES}})
+    df_budget, df_nw = frames["budget"], frames["networth_history"]
+    # Solo data e controvalore delle transazioni: bastano a liquidità e cubo del bilancio
+    df_trans = get_portfolio_frame().cash_flows
 
 if df_budget.empty:
     st.info("👋 Nessun dato di bilancio. Vai su 'Gestione Dati' per inserire entrate e uscite.")
@@ -33,16 +31,23 @@ if df_budget.empty:
 
 # --- 2. SEZIONE ANALISI MENSILE ---
 st.subheader("Analisi Mensile")
-selected_month = render_month_selector(df_budget)
-df_month = df_budget[df_budget['date'].dt.strftime('%Y-%m') == selected_month]
+# Cubo mese × tipo × categoria: ricostruito solo quando cambiano budget o transazioni
+cube = get_budget_cube(get_table_versions("budget", "transactions"), df_budget, df_trans)
+selected_month = render_month_selector(cube.months)
+month_start = pd.Timestamp(selected_month)
+df_month = df_budget[(df_budget['date'] >= month_start) & (df_budget['date'] < month_start + pd.DateOffset(months=1))]
 
 # Calcoli
-summary = get_monthly_summary(selected_month, df_budget, df_trans)
+summary = get_monthly_summary(selected_month, cube)
 final_liquidity, liquidity_help = calculate_liquidity(df_budget, df_trans)
 
 # Rendering
 render_monthly_kpis(summary, final_liquidity, liquidity_help)
-render_monthly_charts(df_month, summary)
+render_monthly_charts(cube, selected_month, summary)
+
+st.divider()
+
+render_year_over_year(cube)
 
 st.divider()
 
@@ -52,4 +57,4 @@ render_net_worth_section(df_nw)
 st.divider()
 
 # --- 4. SEZIONE DETTAGLIO MOVIMENTI ---
-render_transactions_editor(df_month, df_budget)
\ No newline at end of file
+render_transactions_editor(df_month)
\ No newline at end of file
@@ -0,0 +1,150 @@
+"""
+Aggiornamento in blocco delle allocazioni X-Ray (JustETF) degli asset posseduti.
+
+Uso:
+    python -m services.allocation_refresh                          # asset con allocazione più vecchia di 30 giorni
+    python -m services.allocation_refresh --all --max-age-days 7
+    python -m services.allocation_refresh --fixtures fixtures/justetf/ --dry-run
+        # pagine lette da <cartella>/<ISIN>.html, nessuna scrittura né lettura dal database
+
+Le pagine vengono scaricate in parallelo con un intervallo minimo tra due richieste,
+i risultati salvati in un'unica transazione e per ogni ISIN si riportano
+tempi ed eventuali errori.
+"""
+import argparse
+import time
+import threading
+import pandas as pd
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional
+from database.connection import get_data, save_allocations
+from services.portfolio_frame import PortfolioFrame, build_portfolio_frame
+from services.data_service import fetch_justetf_page, parse_justetf_allocation
+
+STALE_AFTER_DAYS = 30  # età oltre la quale un'allocazione va riscaricata
+MAX_WORKERS = 4
+MIN_INTERVAL = 1.0     # secondi minimi tra l'avvio di due richieste a JustETF
+
+class RateLimiter:
+    """Distanzia le chiamate di almeno 'min_interval' secondi, anche tra thread diversi."""
+    def __init__(self, min_interval: float):
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+
+    def wait(self) -> None:
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.min_interval
+        time.sleep(max(0.0, slot - now))
+
+def find_stale_allocations(pf: PortfolioFrame, df_alloc: pd.DataFrame,
+                           max_age_days: int = STALE_AFTER_DAYS, now: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """
+    Asset posseduti (isin, ticker, product) senza allocazione o con 'last_updated'
+    più vecchio di 'max_age_days' giorni. Con max_age_days=0 restituisce tutti gli asset.
+    """
+    owned = pf.owned_assets
+    if owned.empty:
+        return pd.DataFrame(columns=['isin', 'ticker', 'product'])
+    owned = owned.drop_duplicates(subset='ticker')[['isin', 'ticker', 'product']]
+    if df_alloc.empty or 'last_updated' not in df_alloc.columns:
+        return owned.reset_index(drop=True)
+    now = now or pd.Timestamp.now()
+    last_updated = pd.to_datetime(df_alloc.set_index('ticker')['last_updated'])
+    age = now - owned['ticker'].map(last_updated)
+    stale = age.isna() | (age > pd.Timedelta(days=max_age_days))
+    return owned[stale].reset_index(drop=True)
+
+def fixture_fetcher(directory: Path) -> Callable[[str], str]:
+    """Sorgente di pagine registrate: legge <directory>/<ISIN>.html invece di usare la rete."""
+    directory = Path(directory)
+    def fetch(isin: str) -> str:
+        return (directory / f"{isin}.html").read_text(encoding="utf-8")
+    return fetch
+
+def _refresh_one(isin: str, fetch_html: Callable[[str], str], limiter: RateLimiter) -> dict:
+    limiter.wait()
+    t0 = time.perf_counter()
+    html = fetch_html(isin)
+    t1 = time.perf_counter()
+    geo, sec = parse_justetf_allocation(html)
+    t2 = time.perf_counter()
+    return {"geo": geo, "sec": sec, "fetch_s": t1 - t0, "parse_s": t2 - t1}
+
+def refresh_allocations(targets: pd.DataFrame,
+                        fetch_html: Optional[Callable[[str], str]] = None,
+                        max_workers: int = MAX_WORKERS,
+                        min_interval: float = MIN_INTERVAL,
+                        save: bool = True,
+                        on_progress: Optional[Callable[[int, int, str], None]] = None) -> pd.DataFrame:
+    """
+    Scarica e interpreta in parallelo le pagine JustETF degli ISIN in 'targets' (colonne isin, ticker)
+    e salva tutte le allocazioni trovate in una sola transazione (asset_allocation e asset_exposure).
+
+    Restituisce un report con una riga per ISIN: esito ('ok', 'vuoto', 'errore'),
+    tempi di download e parsing, numero di voci geografiche/settoriali e messaggio d'errore.
+    """
+    fetch_html = fetch_html or fetch_justetf_page
+    limiter = RateLimiter(min_interval)
+    report, allocations = [], {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_refresh_one, r.isin, fetch_html, limiter): r for r in targets.itertuples(index=False)}
+        for done, future in enumerate(as_completed(futures), start=1):
+            target = futures[future]
+            entry = {"isin": target.isin, "ticker": target.ticker, "status": "errore",
+                     "fetch_s": None, "parse_s": None, "geo_n": 0, "sec_n": 0, "message": ""}
+            try:
+                res = future.result()
+                entry.update(fetch_s=round(res["fetch_s"], 3), parse_s=round(res["parse_s"], 4),
+                             geo_n=len(res["geo"]), sec_n=len(res["sec"]))
+                if res["geo"] or res["sec"]:
+                    entry["status"] = "ok"
+                    allocations[target.ticker] = (res["geo"], res["sec"])
+                else:
+                    entry.update(status="vuoto", message="Nessuna tabella Paesi/Settori nella pagina")
+            except Exception as e:
+                entry["message"] = str(e)
+            report.append(entry)
+            if on_progress:
+                on_progress(done, len(futures), f"{target.ticker}: {entry['status']}")
+
+    if save and allocations:
+        if save_allocations(allocations) is None:
+            raise RuntimeError("Salvataggio delle allocazioni non riuscito")
+    return pd.DataFrame(report)
+
+def main():
+    parser = argparse.ArgumentParser(description="Aggiornamento in blocco delle allocazioni JustETF")
+    parser.add_argument("--max-age-days", type=int, default=STALE_AFTER_DAYS, help="età massima di un'allocazione valida")
+    parser.add_argument("--all", action="store_true", help="aggiorna tutti gli asset posseduti, anche se recenti")
+    parser.add_argument("--fixtures", type=Path, help="cartella di pagine registrate <ISIN>.html da usare al posto della rete")
+    parser.add_argument("--isins", nargs="*", help="ISIN da aggiornare (solo con --dry-run; di default tutte le fixture)")
+    parser.add_argument("--dry-run", action="store_true", help="non legge né scrive il database, stampa solo il report")
+    parser.add_argument("--workers", type=int, default=MAX_WORKERS)
+    parser.add_argument("--interval", type=float, default=None, help="secondi minimi tra due richieste (0 con --fixtures)")
+    args = parser.parse_args()
+
+    if args.dry_run:
+        isins = args.isins or (sorted(p.stem for p in args.fixtures.glob("*.html")) if args.fixtures else [])
+        targets = pd.DataFrame({"isin": isins, "ticker": isins})
+    else:
+        targets = find_stale_allocations(build_portfolio_frame(), get_data("asset_allocation"),
+                                         max_age_days=0 if args.all else args.max_age_days)
+    if targets.empty:
+        print("Nessuna allocazione da aggiornare.")
+        return
+
+    interval = args.interval if args.interval is not None else (0.0 if args.fixtures else MIN_INTERVAL)
+    fetch_html = fixture_fetcher(args.fixtures) if args.fixtures else None
+    t0 = time.perf_counter()
+    report = refresh_allocations(targets, fetch_html=fetch_html, max_workers=args.workers,
+                                 min_interval=interval, save=not args.dry_run)
+    elapsed = time.perf_counter() - t0
+    print(report.to_string(index=False))
+    print(f"\n{(report['status'] == 'ok').sum()}/{len(report)} ISIN aggiornati in {elapsed:.2f}s")
+
+if __name__ == "__main__":
+    main()
@@ -2,15 +2,15 @@ import pandas as pd
 import json
 from typing import Dict, Any
 
-def get_owned_assets(df_trans: pd.DataFrame, df_map: pd.DataFrame) -> pd.DataFrame:
+def get_owned_assets(df_holdings: pd.DataFrame) -> pd.DataFrame:
     """
-    Restituisce un DataFrame con gli asset attualmente posseduti (quantità > 0).
+    Restituisce un DataFrame con gli asset attualmente posseduti (quantità > 0),
+    partendo dalle posizioni per ISIN (PortfolioFrame.holdings).
     """
-    if df_trans.empty or df_map.empty:
+    if df_holdings.empty:
         return pd.DataFrame()
     
-    df_full = df_trans.merge(df_map, on='isin', how='left')
-    holdings = df_full.groupby(['product', 'ticker', 'isin']).agg(quantity=('quantity', 'sum')).reset_index()
+    holdings = df_holdings.groupby(['product', 'ticker', 'isin'], observed=True).agg(quantity=('quantity', 'sum')).reset_index()
     owned_assets = holdings[holdings['quantity'] > 0.001].copy()
     return owned_assets
 
@@ -1,103 +1,168 @@
 import streamlit as st
 import pandas as pd
-import yfinance as yf
-from typing import Tuple, Dict, Optional
+import numpy as np
+from sqlalchemy import text
+from typing import Tuple, Dict, Optional, List, Callable
+from database.connection import get_data, save_data, get_db_connection
+from services.price_sync import PriceProvider, DEFAULT_START, fetch_prices, plan_price_sync, record_empty_ranges
+from services.portfolio_frame import PortfolioFrame
 
-@st.cache_data(show_spinner=False)
-def run_benchmark_simulation(bench_ticker: str, df_trans: pd.DataFrame, df_map: pd.DataFrame, df_prices: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+BENCHMARK_TABLE = "benchmark_prices"
+CURRENCY_MAP = {'TO': 'CAD', 'MI': 'EUR', 'DE': 'EUR', 'L': 'GBP', 'AS': 'AUD'}
+
+def benchmark_currency(bench_ticker: str) -> str:
+    """Valuta di quotazione del benchmark dedotta dal suffisso di borsa (EUR se sconosciuto)."""
+    for suffix, curr in CURRENCY_MAP.items():
+        if bench_ticker.endswith(suffix):
+            return curr
+    return 'EUR'
+
+def benchmark_series_tickers(bench_ticker: str) -> List[str]:
+    """Serie necessarie alla simulazione: il benchmark e, se non è in euro, la coppia EUR{valuta}=X."""
+    currency = benchmark_currency(bench_ticker)
+    return [bench_ticker] if currency == 'EUR' else [bench_ticker, f"EUR{currency}=X"]
+
+def get_benchmark_tickers() -> List[str]:
+    """Serie già presenti nello storico locale (benchmark usati in passato e relativi cambi)."""
+    df = pd.read_sql(text(f"SELECT DISTINCT ticker FROM {BENCHMARK_TABLE};"), get_db_connection().engine)
+    return df['ticker'].tolist()
+
+def update_benchmark_store(tickers: List[str], start_date: Optional[pd.Timestamp] = None,
+                           provider: Optional[PriceProvider] = None, log: Callable[[str], None] = print) -> int:
+    """
+    Estende in modo incrementale le serie di benchmark/cambio in benchmark_prices, con lo
+    stesso planner e motore di download dei prezzi posseduti: si scaricano solo coda, buchi
+    e, se viene indicato 'start_date', la parte iniziale mancante.
+    Restituisce il numero di chiusure salvate.
+    """
+    if not tickers:
+        return 0
+    start = pd.Timestamp(start_date).date() if start_date is not None else DEFAULT_START
+    plan = plan_price_sync(tickers, table_name=BENCHMARK_TABLE, default_start=start, extend_head=start_date is not None)
+    if not plan.tasks:
+        return 0
+    log(f"Piano di aggiornamento benchmark: {plan.describe()}")
+    df_new, errors = fetch_prices(plan.tasks, provider=provider)
+    for t, e in errors.items():
+        log(f"Download non riuscito per {t}: {e}")
+    record_empty_ranges(plan.tasks, df_new, errors, table_name=BENCHMARK_TABLE, log=log)
+    if df_new.empty:
+        return 0
+    if save_data(df_new, BENCHMARK_TABLE, method='append') is None:
+        raise RuntimeError("Salvataggio dello storico benchmark non riuscito")
+    return len(df_new)
+
+def _load_series(ticker: str, start_date: pd.Timestamp, end_date: pd.Timestamp) -> pd.Series:
+    """Serie di chiusure dallo storico locale nell'intervallo [start_date, end_date)."""
+    df = get_data(BENCHMARK_TABLE, columns=["date", "close_price"], tickers=[ticker], start_date=start_date, end_date=end_date)
+    if df.empty:
+        return pd.Series(dtype=float)
+    series = df.sort_values('date').set_index('date')['close_price'].astype(float)
+    # Come la vecchia yf.download(end=end_date): la data finale è esclusa
+    return series[series.index < end_date]
+
+# Ogni scrittura cambia data_version: max_entries scarta le simulazioni delle versioni superate
+@st.cache_data(show_spinner=False, max_entries=16)
+def run_benchmark_simulation(bench_ticker: str, data_version: tuple, _pf: PortfolioFrame, _df_prices: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Esegue la simulazione shadow del portafoglio contro un benchmark.
     Restituisce un DataFrame per i grafici e un DataFrame per il log delle transazioni.
-    Lancia un'eccezione in caso di errore nel download dei dati.
+    Lancia un'eccezione se lo storico del benchmark non è disponibile.
+
+    Benchmark e cambio vengono letti da benchmark_prices (vedi update_benchmark_store), senza rete.
+    La cache è indicizzata su 'bench_ticker' e 'data_version' (versioni di transactions,
+    mapping, prices e benchmark_prices): gli argomenti col prefisso '_' sono esclusi dall'hashing.
+    Le transazioni arrivano già unite alla mappatura dal ledger del PortfolioFrame.
     """
-    df_trans['date'] = pd.to_datetime(df_trans['date'], errors='coerce').dt.normalize()
+    df_full, df_prices = _pf.ledger, _df_prices
     if not df_prices.empty:
-        df_prices['date'] = pd.to_datetime(df_prices['date'], errors='coerce').dt.normalize()
-    
-    df_full = df_trans.merge(df_map, on='isin', how='left')
-    start_date = df_trans['date'].min()
-    end_date = df_prices['date'].max() if not df_prices.empty else df_trans['date'].max()
-
-    try:
-        bench_hist = yf.download(bench_ticker, start=start_date, end=end_date, progress=False)
-        if bench_hist.empty:
-            raise ValueError(f"Nessun dato storico trovato per il ticker '{bench_ticker}'.")
-        
-        bench_hist = bench_hist[['Close']].iloc[:, 0]
-        bench_hist.index = pd.to_datetime(bench_hist.index).normalize()
-        full_idx = pd.date_range(start=bench_hist.index.min(), end=bench_hist.index.max(), freq='D')
-        bench_hist = bench_hist.reindex(full_idx).ffill()
-        
-        currency_map = {'TO': 'CAD', 'MI': 'EUR', 'DE': 'EUR', 'L': 'GBP', 'AS': 'AUD'}
-        bench_currency = 'EUR'
-        for suffix, curr in currency_map.items():
-            if bench_ticker.endswith(suffix):
-                bench_currency = curr
-                break
-        
-        fx_hist = None
-        if bench_currency != 'EUR':
-            pair = f"EUR{bench_currency}=X"
-            fx_hist_raw = yf.download(pair, start=start_date, end=end_date, progress=False)
-            if not fx_hist_raw.empty:
-                fx_hist = fx_hist_raw[['Close']].iloc[:, 0]
-                fx_hist.index = pd.to_datetime(fx_hist.index).normalize()
-                fx_hist = fx_hist.reindex(full_idx).ffill()
-
-    except Exception as e:
-        raise ConnectionError(f"Errore durante il download dei dati per {bench_ticker}: {e}")
+        df_prices = df_prices.assign(date=pd.to_datetime(df_prices['date'], errors='coerce').dt.normalize())
+
+    start_date = df_full['date'].min()
+    end_date = df_prices['date'].max() if not df_prices.empty else df_full['date'].max()
+
+    bench_hist = _load_series(bench_ticker, start_date, end_date)
+    if bench_hist.empty:
+        raise ValueError(f"Nessun dato storico trovato per il ticker '{bench_ticker}'.")
+    bench_hist.index = pd.to_datetime(bench_hist.index).normalize()
+    full_idx = pd.date_range(start=bench_hist.index.min(), end=bench_hist.index.max(), freq='D')
+    bench_hist = bench_hist.reindex(full_idx).ffill()
+
+    bench_currency = benchmark_currency(bench_ticker)
+    fx_hist = None
+    if bench_currency != 'EUR':
+        fx_raw = _load_series(f"EUR{bench_currency}=X", start_date, end_date)
+        if not fx_raw.empty:
+            fx_raw.index = pd.to_datetime(fx_raw.index).normalize()
+            fx_hist = fx_raw.reindex(full_idx).ffill()
+
+    return simulate_benchmark(df_full, df_prices, bench_hist, fx_hist, bench_currency, start_date, end_date)
 
+def _asof_positions(index: pd.DatetimeIndex, timeline: pd.DatetimeIndex) -> np.ndarray:
+    """Equivalente vettoriale di index.asof(d) per ogni d: posizione dell'ultima etichetta <= d, -1 se nessuna."""
+    return index.searchsorted(timeline, side='right') - 1
+
+def simulate_benchmark(df_full: pd.DataFrame, df_prices: pd.DataFrame, bench_hist: pd.Series, fx_hist: Optional[pd.Series], bench_currency: str, start_date: pd.Timestamp, end_date: pd.Timestamp) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Motore vettoriale della simulazione shadow: nessun ciclo sui giorni.
+
+    - Flussi di cassa giornalieri e matrice cumulativa delle quantità (giorni x ticker).
+    - Prezzi utente, benchmark e cambio allineati con un asof vettoriale sulla timeline.
+    - Quote del benchmark come somma cumulativa degli acquisti giornalieri.
+
+    'df_full' sono le transazioni già unite alla mappatura, 'bench_hist' e 'fx_hist'
+    le serie giornaliere con forward-fill. L'output coincide con quello del vecchio
+    ciclo giorno per giorno (a meno dell'ordine di somma in virgola mobile).
+    """
     timeline = pd.date_range(start=start_date, end=end_date, freq='D').normalize()
-    my_val_history, bench_val_history = [], []
-    pivot_user = pd.DataFrame()
+    n_days = len(timeline)
+
+    # --- Flussi di cassa e acquisti sul benchmark ---
+    daily_cash = (-df_full.groupby('date')['local_value'].sum().astype(float)).reindex(timeline, fill_value=0.0).to_numpy()
+
+    bench_pos = _asof_positions(bench_hist.index, timeline)
+    has_bench = bench_pos >= 0
+    p_bench = np.where(has_bench, bench_hist.to_numpy(dtype=float)[np.clip(bench_pos, 0, None)], np.nan)
+    fx_rate = np.ones(n_days)
+    if fx_hist is not None:
+        fx_aligned = fx_hist.reindex(bench_hist.index).to_numpy(dtype=float)
+        fx_at = np.where(has_bench, fx_aligned[np.clip(bench_pos, 0, None)], np.nan)
+        fx_rate = np.where(np.isnan(fx_at), 1.0, fx_at)
+
+    priced = has_bench & ~np.isnan(p_bench)
+    buy = (daily_cash != 0) & priced & (np.nan_to_num(p_bench) > 0)
+    qty_bought = np.where(buy, daily_cash * fx_rate / np.where(buy, p_bench, 1.0), 0.0)
+    bench_qty = np.cumsum(qty_bought)
+    bench_values = np.where(priced, bench_qty * np.nan_to_num(p_bench) / fx_rate, 0.0)
+
+    # --- Valore del portafoglio reale ---
+    user_values = np.zeros(n_days)
     if not df_prices.empty:
-        pivot_user = df_prices.pivot_table(index='date', columns='ticker', values='close_price', aggfunc='last').sort_index().ffill()
-    
-    trans_grouped = df_full.groupby('date')
-    user_qty, bench_qty = {}, 0.0
-    log_transactions = []
-
-    for d in timeline:
-        daily_cash = 0
-        if d in trans_grouped.groups:
-            moves = trans_grouped.get_group(d)
-            daily_cash = -moves['local_value'].sum()
-            for _, row in moves.iterrows():
-                tk = row['ticker']
-                if pd.notna(tk): 
-                    user_qty[tk] = user_qty.get(tk, 0) + row['quantity']
-        
-        if daily_cash != 0:
-            try:
-                idx = bench_hist.index.asof(d)
-                if pd.notna(idx):
-                    p_bench = bench_hist.at[idx]
-                    if pd.notna(p_bench) and p_bench > 0:
-                        fx_rate = fx_hist.at[idx] if fx_hist is not None and pd.notna(fx_hist.at[idx]) else 1.0
-                        cash_in_local = daily_cash * fx_rate
-                        qty_bench = cash_in_local / p_bench
-                        bench_qty += qty_bench
-                        log_transactions.append({'Data': d, 'Tipo': 'BENCHMARK', 'Importo': daily_cash, 'Quantità': qty_bench, 'Prezzo': p_bench, 'Valuta': bench_currency})
-            except Exception: pass
-        
-        val_user = sum(q * pivot_user.at[pivot_user.index.asof(d), tk] for tk, q in user_qty.items() if q > 0.001 and tk in pivot_user.columns and pd.notna(pivot_user.index.asof(d)))
-        
-        val_bench = 0
-        try:
-            idx = bench_hist.index.asof(d)
-            if pd.notna(idx):
-                p_bench = bench_hist.at[idx]
-                if pd.notna(p_bench):
-                    fx_rate = fx_hist.at[idx] if fx_hist is not None and pd.notna(fx_hist.at[idx]) else 1.0
-                    val_bench = bench_qty * p_bench / fx_rate
-        except Exception: pass
-        
-        my_val_history.append(val_user)
-        bench_val_history.append(val_bench)
-
-    df_chart = pd.DataFrame({'Data': timeline, 'Tu': my_val_history, 'Benchmark': bench_val_history})
+        pivot_user = df_prices.pivot_table(index='date', columns='ticker', values='close_price', aggfunc='last', observed=True).sort_index().ffill()
+        moves = df_full[df_full['ticker'].notna()]
+        holdings = pd.DataFrame(index=timeline)
+        if not moves.empty:
+            holdings = moves.pivot_table(index='date', columns='ticker', values='quantity', aggfunc='sum', observed=True).astype(float).reindex(timeline).fillna(0).cumsum()
+        cols = holdings.columns.intersection(pivot_user.columns)
+        if len(cols) > 0:
+            price_pos = _asof_positions(pivot_user.index, timeline)
+            has_price = price_pos >= 0
+            qty = holdings[cols].to_numpy()
+            prices = pivot_user[cols].to_numpy(dtype=float)[np.clip(price_pos, 0, None)]
+            # Come nel calcolo originale: un prezzo mancante di un titolo posseduto rende il valore NaN
+            contrib = np.where(qty > 0.001, qty * prices, 0.0)
+            user_values = np.where(has_price, contrib.sum(axis=1), 0.0)
+
+    df_chart = pd.DataFrame({'Data': timeline, 'Tu': user_values, 'Benchmark': bench_values})
     df_chart = df_chart[(df_chart['Tu'] > 0) | (df_chart['Benchmark'] > 0)].reset_index(drop=True)
-    
-    df_log = pd.DataFrame(log_transactions).round(2)
-    
-    return df_chart, df_log
\ No newline at end of file
+
+    df_log = pd.DataFrame()
+    if buy.any():
+        df_log = pd.DataFrame({
+            'Data': timeline[buy], 'Tipo': 'BENCHMARK', 'Importo': daily_cash[buy],
+            'Quantità': qty_bought[buy], 'Prezzo': p_bench[buy], 'Valuta': bench_currency
+        })
+        # Solo le colonne numeriche: round sulla colonna 'Data' emette un UserWarning
+        df_log = df_log.round({'Importo': 2, 'Quantità': 2, 'Prezzo': 2})
+
+    return df_chart, df_log
@@ -1,31 +1,120 @@
+import streamlit as st
 import pandas as pd
 import numpy as np
+from dataclasses import dataclass
 from sklearn.linear_model import LinearRegression
-from typing import Dict, Tuple
+from typing import Dict, List, Optional, Tuple
 
-def get_monthly_summary(selected_month: str, df_budget: pd.DataFrame, df_trans: pd.DataFrame) -> Dict[str, float]:
+# --- CUBO MENSILE DEL BILANCIO ---
+INVESTED_TYPE = 'Investito'  # tipo sintetico nel cubo: importi investiti nel mese (dalle transazioni)
+SUMMARY_COLUMNS = ['entrate', 'uscite', 'risparmio', 'savings_rate', 'investito_mese']
+
+def _month_keys(dates: pd.Series) -> pd.Series:
+    """Mese 'YYYY-MM' di ogni data: si troncano i datetime64 al mese e si formattano solo i valori distinti."""
+    months = pd.Series(pd.to_datetime(dates, errors='coerce').values.astype('datetime64[M]'), index=dates.index)
+    labels = {m: m.strftime('%Y-%m') for m in months.dropna().unique()}
+    return months.map(labels)
+
+@dataclass
+class BudgetCube:
     """
-    Calcola un riepilogo finanziario per il mese selezionato.
+    Aggregato mese × tipo × categoria del bilancio, con l'investito mensile dalle transazioni.
+
+    'cells' ha colonne month ('YYYY-MM'), type ('Entrata', 'Uscita', 'Investito'), category, amount;
+    'monthly' ha un indice per mese (ordinato) e le colonne di SUMMARY_COLUMNS.
+    KPI, grafici e confronti tra mesi o anni sono letture su questi due frame.
     """
-    df_month = df_budget[df_budget['date'].dt.strftime('%Y-%m') == selected_month]
+    cells: pd.DataFrame
+    monthly: pd.DataFrame
+
+    @property
+    def months(self) -> List[str]:
+        """Mesi con movimenti di bilancio, dal più recente."""
+        budget_months = self.cells.loc[self.cells['type'] != INVESTED_TYPE, 'month'].unique()
+        return sorted(budget_months, reverse=True)
 
-    entrate = df_month[df_month['type'] == 'Entrata']['amount'].sum()
-    uscite = df_month[df_month['type'] == 'Uscita']['amount'].sum()
-    risparmio = entrate - uscite
-    savings_rate = (risparmio / entrate * 100) if entrate > 0 else 0
+    def categories(self, month: str, type_: str = 'Uscita') -> pd.DataFrame:
+        """Importi per categoria di un tipo di movimento nel mese."""
+        sel = self.cells[(self.cells['month'] == month) & (self.cells['type'] == type_)]
+        return sel[['category', 'amount']].reset_index(drop=True)
 
-    investito_mese = 0.0
+    def yearly(self) -> pd.DataFrame:
+        """Totali per anno, con tasso di risparmio ricalcolato sui totali."""
+        df = self.monthly.groupby(self.monthly.index.str[:4])[['entrate', 'uscite', 'risparmio', 'investito_mese']].sum()
+        df['savings_rate'] = (df['risparmio'] / df['entrate'].where(df['entrate'] > 0) * 100).fillna(0)
+        df.index.name = 'year'
+        return df
+
+    def year_over_year(self, column: str = 'uscite') -> pd.DataFrame:
+        """Tabella mese dell'anno (1-12) × anno per una colonna di 'monthly', per i confronti anno su anno."""
+        df = self.monthly[[column]].copy()
+        df['year'] = df.index.str[:4]
+        df['month_num'] = df.index.str[5:7].astype(int)
+        return df.pivot(index='month_num', columns='year', values=column).reindex(range(1, 13))
+
+def build_budget_cube(df_budget: pd.DataFrame, df_trans: pd.DataFrame) -> BudgetCube:
+    """Costruisce il cubo con un solo groupby sul bilancio e uno sulle transazioni."""
+    parts = []
+    if not df_budget.empty:
+        b = pd.DataFrame({
+            'month': _month_keys(df_budget['date']),
+            'type': df_budget['type'],
+            'category': df_budget['category'],
+            'amount': pd.to_numeric(df_budget['amount'], errors='coerce').fillna(0.0),
+        })
+        parts.append(b.groupby(['month', 'type', 'category'], as_index=False, observed=True)['amount'].sum())
     if not df_trans.empty:
-        mask_inv = df_trans['date'].dt.strftime('%Y-%m') == selected_month
-        investito_mese = -df_trans[mask_inv]['local_value'].sum()
+        t = pd.DataFrame({
+            'month': _month_keys(df_trans['date']),
+            'amount': -pd.to_numeric(df_trans['local_value'], errors='coerce').fillna(0.0),
+        })
+        inv = t.groupby('month', as_index=False)['amount'].sum()
+        inv['type'], inv['category'] = INVESTED_TYPE, 'Investimenti'
+        parts.append(inv[['month', 'type', 'category', 'amount']])
+    cells = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=['month', 'type', 'category', 'amount'])
+
+    by_type = cells.pivot_table(index='month', columns='type', values='amount', aggfunc='sum', fill_value=0.0, observed=True)
+    monthly = pd.DataFrame(index=by_type.index.sort_values())
+    monthly['entrate'] = by_type.get('Entrata', 0.0)
+    monthly['uscite'] = by_type.get('Uscita', 0.0)
+    monthly['risparmio'] = monthly['entrate'] - monthly['uscite']
+    monthly['savings_rate'] = (monthly['risparmio'] / monthly['entrate'].where(monthly['entrate'] > 0) * 100).fillna(0)
+    monthly['investito_mese'] = by_type.get(INVESTED_TYPE, 0.0)
+    return BudgetCube(cells=cells, monthly=monthly.astype(float))
+
+# Ogni scrittura cambia data_version: max_entries scarta i cubi delle versioni superate
+@st.cache_data(show_spinner=False, max_entries=4)
+def get_budget_cube(data_version: tuple, _df_budget: pd.DataFrame, _df_trans: pd.DataFrame) -> BudgetCube:
+    """
+    Cubo del bilancio in cache, ricostruito solo quando cambia 'data_version'
+    (versioni di budget e transactions); i DataFrame col prefisso '_' sono esclusi dall'hashing.
+    """
+    return build_budget_cube(_df_budget, _df_trans)
+
+def get_monthly_summary(selected_month: str, cube: BudgetCube) -> Dict[str, float]:
+    """
+    Riepilogo finanziario del mese selezionato, letto dal cubo.
+    """
+    if selected_month not in cube.monthly.index:
+        return {k: 0.0 for k in SUMMARY_COLUMNS}
+    return cube.monthly.loc[selected_month, SUMMARY_COLUMNS].to_dict()
 
-    return {
-        "entrate": entrate,
-        "uscite": uscite,
-        "risparmio": risparmio,
-        "savings_rate": savings_rate,
-        "investito_mese": investito_mese
-    }
+def propagate_goals(df_nw: pd.DataFrame, today: Optional[pd.Timestamp] = None) -> pd.DataFrame:
+    """
+    Associa a ogni data con patrimonio il primo obiettivo in scadenza da quella data in poi
+    (merge_asof in avanti) e tiene a parte solo gli obiettivi futuri senza patrimonio.
+    Gli obiettivi passati senza patrimonio restano nel database ma non vengono mostrati.
+    Restituisce date, patrimonio e obiettivo ordinati per data.
+    """
+    today = pd.Timestamp(pd.Timestamp.now() if today is None else today).normalize()
+    df_nw = df_nw.assign(date=pd.to_datetime(df_nw['date']))
+    nw_points = df_nw[['date', 'net_worth']].dropna().sort_values('date')
+    goal_points = df_nw[['date', 'goal']].dropna().sort_values('date')
+    if goal_points.empty:
+        return nw_points.assign(goal=np.nan).reset_index(drop=True)
+    propagated = pd.merge_asof(nw_points, goal_points, on='date', direction='forward')
+    future_goals = goal_points[(goal_points['date'] > today) & ~goal_points['date'].isin(nw_points['date'])]
+    return pd.concat([propagated, future_goals], ignore_index=True).sort_values('date').reset_index(drop=True)
 
 def calculate_net_worth_trend(df_chart: pd.DataFrame) -> Tuple[pd.DataFrame, LinearRegression]:
     """
@@ -44,20 +133,3 @@ def calculate_net_worth_trend(df_chart: pd.DataFrame) -> Tuple[pd.DataFrame, Lin
     
     df_trend = pd.DataFrame({'date': trend_dates, 'trend': trend_y})
     return df_trend, model
-
-def parse_degiro_csv(file):
-    df = pd.read_csv(file)
-    cols = ['Quantità', 'Quotazione', 'Valore', 'Costi di transazione', 'Totale']
-    for c in cols:
-        if c in df.columns:
-            df[c] = df[c].astype(str).str.replace(',', '.').apply(pd.to_numeric, errors='coerce').fillna(0)
-    if 'Data' in df.columns:
-        df['Data'] = pd.to_datetime(df['Data'], format='%d-%m-%Y', errors='coerce').dt.normalize()
-    if 'Costi di transazione' in df.columns:
-        df['Costi di transazione'] = df['Costi di transazione'].abs()
-    return df
-
-def generate_id(row, index):
-    d_str = row['Data'].strftime('%Y-%m-%d') if pd.notna(row['Data']) else ""
-    raw = f"{index}{d_str}{row.get('Ora','')}{row.get('ISIN','')}{row.get('Quantità','')}{row.get('Valore','')}"
-    return hashlib.md5(raw.encode()).hexdigest()
\ No newline at end of file
@@ -1,73 +1,97 @@
+import streamlit as st
 import pandas as pd
-from services.portfolio_service import calculate_liquidity
+import hashlib
+from datetime import datetime, timedelta
+from typing import Optional, Callable, Dict, Any
+from database.connection import get_data, save_data, get_last_prices_before
+from services.portfolio_service import calculate_liquidity, compute_portfolio_daily
+from services.portfolio_frame import PortfolioFrame, get_portfolio_frame
+from services.http_cache import cached_get
+from services.justetf_parser import extract_allocations
+from services.price_sync import PriceProvider, fetch_prices, plan_price_sync, record_empty_ranges
+
+DEGIRO_NUMERIC_COLS = ['Quantità', 'Quotazione', 'Valore', 'Costi di transazione', 'Totale']
+# Campi che identificano un'operazione nell'export DEGIRO (la posizione nel file NON ne fa parte)
+ID_CONTENT_COLS = ['Data', 'Ora', 'ISIN', 'Quantità', 'Valore']
+
 def parse_degiro_csv(file):
     df = pd.read_csv(file)
-    cols = ['Quantità', 'Quotazione', 'Valore', 'Costi di transazione', 'Totale']
-    for c in cols:
+    for c in DEGIRO_NUMERIC_COLS:
         if c in df.columns:
-            df[c] = df[c].astype(str).str.replace(',', '.').apply(pd.to_numeric, errors='coerce').fillna(0)
+            df[c] = pd.to_numeric(df[c].astype(str).str.replace(',', '.'), errors='coerce').fillna(0)
     if 'Data' in df.columns:
         df['Data'] = pd.to_datetime(df['Data'], format='%d-%m-%Y', errors='coerce').dt.normalize()
     if 'Costi di transazione' in df.columns:
         df['Costi di transazione'] = df['Costi di transazione'].abs()
     return df
 
-def generate_id(row, index):
-    d_str = row['Data'].strftime('%Y-%m-%d') if pd.notna(row['Data']) else ""
-    raw = f"{index}{d_str}{row.get('Ora','')}{row.get('ISIN','')}{row.get('Quantità','')}{row.get('Valore','')}"
-    return hashlib.md5(raw.encode()).hexdigest()
-
-def process_new_transactions(file: "UploadedFile", existing_transactions: pd.DataFrame) -> pd.DataFrame:
+def content_ids(df: pd.DataFrame) -> pd.Series:
     """
-    Elabora un file CSV di transazioni, lo confronta con quelle esistenti e restituisce solo le nuove.
+    ID stabili basati sul contenuto: MD5 di data, ora, ISIN, quantità e valore più un contatore
+    di occorrenza per le righe identiche nello stesso export (es. esecuzioni parziali uguali).
+    Lo stesso movimento ottiene lo stesso ID in export con intervalli di date diversi.
     """
-    ndf = parse_degiro_csv(file)
-    rows_to_add = []
-    existing_ids = set(existing_transactions['id']) if not existing_transactions.empty else set()
-    
-    for idx, r in ndf.iterrows():
-        if pd.isna(r.get('ISIN')): continue
-        tid = generate_id(r, idx)
-        if tid not in existing_ids:
-            val = r.get('Totale', 0) if r.get('Totale', 0) != 0 else r.get('Valore', 0)
-            rows_to_add.append({
-                'id': tid, 
-                'date': r['Data'], 
-                'product': r.get('Prodotto',''), 
-                'isin': r.get('ISIN',''), 
-                'quantity': r.get('Quantità',0), 
-                'local_value': val, 
-                'fees': r.get('Costi di transazione',0), 
-                'currency': 'EUR'
-            })
-            existing_ids.add(tid)
-            
-    return pd.DataFrame(rows_to_add)
-
-def calculate_net_worth_snapshot(snapshot_date: pd.Timestamp, df_trans: pd.DataFrame, df_map: pd.DataFrame, df_prices: pd.DataFrame, df_budget: pd.DataFrame) -> tuple[float, float, float]:
+    parts = pd.DataFrame(index=df.index)
+    for c in ID_CONTENT_COLS:
+        col = df[c] if c in df.columns else pd.Series("", index=df.index)
+        if c == 'Data':
+            col = col.dt.strftime('%Y-%m-%d')
+        parts[c] = col.fillna("").astype(str)
+    occurrence = parts.groupby(ID_CONTENT_COLS, sort=False).cumcount().astype(str)
+    raw = parts[ID_CONTENT_COLS[0]].str.cat([parts[c] for c in ID_CONTENT_COLS[1:]], sep="|") + "#" + occurrence
+    return pd.Series([hashlib.md5(r.encode()).hexdigest() for r in raw], index=df.index)
+
+def transactions_from_degiro(ndf: pd.DataFrame) -> pd.DataFrame:
+    """Converte l'export DEGIRO già interpretato nel formato della tabella transactions, in modo vettoriale."""
+    ndf = ndf[ndf['ISIN'].notna()] if 'ISIN' in ndf.columns else ndf.iloc[0:0]
+    zeros = pd.Series(0.0, index=ndf.index)
+    totale, valore = ndf.get('Totale', zeros), ndf.get('Valore', zeros)
+    return pd.DataFrame({
+        'id': content_ids(ndf),
+        'date': ndf['Data'] if 'Data' in ndf.columns else pd.NaT,
+        'product': ndf.get('Prodotto', pd.Series('', index=ndf.index)),
+        'isin': ndf['ISIN'] if 'ISIN' in ndf.columns else '',
+        'quantity': ndf.get('Quantità', zeros),
+        'local_value': totale.where(totale != 0, valore),
+        'fees': ndf.get('Costi di transazione', zeros),
+        'currency': 'EUR'
+    }).reset_index(drop=True)
+
+def import_degiro_file(file: "UploadedFile") -> Optional[Dict[str, Any]]:
+    """
+    Importa un export DEGIRO lasciando la deduplica al database (save_data con method='import'):
+    non serve leggere le transazioni esistenti. Se sono state inserite righe, ricalcola
+    portfolio_daily dalla prima data nuova. Restituisce le statistiche di import (None se fallito).
+    """
+    candidates = transactions_from_degiro(parse_degiro_csv(file))
+    if candidates.empty:
+        return {"rows": 0, "skipped": 0, "first_date": None, "seconds": 0.0, "rows_per_sec": 0.0}
+    stats = save_data(candidates, "transactions", method='import')
+    if stats and stats["rows"] > 0:
+        update_portfolio_daily(since=stats["first_date"])
+    return stats
+
+def calculate_net_worth_snapshot(snapshot_date: pd.Timestamp, df_daily: pd.DataFrame, pf: PortfolioFrame, df_budget: pd.DataFrame) -> tuple[float, float, float]:
     """
     Calcola il valore degli asset, la liquidità e il patrimonio netto totale a una data specifica.
-    Replica la logica complessa della pagina Gestione Dati.
+    Il valore degli asset viene letto dalla tabella portfolio_daily (ultimo giorno <= data),
+    gli investimenti dai flussi di cassa del PortfolioFrame (date già normalizzate).
     """
-    # Normalizza le date per confronti sicuri
-    if not df_trans.empty: df_trans['date'] = pd.to_datetime(df_trans['date']).dt.normalize()
-    if not df_prices.empty: df_prices['date'] = pd.to_datetime(df_prices['date']).dt.normalize()
-    if not df_budget.empty: df_budget['date'] = pd.to_datetime(df_budget['date']).dt.normalize()
-
     net_worth_at_date, total_assets_value, final_liquidity = 0, 0, 0
 
     # Filtra tutti i dati fino alla data dello snapshot
-    trans_at_date = df_trans[df_trans['date'] <= snapshot_date] if not df_trans.empty else pd.DataFrame()
-    prices_at_date = df_prices[df_prices['date'] <= snapshot_date] if not df_prices.empty else pd.DataFrame()
-    budget_at_date = df_budget[df_budget['date'] <= snapshot_date] if not df_budget.empty else pd.DataFrame()
-
-    # 1. Calcolo Valore Asset alla data
-    if not trans_at_date.empty and not df_map.empty and not prices_at_date.empty:
-        df_full_nw = trans_at_date.merge(df_map, on='isin', how='left')
-        last_prices_at_date = prices_at_date.sort_values('date').groupby('ticker').tail(1).set_index('ticker')['close_price']
-        view_nw = df_full_nw.groupby('ticker')['quantity'].sum().reset_index()
-        view_nw['mkt_val'] = view_nw['quantity'] * view_nw['ticker'].map(last_prices_at_date).fillna(0)
-        total_assets_value = view_nw['mkt_val'].sum()
+    cash_flows = pf.cash_flows if not pf.empty else pd.DataFrame()
+    trans_at_date = cash_flows[cash_flows['date'] <= snapshot_date] if not cash_flows.empty else pd.DataFrame()
+    budget_at_date = pd.DataFrame()
+    if not df_budget.empty:
+        budget_at_date = df_budget.assign(date=pd.to_datetime(df_budget['date']).dt.normalize())
+        budget_at_date = budget_at_date[budget_at_date['date'] <= snapshot_date]
+
+    # 1. Valore Asset alla data dalla valorizzazione giornaliera persistita
+    if not df_daily.empty:
+        daily_at_date = df_daily[pd.to_datetime(df_daily['date']) <= snapshot_date]
+        if not daily_at_date.empty:
+            total_assets_value = float(daily_at_date.sort_values('date')['value'].iloc[-1])
 
     # 2. Calcolo Liquidità alla data (usando la funzione di servizio già esistente)
     final_liquidity, _ = calculate_liquidity(budget_at_date, trans_at_date)
@@ -77,137 +101,95 @@ def calculate_net_worth_snapshot(snapshot_date: pd.Timestamp, df_trans: pd.DataF
     
     return net_worth_at_date, total_assets_value, final_liquidity
 
-def fetch_justetf_allocation_robust(isin):
+def update_portfolio_daily(since: Optional[pd.Timestamp] = None) -> int:
+    """
+    Aggiorna la tabella portfolio_daily ricalcolando solo i giorni da 'since' (incluso) a oggi.
+    Con since=None ricostruisce tutto dalla prima transazione (es. dopo una modifica della mappatura).
+    Restituisce il numero di giorni ricalcolati.
+    """
+    pf = get_portfolio_frame()
+    if pf.empty or pf.mapping.empty:
+        return 0
+
+    first_date = pf.ledger['date'].min()
+    start = first_date if since is None else max(pd.Timestamp(since).normalize(), first_date)
+    end = pd.Timestamp.today().normalize()
+    if start > end:
+        return 0
+
+    # Prezzi dell'intervallo più l'ultima chiusura precedente di ogni ticker (mai prima della prima transazione)
+    df_prices = pd.concat([get_last_prices_before(start, first_date), get_data("prices", start_date=start)], ignore_index=True)
+    daily = compute_portfolio_daily(pf, df_prices, start, end)
+
+    stale_dates = None
+    if since is None:
+        stale_dates = get_data("portfolio_daily", columns=["date"], end_date=start - timedelta(days=1))
+    save_data(daily, "portfolio_daily", method='upsert', delete_keys=stale_dates)
+    return len(daily)
+
+JUSTETF_URL = "https://www.justetf.com/it/etf-profile.html?isin={isin}"
+JUSTETF_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept-Language": "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7"
+}
+
+def fetch_justetf_page(isin: str) -> str:
+    """Scarica (passando per la cache HTTP) la pagina profilo JustETF dell'ISIN. Lancia un'eccezione in caso di errore."""
+    response = cached_get(JUSTETF_URL.format(isin=isin), source="justetf", headers=JUSTETF_HEADERS, timeout=15)
+    response.raise_for_status()
+    return response.text
+
+def parse_justetf_allocation(html: str) -> tuple[dict, dict]:
     """
-    Scarica da JustETF usando un metodo robusto basato su BeautifulSoup
-    che cerca le intestazioni 'Paesi' e 'Settori' per identificare le tabelle corrette,
-    indipendentemente dalla loro posizione nella pagina.
+    Estrae le allocazioni geografica e settoriale da una pagina JustETF: le tabelle
+    sono quelle che seguono le intestazioni 'Paesi' e 'Settori' (vedi services.justetf_parser).
     """
-    url = f"https://www.justetf.com/it/etf-profile.html?isin={isin}"
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-        "Accept-Language": "it-IT,it;q=0.9,en-US;q=0.8,en;q=0.7"
-    }
+    return extract_allocations(html)
 
-    geo_dict, sec_dict = {}, {}
+def fetch_justetf_allocation_robust(isin):
+    """
+    Scarica da JustETF le allocazioni geografica e settoriale di un ISIN.
+    In caso di errore mostra il messaggio e restituisce due dizionari vuoti.
+    """
     try:
-        response = requests.get(url, headers=headers, timeout=15)
-        response.raise_for_status()
-        
-        soup = BeautifulSoup(response.text, 'lxml')
-        
-        # --- ESTRAZIONE DATI GEOGRAFIA ---
-        h3_geo = soup.find('h3', string=lambda text: text and 'Paesi' in text)
-        if h3_geo:
-            table = h3_geo.find_next('table')
-            if table:
-                for row in table.find_all('tr'):
-                    cols = row.find_all('td')
-                    if len(cols) >= 2:
-                        key = cols[0].text.strip()
-                        val_str = cols[1].text.strip().replace('%', '').replace(',', '.')
-                        try:
-                            val = float(val_str)
-                            if val < 101: geo_dict[key] = val
-                        except (ValueError, TypeError):
-                            pass
-        
-        # --- ESTRAZIONE DATI SETTORI ---
-        h3_sec = soup.find('h3', string=lambda text: text and 'Settori' in text)
-        if h3_sec:
-            table = h3_sec.find_next('table')
-            if table:
-                for row in table.find_all('tr'):
-                    cols = row.find_all('td')
-                    if len(cols) >= 2:
-                        key = cols[0].text.strip()
-                        val_str = cols[1].text.strip().replace('%', '').replace(',', '.')
-                        try:
-                            val = float(val_str)
-                            if val < 101: sec_dict[key] = val
-                        except (ValueError, TypeError):
-                            pass
-                            
-        return geo_dict, sec_dict
-
+        return parse_justetf_allocation(fetch_justetf_page(isin))
     except Exception as e:
         st.error(f"Scraping fallito per {isin}: {e}")
         return {}, {}
-    
 
-def sync_prices(df_trans, df_map):
-    if df_trans.empty or df_map.empty: return 0
-    df_full = df_trans.merge(df_map, on='isin', how='left')
-    holdings = df_full.groupby('ticker')['quantity'].sum()
+def sync_prices(df_holdings, provider: Optional[PriceProvider] = None,
+                on_progress: Optional[Callable[[int, int, str], None]] = None,
+                log: Callable[[str], None] = print) -> Dict[str, Any]:
+    """
+    Scarica e salva le chiusure mancanti dei ticker posseduti, poi aggiorna portfolio_daily.
+    Non usa componenti Streamlit: la chiamano sia l'interfaccia sia il processo services.sync.
+    Restituisce righe salvate, ticker coinvolti ed errori per ticker.
+    """
+    result = {"rows": 0, "tickers": 0, "errors": {}}
+    if df_holdings.empty: return result
+    holdings = df_holdings.groupby('ticker')['quantity'].sum()
     owned_tickers = holdings[holdings > 0.001].index.dropna().tolist()
-    if not owned_tickers: return 0
-
-    df_prices_all = get_data("prices")
-    if not df_prices_all.empty:
-        # Assicuriamoci che la colonna 'date' sia 'datetime' e senza fuso orario per confronti sicuri
-        df_prices_all['date'] = pd.to_datetime(df_prices_all['date'], errors='coerce').dt.tz_localize(None).dt.normalize()
-    
-    new_data = []
-    errors = []
-    bar = st.progress(0, text="Sincronizzazione prezzi...")
-    
-    # Definiamo "oggi" e "ieri"
-    today = datetime.now().date()
-    yesterday = today - timedelta(days=1)
-
-    for i, t in enumerate(owned_tickers):
-        start_date = "2020-01-01"
-        needs_update = True
-        
-        if not df_prices_all.empty:
-            exist = df_prices_all[df_prices_all['ticker'] == t]
-            if not exist.empty:
-                last_price_date = exist['date'].max().date()
-                
-                # Se abbiamo già i dati fino a ieri, siamo a posto.
-                if last_price_date >= yesterday:
-                    needs_update = False
-                else:
-                    start_date = (last_price_date + timedelta(days=1)).strftime('%Y-%m-%d')
-
-        if needs_update:
-            bar.progress((i + 1) / len(owned_tickers), text=f"Scaricando {t} dal {start_date}...")
-            try:
-                # Scarica i dati
-                hist = yf.download(t, start=start_date, progress=False)
-                
-                # --- FIX PER YFINANCE RECENTE (MultiIndex) ---
-                if isinstance(hist.columns, pd.MultiIndex):
-                    try:
-                        if t in hist.columns.get_level_values(1):
-                            hist = hist.xs(t, axis=1, level=1)
-                        else:
-                            hist.columns = hist.columns.get_level_values(0)
-                    except Exception:
-                        hist.columns = hist.columns.get_level_values(0)
-
-                if not hist.empty and 'Close' in hist.columns:
-                    for d, v in hist['Close'].items():
-                        # --- FILTRO FONDAMENTALE ---
-                        # Salviamo SOLO se la data del dato è STRETTAMENTE PRECEDENTE a oggi.
-                        # Questo scarta qualsiasi prezzo "live" o "intraday" di oggi.
-                        if pd.notna(v) and d.date() < today: 
-                            new_data.append({'ticker': t, 'date': d.normalize().tz_localize(None), 'close_price': float(v)})
-                else:
-                    if hist.empty:
-                        print(f"Nessun dato trovato per {t} dal {start_date}")
-            except Exception as e: 
-                errors.append(f"{t}: {str(e)}")
-        else:
-            bar.progress((i + 1) / len(owned_tickers), text=f"{t} già aggiornato.")
-    
-    if errors:
-        st.warning(f"Problemi con alcuni ticker: {', '.join(errors)}")
-
-    if new_data:
-        df_new = pd.DataFrame(new_data)
-        df_new['date'] = pd.to_datetime(df_new['date']).dt.normalize()
-        save_data(df_new, "prices", method='append')
-        return len(df_new)
-    
-    return 0
\ No newline at end of file
+    if not owned_tickers: return result
+
+    # Ultime date e buchi interni vengono calcolati dal database: qui arriva solo il piano.
+    plan = plan_price_sync(owned_tickers)
+    log(f"Piano di sincronizzazione prezzi: {plan.describe()}")
+    result["tickers"] = len(plan.tickers)
+    if not plan.tasks:
+        return result
+
+    df_new, errors = fetch_prices(plan.tasks, provider=provider, on_progress=on_progress)
+    result["errors"] = errors
+    for t in set(plan.tickers) - set(df_new['ticker']) - set(errors):
+        log(f"Nessun dato trovato per {t}")
+    record_empty_ranges(plan.tasks, df_new, errors, log=log)
+
+    if not df_new.empty:
+        stats = save_data(df_new, "prices", method='append')
+        if stats is None:
+            raise RuntimeError("Salvataggio dei prezzi non riuscito")
+        log(f"Scritte {stats['rows']} righe in {stats['seconds']:.2f}s ({stats['rows_per_sec']:,.0f} righe/s).")
+        # Ricalcola la valorizzazione solo dal primo giorno con prezzi nuovi
+        update_portfolio_daily(since=df_new['date'].min())
+        result["rows"] = len(df_new)
+    return result
@@ -0,0 +1,140 @@
+"""
+Cache su disco delle risposte HTTP (Yahoo Finance, JustETF) condivisa da tutti i servizi.
+
+Modalità, scelta con la variabile d'ambiente PORTFOLIO_HTTP_MODE:
+- live   (default) risposta dalla cache se più recente del TTL della sorgente, altrimenti rete e salvataggio;
+- record sempre dalla rete, salvando ogni risposta: serve a registrare una sessione;
+- replay solo dalla cache, senza TTL e senza rete: una risposta mancante è un errore (HTTPCacheMiss).
+  Le richieste di storico fino a oggi usano l'ultima registrazione, di qualunque giorno sia.
+
+La cache è limitata a PORTFOLIO_HTTP_CACHE_MB megabyte; oltre il limite vengono eliminate
+le voci usate meno di recente (l'mtime del file viene aggiornato a ogni lettura).
+"""
+import os
+import time
+import pickle
+import hashlib
+import threading
+import requests
+import pandas as pd
+import yfinance as yf
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+
+CACHE_DIR = Path(os.environ.get("PORTFOLIO_HTTP_CACHE_DIR", ".cache/http"))
+MODE = os.environ.get("PORTFOLIO_HTTP_MODE", "live").lower()
+MAX_CACHE_BYTES = int(float(os.environ.get("PORTFOLIO_HTTP_CACHE_MB", "200")) * 1024 * 1024)
+
+# TTL in secondi per sorgente: lo storico prezzi cambia una volta al giorno, le pagine JustETF molto meno
+SOURCE_TTL: Dict[str, int] = {
+    "yahoo": 6 * 3600,
+    "justetf": 7 * 24 * 3600,
+}
+DEFAULT_TTL = 3600
+
+_evict_lock = threading.Lock()
+
+class HTTPCacheMiss(LookupError):
+    """Risposta non presente in cache in modalità replay."""
+
+def _key(source: str, parts: Any) -> Path:
+    digest = hashlib.sha256(repr(parts).encode("utf-8")).hexdigest()
+    return CACHE_DIR / source / f"{digest}.pkl"
+
+def _read(path: Path, ttl: Optional[int]) -> Optional[Any]:
+    try:
+        with open(path, "rb") as f:
+            entry = pickle.load(f)
+    except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+        return None
+    if ttl is not None and time.time() - entry["created_at"] > ttl:
+        return None
+    try:
+        os.utime(path)  # ultimo utilizzo, usato per l'LRU
+    except FileNotFoundError:
+        pass
+    return entry["payload"]
+
+def _write(path: Path, payload: Any) -> None:
+    """Scrittura atomica (file temporaneo per thread + rename), poi eventuale eviction."""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp, "wb") as f:
+        pickle.dump({"created_at": time.time(), "payload": payload}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+    _evict()
+
+def _evict(max_bytes: Optional[int] = None) -> None:
+    """Elimina le voci meno usate di recente finché la cache non rientra nel limite."""
+    max_bytes = MAX_CACHE_BYTES if max_bytes is None else max_bytes
+    with _evict_lock:
+        entries = []
+        for p in CACHE_DIR.glob("*/*.pkl"):
+            try:
+                st_ = p.stat()
+                entries.append((st_.st_mtime, st_.st_size, p))
+            except FileNotFoundError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, p in sorted(entries):
+            if total <= max_bytes:
+                break
+            p.unlink(missing_ok=True)
+            total -= size
+
+def cached_call(source: str, parts: Any, fetch: Callable[[], Any],
+                should_store: Callable[[Any], bool] = lambda _: True,
+                latest_parts: Optional[Any] = None) -> Any:
+    """
+    Restituisce il risultato di 'fetch()' passando per la cache della sorgente.
+    'parts' identifica la richiesta (URL, parametri...); 'should_store' evita di salvare
+    risposte vuote o di errore, che altrimenti verrebbero servite fino alla scadenza.
+    'latest_parts' identifica la stessa richiesta senza la parte che cambia ogni giorno: ogni
+    risposta salvata vi viene copiata e in replay la si usa se manca la voce esatta.
+    """
+    path = _key(source, parts)
+    if MODE == "replay":
+        payload = _read(path, ttl=None)
+        if payload is None and latest_parts is not None:
+            payload = _read(_key(source, latest_parts), ttl=None)
+        if payload is None:
+            raise HTTPCacheMiss(f"Nessuna risposta registrata per {source}: {parts!r}")
+        return payload
+    if MODE != "record":
+        payload = _read(path, ttl=SOURCE_TTL.get(source, DEFAULT_TTL))
+        if payload is not None:
+            return payload
+    payload = fetch()
+    if should_store(payload):
+        _write(path, payload)
+        if latest_parts is not None:
+            _write(_key(source, latest_parts), payload)
+    return payload
+
+def cached_get(url: str, source: str, **kwargs) -> requests.Response:
+    """requests.get con cache: si salvano solo le risposte 2xx (gli header non fanno parte della chiave)."""
+    parts = ("GET", url, sorted((kwargs.get("params") or {}).items()))
+    return cached_call(source, parts, lambda: requests.get(url, **kwargs), should_store=lambda r: r.ok)
+
+def cached_download(tickers, start=None, end=None, source: str = "yahoo", **kwargs) -> pd.DataFrame:
+    """
+    yf.download con cache. Le richieste senza 'end' arrivano fino a oggi: la data corrente
+    entra nella chiave, così una risposta di ieri non viene riusata per lo storico di oggi.
+    In replay, se per oggi non c'è una registrazione, si usa l'ultima salvata per gli stessi ticker e inizio.
+    """
+    tickers_key = tuple(sorted(tickers)) if isinstance(tickers, (list, tuple)) else tickers
+    end_key = str(pd.Timestamp(end).date()) if end is not None else f"oggi:{pd.Timestamp.today().date()}"
+    start_key = str(pd.Timestamp(start).date()) if start is not None else None
+    parts = ("yf.download", tickers_key, start_key, end_key, sorted(kwargs.items()))
+    latest_parts = ("yf.download", tickers_key, start_key, "oggi", sorted(kwargs.items())) if end is None else None
+    return cached_call(source, parts, lambda: yf.download(tickers, start=start, end=end, **kwargs),
+                       should_store=lambda df: df is not None and not df.empty, latest_parts=latest_parts)
+
+def clear_cache(source: Optional[str] = None) -> int:
+    """Svuota la cache (di una sola sorgente se indicata). Restituisce i file eliminati."""
+    pattern = f"{source}/*.pkl" if source else "*/*.pkl"
+    removed = 0
+    for p in CACHE_DIR.glob(pattern):
+        p.unlink(missing_ok=True)
+        removed += 1
+    return removed
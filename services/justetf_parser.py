@@ -0,0 +1,69 @@
+import re
+from lxml import html as lxml_html
+from typing import Dict, Optional, Tuple
+
+# Intestazioni delle due sezioni di allocazione nella pagina profilo JustETF (versione italiana)
+SECTIONS = {"geo": "Paesi", "sec": "Settori"}
+
+# <h3 ...>...Paesi...</h3> oppure Settori, senza attraversare altre intestazioni
+_H3_RE = re.compile(r"<h3\b[^>]*>((?:(?!</h3>).)*?)</h3>", re.IGNORECASE | re.DOTALL)
+_TABLE_RE = re.compile(r"<table\b.*?</table>", re.IGNORECASE | re.DOTALL)
+_TAG_RE = re.compile(r"<[^>]+>")
+
+def _parse_rows(table) -> Dict[str, float]:
+    """Righe con almeno due celle: nome e percentuale ('12,3%'), scartando valori non numerici o > 100."""
+    out = {}
+    for row in table.xpath(".//tr[count(td) >= 2]"):
+        cells = row.xpath("./td")
+        key = cells[0].text_content().strip()
+        val_str = cells[1].text_content().strip().replace('%', '').replace(',', '.')
+        try:
+            val = float(val_str)
+        except ValueError:
+            continue
+        if val < 101:
+            out[key] = val
+    return out
+
+def _section_tables(page: str) -> Dict[str, Optional[str]]:
+    """
+    Individua con un'unica scansione delle intestazioni h3 il frammento HTML della
+    prima tabella che segue 'Paesi' e 'Settori'. Il resto della pagina non viene interpretato.
+    """
+    found: Dict[str, Optional[str]] = {name: None for name in SECTIONS}
+    for m in _H3_RE.finditer(page):
+        title = _TAG_RE.sub("", m.group(1))
+        for name, label in SECTIONS.items():
+            if found[name] is None and label in title:
+                table = _TABLE_RE.search(page, m.end())
+                found[name] = table.group(0) if table else ""
+        if all(v is not None for v in found.values()):
+            break
+    return found
+
+def _xpath_fallback(page: str, label: str) -> Dict[str, float]:
+    """Percorso lento ma tollerante: albero lxml completo e XPath dall'intestazione alla tabella successiva."""
+    tree = lxml_html.fromstring(page)
+    tables = tree.xpath(f"(//h3[contains(., '{label}')])[1]/following::table[1]")
+    return _parse_rows(tables[0]) if tables else {}
+
+def extract_allocations(page: str) -> Tuple[Dict[str, float], Dict[str, float]]:
+    """
+    Estrae in un solo passaggio le allocazioni geografica e settoriale da una pagina JustETF.
+
+    Si interpretano con lxml solo i due frammenti <table> che seguono le intestazioni
+    'Paesi' e 'Settori'; se un frammento non è isolabile (es. tabelle annidate) si ripiega
+    sull'XPath sull'intera pagina per quella sezione.
+    """
+    result = {}
+    for name, fragment in _section_tables(page).items():
+        if fragment is None:
+            result[name] = {}
+            continue
+        try:
+            result[name] = _parse_rows(lxml_html.fragment_fromstring(fragment)) if fragment else {}
+        except Exception:
+            result[name] = {}
+        if not result[name] and fragment:
+            result[name] = _xpath_fallback(page, SECTIONS[name])
+    return result["geo"], result["sec"]
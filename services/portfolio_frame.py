@@ -0,0 +1,124 @@
+import streamlit as st
+import numpy as np
+import pandas as pd
+from functools import cached_property
+from typing import Optional
+from database.connection import get_data, load_bundle, get_table_versions
+from services.asset_service import get_owned_assets
+
+# Tabelle lette dalle pagine insieme al PortfolioFrame (piccole: posizioni e prezzi già aggregati in SQL)
+PORTFOLIO_TABLES = ("holdings_current", "mapping", "last_price_per_ticker")
+# Chiave di cache: anche le transazioni, lette solo se serve il ledger
+PORTFOLIO_VERSION_TABLES = PORTFOLIO_TABLES + ("transactions",)
+
+class PortfolioFrame:
+    """
+    Posizioni, mappatura e ultimi prezzi, con le viste derivate calcolate una sola volta per versione dei dati.
+
+    Le posizioni arrivano dalla vista materializzata holdings_current; le transazioni vengono lette
+    solo alla prima richiesta del ledger (o dei flussi di cassa), che serve a storico, simulazioni e
+    dettaglio per asset. Ogni proprietà è calcolata alla prima lettura e poi riusata (cached_property).
+    I DataFrame restituiti sono condivisi: vanno trattati in sola lettura.
+    """
+    def __init__(self, df_holdings: pd.DataFrame, df_map: pd.DataFrame, df_last_prices: Optional[pd.DataFrame] = None,
+                 df_trans: Optional[pd.DataFrame] = None):
+        self.holdings_table = df_holdings
+        self.mapping = df_map
+        self.last_prices_table = df_last_prices if df_last_prices is not None else pd.DataFrame()
+        if df_trans is not None:
+            self.transactions = df_trans
+
+    @property
+    def empty(self) -> bool:
+        return self.holdings_table.empty
+
+    @cached_property
+    def transactions(self) -> pd.DataFrame:
+        """Tabella transactions completa, letta alla prima richiesta."""
+        return get_data("transactions")
+
+    @cached_property
+    def cash_flows(self) -> pd.DataFrame:
+        """Data e controvalore di ogni transazione (liquidità e cubo del bilancio), senza il resto del ledger."""
+        if "transactions" in self.__dict__:
+            return self.transactions[['date', 'local_value']]
+        return get_data("transactions", columns=["date", "local_value"])
+
+    @cached_property
+    def ledger(self) -> pd.DataFrame:
+        """Transazioni con ticker e categoria, date normalizzate e importi float, ordinate per data."""
+        if self.transactions.empty:
+            return pd.DataFrame(columns=['id', 'date', 'product', 'isin', 'quantity', 'local_value', 'fees', 'currency', 'ticker', 'category'])
+        df = self.transactions.assign(date=pd.to_datetime(self.transactions['date'], errors='coerce').dt.normalize())
+        df = df.astype({'quantity': float, 'local_value': float})
+        if not self.mapping.empty:
+            df = df.merge(self.mapping[['isin', 'ticker', 'category']], on='isin', how='left')
+        else:
+            df['ticker'], df['category'] = None, None
+        return df.sort_values('date', kind='stable').reset_index(drop=True)
+
+    @cached_property
+    def _ticker_factorized(self):
+        return pd.factorize(self.ledger['ticker'], sort=True)
+
+    @property
+    def ticker_codes(self) -> np.ndarray:
+        """Codice intero del ticker di ogni riga del ledger (-1 se l'ISIN non è mappato)."""
+        return self._ticker_factorized[0]
+
+    @property
+    def tickers(self) -> pd.Index:
+        """Ticker distinti del ledger, nell'ordine dei codici di ticker_codes."""
+        return pd.Index(self._ticker_factorized[1])
+
+    @cached_property
+    def categories(self) -> pd.Series:
+        """Categoria di ogni ticker mappato."""
+        if self.mapping.empty:
+            return pd.Series(dtype=object)
+        return self.mapping.dropna(subset=['ticker']).drop_duplicates('ticker').set_index('ticker')['category']
+
+    @cached_property
+    def holdings(self) -> pd.DataFrame:
+        """Quantità e controvalore per ISIN/prodotto con ticker e categoria, dalla vista holdings_current."""
+        if self.holdings_table.empty:
+            return pd.DataFrame(columns=['isin', 'product', 'ticker', 'category', 'quantity', 'local_value'])
+        return self.holdings_table[['isin', 'product', 'ticker', 'category', 'quantity', 'local_value']]
+
+    @cached_property
+    def owned_assets(self) -> pd.DataFrame:
+        """Asset posseduti (quantità > 0.001) per prodotto, ticker e ISIN."""
+        return get_owned_assets(self.holdings)
+
+    @cached_property
+    def last_prices(self) -> pd.Series:
+        """Ultima chiusura disponibile per ticker."""
+        if self.last_prices_table.empty:
+            return pd.Series(dtype='float64')
+        return self.last_prices_table.set_index('ticker')['close_price'].astype(float)
+
+    def asset_ledger(self, ticker: str) -> pd.DataFrame:
+        """Righe del ledger di un ticker, selezionate tramite i codici interi."""
+        pos = self.tickers.get_indexer([ticker])[0]
+        return self.ledger[self.ticker_codes == pos] if pos >= 0 else self.ledger.iloc[0:0]
+
+def build_portfolio_frame() -> PortfolioFrame:
+    """Legge in parallelo posizioni, mappatura e ultimi prezzi e costruisce un PortfolioFrame senza cache."""
+    frames, _ = load_bundle({t: t for t in PORTFOLIO_TABLES})
+    return PortfolioFrame(frames["holdings_current"], frames["mapping"], frames["last_price_per_ticker"])
+
+# Come _read_table: le scritture di altri processi non cambiano la chiave, la ttl ne limita l'attesa
+@st.cache_resource(show_spinner="Preparazione portafoglio...", ttl=600, max_entries=4)
+def _cached_portfolio_frame(data_version: tuple) -> PortfolioFrame:
+    return build_portfolio_frame()
+
+def get_portfolio_frame() -> PortfolioFrame:
+    """
+    PortfolioFrame condiviso tra pagine e sessioni per la versione corrente di holdings_current,
+    mapping, last_price_per_ticker e transactions: viene ricostruito solo dopo una scrittura.
+    """
+    return _cached_portfolio_frame(get_table_versions(*PORTFOLIO_VERSION_TABLES))
+
+def clear_portfolio_frame_cache() -> None:
+    """Scarta i PortfolioFrame condivisi (processo di sync: le scritture dell'app non ne cambiano la chiave)."""
+    _cached_portfolio_frame.clear()
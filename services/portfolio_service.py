@@ -1,15 +1,17 @@
 import pandas as pd
 from datetime import datetime
+from typing import Dict
+from services.portfolio_frame import PortfolioFrame
 
-def calculate_portfolio_view(df_trans: pd.DataFrame, df_map: pd.DataFrame, df_prices: pd.DataFrame) -> pd.DataFrame:
-    """Calcola la vista aggregata degli ASSET del portafoglio (esclusa liquidità)."""
-    if df_trans.empty or df_map.empty:
+def calculate_portfolio_view(pf: PortfolioFrame) -> pd.DataFrame:
+    """
+    Calcola la vista aggregata degli ASSET del portafoglio (esclusa liquidità)
+    a partire dalle posizioni e dagli ultimi prezzi del PortfolioFrame.
+    """
+    if pf.holdings.empty:
         return pd.DataFrame()
-    df_full = df_trans.merge(df_map, on='isin', how='left')
-    last_p = pd.Series(dtype='float64')
-    if not df_prices.empty:
-        last_p = df_prices.sort_values('date').groupby('ticker').tail(1).set_index('ticker')['close_price']
-    view = df_full.groupby(['product', 'ticker', 'category']).agg(quantity=('quantity', 'sum'), local_value=('local_value', 'sum')).reset_index()
+    last_p = pf.last_prices
+    view = pf.holdings.groupby(['product', 'ticker', 'category'], observed=True).agg(quantity=('quantity', 'sum'), local_value=('local_value', 'sum')).reset_index()
     view = view[view['quantity'] > 0.001].copy()
     view['net_invested'] = -view['local_value']
     view['curr_price'] = view['ticker'].map(last_p)
@@ -18,6 +20,21 @@ def calculate_portfolio_view(df_trans: pd.DataFrame, df_map: pd.DataFrame, df_pr
     view['pnl%'] = (view['pnl'] / view['net_invested'].replace(0, pd.NA)) * 100
     return view.fillna({'curr_price': 0, 'mkt_val': 0, 'pnl': 0, 'pnl%': 0})
 
+def calculate_exposure(full_view: pd.DataFrame, df_exposure: pd.DataFrame) -> Dict[str, pd.DataFrame]:
+    """
+    Esposizione in euro del portafoglio per ogni dimensione di asset_exposure ('geo', 'sec').
+    Equivale al prodotto matrice-vettore tra i pesi (asset x voci) e il valore di mercato
+    degli asset, calcolato come merge + groupby sul formato lungo.
+    Restituisce {dimensione: DataFrame key/value}.
+    """
+    if full_view.empty or df_exposure.empty:
+        return {}
+    values = full_view.loc[full_view['mkt_val'].fillna(0) != 0, ['ticker', 'mkt_val']]
+    exposure = values.merge(df_exposure[['ticker', 'dimension', 'key', 'weight']], on='ticker')
+    exposure['value'] = exposure['mkt_val'] * exposure['weight'].astype(float) / 100
+    totals = exposure.groupby(['dimension', 'key'], sort=False, observed=True)['value'].sum().reset_index()
+    return {dim: group[['key', 'value']].reset_index(drop=True) for dim, group in totals.groupby('dimension', sort=False, observed=True)}
+
 def calculate_liquidity(df_budget: pd.DataFrame, df_trans: pd.DataFrame) -> tuple[float, str]:
     """Calcola la liquidità finale partendo dal saldo iniziale o, in sua assenza, dai totali."""
     if df_budget.empty:
@@ -40,19 +57,63 @@ def calculate_liquidity(df_budget: pd.DataFrame, df_trans: pd.DataFrame) -> tupl
         final_liquidity = total_entrate - total_uscite - total_investito_netto
     return final_liquidity, "Liquidità Calcolata"
 
-def get_historical_portfolio(df_trans: pd.DataFrame, df_map: pd.DataFrame, df_prices: pd.DataFrame) -> pd.DataFrame:
-    """Calcola l'andamento storico del valore di portafoglio e del capitale investito."""
-    if df_prices.empty or df_trans.empty or df_map.empty:
-        return pd.DataFrame()
-    df_full = df_trans.merge(df_map, on='isin', how='left')
-    start_dt, end_dt = df_trans['date'].min(), datetime.today()
-    full_idx = pd.date_range(start_dt, end_dt, freq='D').normalize()
-    daily_qty_change = df_full.pivot_table(index='date', columns='ticker', values='quantity', aggfunc='sum').fillna(0)
-    daily_holdings = daily_qty_change.reindex(full_idx, fill_value=0).cumsum()
-    price_matrix = df_prices.pivot(index='date', columns='ticker', values='close_price').reindex(full_idx).ffill()
+def compute_portfolio_daily(pf: PortfolioFrame, df_prices: pd.DataFrame, start_date: pd.Timestamp, end_date: pd.Timestamp) -> pd.DataFrame:
+    """
+    Calcola valore e capitale investito di ogni giorno tra start_date ed end_date.
+
+    Le transazioni devono essere complete (servono per le quantità e l'investito di apertura),
+    mentre i prezzi bastano da start_date in poi più l'ultima chiusura precedente di ogni ticker,
+    usata per proseguire il forward-fill. Ricalcolare un intervallo dà gli stessi valori
+    della ricostruzione completa a partire dalla prima transazione.
+    """
+    if pf.empty or pf.mapping.empty:
+        return pd.DataFrame(columns=['date', 'value', 'invested'])
+    df_full = pf.ledger
+    full_idx = pd.date_range(start_date, end_date, freq='D').normalize()
+
+    # Stato di apertura: tutto ciò che è avvenuto prima dell'intervallo (quantità per codice di ticker)
+    is_before = (df_full['date'] < full_idx[0]).to_numpy()
+    in_range = df_full[(df_full['date'] >= full_idx[0]) & (df_full['date'] <= full_idx[-1])]
+    codes = pf.ticker_codes
+    mapped_before = is_before & (codes >= 0)
+    opening_qty = pd.Series(df_full['quantity'].to_numpy()[mapped_before]).groupby(codes[mapped_before]).sum()
+    opening_qty.index = pf.tickers[opening_qty.index]
+    opening_invested = -df_full.loc[is_before, 'local_value'].sum()
+
+    daily_qty_change = pd.DataFrame(index=full_idx)
+    if not in_range.empty:
+        daily_qty_change = in_range.pivot_table(index='date', columns='ticker', values='quantity', aggfunc='sum', observed=True)
+    tickers = opening_qty.index.union(daily_qty_change.columns)
+    daily_holdings = daily_qty_change.reindex(index=full_idx, columns=tickers).fillna(0).cumsum() + opening_qty.reindex(tickers, fill_value=0)
+
+    # Le chiusure precedenti l'intervallo servono solo a proseguire il forward-fill
+    price_matrix = pd.DataFrame(index=full_idx)
+    if not df_prices.empty:
+        prices = df_prices.astype({'close_price': float})
+        pivot = prices.pivot(index='date', columns='ticker', values='close_price').sort_index()
+        price_matrix = pivot.reindex(pivot.index.union(full_idx)).ffill().reindex(full_idx)
     common_cols = daily_holdings.columns.intersection(price_matrix.columns)
-    daily_value = (daily_holdings[common_cols] * price_matrix[common_cols]).sum(axis=1)
-    daily_inv_change = df_full.pivot_table(index='date', values='local_value', aggfunc='sum').fillna(0)
-    daily_invested = -daily_inv_change.reindex(full_idx, fill_value=0).cumsum()
-    hdf = pd.DataFrame({'Data': full_idx, 'Valore': daily_value, 'Investito': daily_invested['local_value']})
-    return hdf
\ No newline at end of file
+    ticker_values = daily_holdings[common_cols] * price_matrix[common_cols]
+
+    daily_inv_change = in_range.groupby('date')['local_value'].sum()
+    daily_invested = opening_invested - daily_inv_change.reindex(full_idx, fill_value=0).cumsum()
+
+    return pd.DataFrame({
+        'date': full_idx,
+        'value': ticker_values.sum(axis=1).values,
+        'invested': daily_invested.values,
+    })
+
+def get_historical_portfolio(df_daily: pd.DataFrame) -> pd.DataFrame:
+    """
+    Restituisce l'andamento storico del valore di portafoglio e del capitale investito
+    leggendo la tabella portfolio_daily. I giorni successivi all'ultimo calcolo
+    proseguono con l'ultimo valore noto fino a oggi.
+    """
+    if df_daily.empty:
+        return pd.DataFrame()
+    df_daily = df_daily.sort_values('date')
+    full_idx = pd.date_range(df_daily['date'].min(), datetime.today(), freq='D').normalize()
+    series = df_daily.set_index('date')[['value', 'invested']].astype(float).reindex(full_idx).ffill()
+    hdf = pd.DataFrame({'Data': full_idx, 'Valore': series['value'].values, 'Investito': series['invested'].values})
+    return hdf
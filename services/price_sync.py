@@ -0,0 +1,293 @@
+import time
+from abc import ABC, abstractmethod
+import pandas as pd
+from dataclasses import dataclass, field
+from datetime import date, datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+from database.connection import get_price_coverage, get_checked_gaps, record_checked_gaps
+from services.http_cache import cached_download
+
+# Parametri di default del motore di sincronizzazione
+BATCH_SIZE = 20       # ticker per singola chiamata al provider
+MAX_WORKERS = 4       # chiamate concorrenti al provider
+MAX_RETRIES = 3       # tentativi per ticker quando una chiamata fallisce
+BACKOFF_SECONDS = 1.0 # attesa iniziale tra i tentativi, raddoppia a ogni ripetizione
+DEFAULT_START = date(2020, 1, 1)  # inizio dello storico per i ticker senza prezzi
+# Distanza minima (giorni di calendario) tra due chiusure consecutive per considerarla un buco:
+# weekend e festività di borsa (es. Pasqua, giovedì -> martedì) non superano i 5 giorni.
+# Le chiusure più lunghe (es. Natale) vengono scaricate una volta e, se restano vuote,
+# registrate in price_gaps_checked (vedi record_empty_ranges).
+GAP_DAYS = 5
+# yf.download non solleva eccezioni per un ticker fallito: una risposta vuota può essere un errore
+# transitorio, quindi un intervallo vuoto viene riverificato dopo questi giorni.
+CHECKED_GAP_TTL_DAYS = 7
+
+PRICE_COLUMNS = ['ticker', 'date', 'close_price']
+
+class PriceProvider(ABC):
+    """
+    Sorgente di prezzi di chiusura giornalieri.
+    Le implementazioni restituiscono un DataFrame lungo con colonne ticker, date, close_price
+    (date normalizzate e senza fuso orario) e possono essere sostituite nei test.
+    """
+    @abstractmethod
+    def download(self, tickers: List[str], start: date, end: Optional[date] = None) -> pd.DataFrame:
+        """Chiusure dei ticker nell'intervallo [start, end), con end=None fino a oggi."""
+
+class YahooPriceProvider(PriceProvider):
+    """Provider Yahoo Finance: una sola chiamata yf.download per più ticker (passando per la cache HTTP)."""
+    def download(self, tickers: List[str], start: date, end: Optional[date] = None) -> pd.DataFrame:
+        hist = cached_download(list(tickers), start=start, end=end, progress=False, group_by='column')
+        return _close_frame_to_long(hist, tickers)
+
+class StaticPriceProvider(PriceProvider):
+    """Provider locale che serve i prezzi da un DataFrame in memoria (test e esecuzioni offline)."""
+    def __init__(self, prices: pd.DataFrame):
+        self.prices = prices
+
+    def download(self, tickers: List[str], start: date, end: Optional[date] = None) -> pd.DataFrame:
+        mask = self.prices['ticker'].isin(tickers) & (self.prices['date'] >= pd.Timestamp(start))
+        if end is not None:
+            mask &= self.prices['date'] < pd.Timestamp(end)
+        return self.prices.loc[mask, PRICE_COLUMNS].reset_index(drop=True)
+
+# --- PIANIFICAZIONE ---
+@dataclass
+class SyncTask:
+    """Intervallo da scaricare per un ticker: [start, end), con end=None fino a oggi."""
+    ticker: str
+    start: date
+    end: Optional[date] = None
+    reason: str = "coda"  # 'nuovo' (nessun prezzo), 'testa' (prima della prima chiusura), 'coda' (dopo l'ultima), 'buco' (interno)
+
+@dataclass
+class SyncPlan:
+    """Piano di sincronizzazione: intervalli da scaricare e ticker già aggiornati."""
+    tasks: List[SyncTask] = field(default_factory=list)
+    up_to_date: List[str] = field(default_factory=list)
+
+    @property
+    def tickers(self) -> List[str]:
+        return sorted({t.ticker for t in self.tasks})
+
+    def describe(self) -> str:
+        """Riepilogo leggibile del piano, una riga per intervallo."""
+        lines = [f"{len(self.tasks)} intervalli su {len(self.tickers)} ticker, {len(self.up_to_date)} già aggiornati"]
+        for t in self.tasks:
+            lines.append(f"  {t.ticker:<12} {t.reason:<6} {t.start} -> {t.end or 'oggi'}")
+        return "\n".join(lines)
+
+def _range_keys(ranges: Optional[pd.DataFrame]) -> Set[Tuple[str, date, date]]:
+    """Chiavi (ticker, inizio, fine) di un DataFrame ticker/start_date/end_date."""
+    if ranges is None or ranges.empty:
+        return set()
+    return set(zip(ranges['ticker'], pd.to_datetime(ranges['start_date']).dt.date, pd.to_datetime(ranges['end_date']).dt.date))
+
+def build_sync_plan(tickers: Sequence[str], last_dates: pd.DataFrame, gaps: pd.DataFrame,
+                    today: Optional[date] = None, default_start: date = DEFAULT_START,
+                    extend_head: bool = False, checked: Optional[pd.DataFrame] = None) -> SyncPlan:
+    """
+    Costruisce il piano a partire dalla copertura già calcolata (vedi get_price_coverage):
+    'last_dates' con ticker/first_date/last_date e 'gaps' con ticker/prev_date/next_date.
+    Un ticker è aggiornato se ha la chiusura di ieri; i buchi interni diventano
+    intervalli chiusi [prev_date + 1, next_date).
+    Con 'extend_head' lo storico viene esteso all'indietro fino a 'default_start'
+    (serve alle serie di benchmark, che devono coprire tutto il periodo simulato).
+    'checked' (ticker/start_date/end_date, vedi get_checked_gaps) elenca gli intervalli chiusi
+    scaricati di recente senza risultati, es. chiusure di borsa lunghe: non vengono ripianificati.
+    """
+    today = today or datetime.now().date()
+    yesterday = today - timedelta(days=1)
+    coverage = last_dates.set_index('ticker') if not last_dates.empty else pd.DataFrame(columns=['first_date', 'last_date'])
+    last = pd.to_datetime(coverage['last_date']).dt.date.to_dict()
+    first = pd.to_datetime(coverage['first_date']).dt.date.to_dict() if 'first_date' in coverage else {}
+    already_checked = _range_keys(checked)
+
+    plan = SyncPlan()
+    for t in tickers:
+        last_date = last.get(t)
+        if last_date is None:
+            plan.tasks.append(SyncTask(t, default_start, None, "nuovo"))
+            continue
+        first_date = first.get(t)
+        # Come per i buchi interni, pochi giorni mancanti in testa sono solo weekend o festività
+        missing_head = (extend_head and first_date is not None and (first_date - default_start).days > GAP_DAYS
+                        and (t, default_start, first_date) not in already_checked)
+        if missing_head:
+            plan.tasks.append(SyncTask(t, default_start, first_date, "testa"))
+        if last_date < yesterday:
+            plan.tasks.append(SyncTask(t, last_date + timedelta(days=1), None, "coda"))
+        elif not missing_head:
+            plan.up_to_date.append(t)
+
+    if not gaps.empty:
+        gaps = gaps[gaps['ticker'].isin(tickers)]
+        for t, prev_date, next_date in zip(gaps['ticker'], pd.to_datetime(gaps['prev_date']).dt.date, pd.to_datetime(gaps['next_date']).dt.date):
+            start = prev_date + timedelta(days=1)
+            if (t, start, next_date) in already_checked:
+                continue
+            plan.tasks.append(SyncTask(t, start, next_date, "buco"))
+            if t in plan.up_to_date:
+                plan.up_to_date.remove(t)
+    return plan
+
+def plan_price_sync(tickers: Sequence[str], gap_days: int = GAP_DAYS, today: Optional[date] = None,
+                    table_name: str = "prices", default_start: date = DEFAULT_START,
+                    extend_head: bool = False) -> SyncPlan:
+    """
+    Interroga il database (date estreme, buchi e intervalli già verificati) e restituisce il piano.
+    """
+    if not tickers:
+        return SyncPlan()
+    last_dates, gaps = get_price_coverage(tickers, gap_days, table_name)
+    checked = get_checked_gaps(tickers, table_name, max_age_days=CHECKED_GAP_TTL_DAYS)
+    return build_sync_plan(tickers, last_dates, gaps, today=today, default_start=default_start,
+                           extend_head=extend_head, checked=checked)
+
+def find_empty_ranges(tasks: Iterable[SyncTask], df_new: pd.DataFrame, errors: Dict[str, str]) -> pd.DataFrame:
+    """
+    Intervalli chiusi del piano (buchi e testa) scaricati senza errori ma senza alcuna chiusura.
+    Restituisce un DataFrame ticker/start_date/end_date da passare a record_empty_ranges.
+    """
+    closed = [t for t in tasks if t.end is not None and t.ticker not in errors]
+    if not closed:
+        return pd.DataFrame(columns=['ticker', 'start_date', 'end_date'])
+    dates = pd.to_datetime(df_new['date']) if not df_new.empty else pd.Series(dtype='datetime64[ns]')
+    tickers = df_new['ticker'].astype(str) if not df_new.empty else pd.Series(dtype=object)
+    rows = [(t.ticker, t.start, t.end) for t in closed
+            if not ((tickers == t.ticker) & (dates >= pd.Timestamp(t.start)) & (dates < pd.Timestamp(t.end))).any()]
+    return pd.DataFrame(rows, columns=['ticker', 'start_date', 'end_date'])
+
+def record_empty_ranges(tasks: Iterable[SyncTask], df_new: pd.DataFrame, errors: Dict[str, str],
+                        table_name: str = "prices", log: Callable[[str], None] = print) -> int:
+    """
+    Registra gli intervalli chiusi rimasti vuoti, così le sincronizzazioni successive non li
+    richiedono di nuovo per CHECKED_GAP_TTL_DAYS giorni. Restituisce il numero di intervalli registrati.
+    """
+    empty = find_empty_ranges(tasks, df_new, errors)
+    if empty.empty:
+        return 0
+    try:
+        record_checked_gaps(empty, table_name)
+    except Exception as e:
+        log(f"Registrazione degli intervalli vuoti non riuscita: {e}")
+        return 0
+    log(f"{len(empty)} intervalli senza chiusure registrati: verranno riverificati tra {CHECKED_GAP_TTL_DAYS} giorni.")
+    return len(empty)
+
+# --- DOWNLOAD ---
+def _close_frame_to_long(hist: pd.DataFrame, tickers: List[str]) -> pd.DataFrame:
+    """
+    Converte l'output di yf.download (colonne semplici o MultiIndex Price/Ticker)
+    in formato lungo ticker/date/close_price, in modo vettoriale.
+    """
+    if hist is None or hist.empty:
+        return pd.DataFrame(columns=PRICE_COLUMNS)
+    if isinstance(hist.columns, pd.MultiIndex):
+        close = hist.xs('Close', axis=1, level=0) if 'Close' in hist.columns.get_level_values(0) else pd.DataFrame()
+    else:
+        close = hist[['Close']].set_axis(tickers[:1], axis=1) if 'Close' in hist.columns else pd.DataFrame()
+    if close.empty:
+        return pd.DataFrame(columns=PRICE_COLUMNS)
+
+    index = pd.to_datetime(close.index)
+    if index.tz is not None:
+        index = index.tz_localize(None)
+    close.index = index.normalize().rename('date')
+    long = close.reset_index().melt(id_vars='date', var_name='ticker', value_name='close_price').dropna(subset=['close_price'])
+    long['close_price'] = long['close_price'].astype(float)
+    return long[PRICE_COLUMNS]
+
+def _download_with_retry(provider: PriceProvider, tickers: List[str], start: date, end: Optional[date],
+                         retries: int, backoff: float) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    Scarica un lotto di ticker. Se la chiamata di lotto fallisce, ogni ticker viene
+    ritentato singolarmente con backoff esponenziale: un ticker problematico non
+    fa perdere gli altri. Restituisce i prezzi e gli errori per ticker.
+    """
+    try:
+        return provider.download(tickers, start, end), {}
+    except Exception:
+        if len(tickers) == 1 and retries <= 1:
+            raise
+
+    frames, errors = [], {}
+    for t in tickers:
+        for attempt in range(retries):
+            try:
+                frames.append(provider.download([t], start, end))
+                break
+            except Exception as e:
+                if attempt == retries - 1:
+                    errors[t] = str(e)
+                else:
+                    time.sleep(backoff * (2 ** attempt))
+    frames = [f for f in frames if not f.empty]
+    return (pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=PRICE_COLUMNS)), errors
+
+def _clip_to_range(frame: pd.DataFrame, tickers: List[str], start: date, end: Optional[date]) -> pd.DataFrame:
+    """
+    Tiene solo le righe dei ticker richiesti nell'intervallo [start, end): un provider può restituire
+    date già salvate, che nell'append con COPY violerebbero la chiave primaria di prices.
+    """
+    if frame.empty:
+        return frame
+    dates = pd.to_datetime(frame['date'])
+    mask = frame['ticker'].isin(tickers) & (dates >= pd.Timestamp(start))
+    if end is not None:
+        mask &= dates < pd.Timestamp(end)
+    return frame[mask]
+
+def fetch_prices(tasks: Iterable[SyncTask],
+                 provider: Optional[PriceProvider] = None,
+                 batch_size: int = BATCH_SIZE,
+                 max_workers: int = MAX_WORKERS,
+                 retries: int = MAX_RETRIES,
+                 backoff: float = BACKOFF_SECONDS,
+                 on_progress: Optional[Callable[[int, int, str], None]] = None) -> Tuple[pd.DataFrame, Dict[str, str]]:
+    """
+    Scarica le chiusure mancanti descritte dagli intervalli del piano con poche chiamate di lotto.
+
+    Gli intervalli vengono raggruppati per (inizio, fine) e spezzati in lotti di al massimo
+    'batch_size' ticker; i lotti vengono scaricati in parallelo da un pool di 'max_workers' thread.
+    Si tengono solo le chiusure strettamente precedenti a oggi, scartando i prezzi intraday.
+
+    Restituisce il DataFrame ticker/date/close_price dei nuovi prezzi e gli errori per ticker.
+    'on_progress(completati, totale, messaggio)' viene chiamato alla fine di ogni lotto.
+    """
+    provider = provider or YahooPriceProvider()
+    by_range: Dict[Tuple[date, Optional[date]], List[str]] = {}
+    for task in tasks:
+        by_range.setdefault((task.start, task.end), []).append(task.ticker)
+    batches = [(start, end, tickers[i:i + batch_size])
+               for (start, end), tickers in sorted(by_range.items(), key=lambda kv: (kv[0][0], kv[0][1] or date.max))
+               for i in range(0, len(tickers), batch_size)]
+    if not batches:
+        return pd.DataFrame(columns=PRICE_COLUMNS), {}
+
+    frames, errors = [], {}
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(_download_with_retry, provider, tickers, start, end, retries, backoff): (start, end, tickers) for start, end, tickers in batches}
+        for done, future in enumerate(as_completed(futures), start=1):
+            start, end, tickers = futures[future]
+            try:
+                frame, batch_errors = future.result()
+                frames.append(_clip_to_range(frame, tickers, start, end))
+                errors.update(batch_errors)
+            except Exception as e:
+                errors.update({t: str(e) for t in tickers})
+            if on_progress:
+                on_progress(done, len(batches), f"Scaricati {len(tickers)} ticker dal {start}")
+
+    frames = [f for f in frames if not f.empty]
+    if not frames:
+        return pd.DataFrame(columns=PRICE_COLUMNS), errors
+    prices = pd.concat(frames, ignore_index=True)
+    # --- FILTRO FONDAMENTALE ---
+    # Salviamo SOLO le chiusure STRETTAMENTE PRECEDENTI a oggi: niente prezzi "live" o intraday.
+    today = pd.Timestamp(datetime.now().date())
+    prices = prices[prices['date'] < today]
+    # Gli intervalli di uno stesso ticker non si sovrappongono: dopo il ritaglio non restano date già salvate
+    prices = prices.drop_duplicates(subset=['ticker', 'date'], keep='last').reset_index(drop=True)
+    return prices, errors
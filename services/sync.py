@@ -0,0 +1,140 @@
+"""
+Sincronizzazione dei prezzi fuori dal ciclo di richiesta di Streamlit.
+
+Uso:
+    python -m services.sync                   # ciclo continuo, una sincronizzazione ogni --interval secondi
+    python -m services.sync --once            # una sola esecuzione (es. da cron)
+    python -m services.sync --interval 1800
+
+Un advisory lock di Postgres garantisce che una sola replica alla volta scarichi i prezzi;
+l'esito di ogni esecuzione viene scritto in sync_status, che l'interfaccia si limita a leggere.
+"""
+import argparse
+import socket
+import time
+import pandas as pd
+import streamlit as st
+from datetime import datetime
+from sqlalchemy import text
+from typing import Optional, Dict, Any, Callable
+from database.connection import get_db_connection, bump_table_version, clear_read_cache
+from services.portfolio_frame import clear_portfolio_frame_cache
+from services.data_service import sync_prices
+from services.benchmark_service import update_benchmark_store, get_benchmark_tickers
+from services.price_sync import PriceProvider
+
+# Chiave dell'advisory lock della sincronizzazione (distinta da quella delle migrazioni)
+SYNC_LOCK_KEY = 720_602
+PRICES_JOB = "prices"
+DEFAULT_INTERVAL = 3600  # secondi tra due sincronizzazioni nel ciclo continuo
+# Tabelle scritte da una sincronizzazione prezzi: le loro versioni vanno invalidate nei processi dell'app
+SYNCED_TABLES = ("prices", "last_price_per_ticker", "portfolio_daily", "benchmark_prices")
+
+def _set_status(job: str, **fields) -> None:
+    """UPSERT della riga di stato del job con i soli campi indicati."""
+    fields = {"host": socket.gethostname(), **fields}
+    cols = ", ".join(fields)
+    values = ", ".join(f":{c}" for c in fields)
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in fields)
+    sql = text(f"INSERT INTO sync_status (job, {cols}) VALUES (:job, {values}) ON CONFLICT (job) DO UPDATE SET {updates};")
+    with get_db_connection().engine.begin() as c:
+        c.execute(sql, {"job": job, **fields})
+
+def get_sync_status(job: str = PRICES_JOB) -> Optional[Dict[str, Any]]:
+    """Legge lo stato dell'ultima sincronizzazione del job (None se non è mai stata eseguita)."""
+    try:
+        with get_db_connection().engine.connect() as c:
+            row = c.execute(text("SELECT * FROM sync_status WHERE job = :job;"), {"job": job}).mappings().first()
+        return dict(row) if row else None
+    except Exception as e:
+        print(f"Lettura di sync_status non riuscita: {e}")
+        return None
+
+def _read_holdings() -> pd.DataFrame:
+    """Posizioni correnti lette senza cache: il processo di sync non vede le invalidazioni dell'app."""
+    return pd.read_sql(text("SELECT ticker, quantity FROM holdings_current;"), get_db_connection().engine)
+
+def run_sync(provider: Optional[PriceProvider] = None,
+             on_progress: Optional[Callable[[int, int, str], None]] = None,
+             log: Callable[[str], None] = print) -> Optional[Dict[str, Any]]:
+    """
+    Esegue una sincronizzazione prezzi sotto advisory lock e ne registra l'esito in sync_status.
+    Se un altro processo sta già sincronizzando restituisce None senza scaricare nulla.
+    """
+    with get_db_connection().engine.connect() as lock_conn:
+        # Lock di sessione non bloccante, tenuto per tutta la durata della sincronizzazione
+        if not lock_conn.exec_driver_sql(f"SELECT pg_try_advisory_lock({SYNC_LOCK_KEY});").scalar():
+            lock_conn.rollback()
+            log("Sincronizzazione già in corso su un altro processo: salto questo giro.")
+            return None
+        lock_conn.commit()
+        started = datetime.now()
+        try:
+            _set_status(PRICES_JOB, status="in corso", started_at=started, finished_at=None, rows_written=None, message=None)
+            result = sync_prices(_read_holdings(), provider=provider, on_progress=on_progress, log=log)
+            # Anche le serie di benchmark e cambio già usate restano aggiornate
+            result["benchmark_rows"] = update_benchmark_store(get_benchmark_tickers(), provider=provider, log=log)
+            errors = result["errors"]
+            message = f"{result['tickers']} ticker da aggiornare"
+            if errors:
+                message += f"; errori: {', '.join(f'{t}: {e}' for t, e in errors.items())}"
+            _set_status(PRICES_JOB, status="errori" if errors else "ok", finished_at=datetime.now(), rows_written=result["rows"], message=message)
+            log(f"Sincronizzazione completata in {(datetime.now() - started).total_seconds():.1f}s: {result['rows']} nuovi prezzi.")
+            return result
+        except Exception as e:
+            _set_status(PRICES_JOB, status="fallita", finished_at=datetime.now(), message=str(e))
+            raise
+        finally:
+            lock_conn.rollback()
+            lock_conn.exec_driver_sql(f"SELECT pg_advisory_unlock({SYNC_LOCK_KEY});")
+            lock_conn.commit()
+
+# --- LATO APP ---
+@st.cache_data(ttl=60, show_spinner=False)
+def get_cached_sync_status(job: str = PRICES_JOB) -> Optional[Dict[str, Any]]:
+    """Stato del job letto al massimo una volta al minuto: è quello che mostrano le pagine."""
+    return get_sync_status(job)
+
+@st.cache_resource
+def _seen_sync_runs() -> Dict[str, Any]:
+    return {}
+
+def apply_external_sync(job: str = PRICES_JOB) -> Optional[Dict[str, Any]]:
+    """
+    Se il processo di sync ha completato una nuova esecuzione dall'ultima volta che questo
+    processo l'ha vista, invalida le versioni delle tabelle che ha scritto.
+    Restituisce lo stato corrente del job.
+    """
+    status = get_cached_sync_status(job)
+    if not status or not status.get("finished_at"):
+        return status
+    seen = _seen_sync_runs()
+    if job in seen and seen[job] != status["finished_at"]:
+        for table in SYNCED_TABLES:
+            bump_table_version(table)
+    seen[job] = status["finished_at"]
+    return status
+
+def main():
+    parser = argparse.ArgumentParser(description="Sincronizzazione prezzi in background")
+    parser.add_argument("--once", action="store_true", help="esegue una sola sincronizzazione ed esce")
+    parser.add_argument("--interval", type=int, default=DEFAULT_INTERVAL, help="secondi tra due sincronizzazioni")
+    args = parser.parse_args()
+
+    while True:
+        # Ogni giro rilegge i dati dal database: le scritture dell'app avvengono in un altro processo
+        st.cache_data.clear()
+        clear_read_cache()
+        clear_portfolio_frame_cache()
+        try:
+            run_sync()
+        except Exception as e:
+            print(f"Sincronizzazione fallita: {e}")
+            if args.once:
+                raise SystemExit(1)
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,38 @@
 import streamlit as st
-
-# Lista dei comandi SQL per creare le tabelle
-# Usiamo "IF NOT EXISTS" per rendere lo script eseguibile più volte senza errori.
-CREATE_TABLE_COMMANDS = [
-    """
-    CREATE TABLE IF NOT EXISTS transactions (
-        id VARCHAR(255) PRIMARY KEY,
-        date DATE,
-        product VARCHAR(255),
-        isin VARCHAR(50),
-        quantity NUMERIC(20, 10),
-        local_value NUMERIC(20, 10),
-        fees NUMERIC(20, 10),
-        currency VARCHAR(10)
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS mapping (
-        isin VARCHAR(50) PRIMARY KEY,
-        ticker VARCHAR(50),
-        category VARCHAR(50)
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS prices (
-        ticker VARCHAR(50),
-        date DATE,
-        close_price NUMERIC(20, 10),
-        PRIMARY KEY (ticker, date)
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS budget (
-        id SERIAL PRIMARY KEY,
-        date DATE,
-        type VARCHAR(50),
-        category VARCHAR(100),
-        amount NUMERIC(20, 2),
-        note TEXT
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS settings (
-        key VARCHAR(50) PRIMARY KEY,
-        value TEXT
-    );
-    """
-]
+import pandas as pd
+from database.migrations import MIGRATIONS, run_migrations, check_query_plans
 
 def setup():
     """
-    Esegue i comandi SQL per creare/aggiornare le tabelle del database.
+    Applica le migrazioni mancanti dello schema e verifica i piani delle query principali.
     """
     st.title("🛠️ Setup Database")
     st.info("Questo script creerà o aggiornerà le tabelle nel tuo database Neon per assicurare che l'applicazione funzioni correttamente.")
 
+    conn = st.connection("postgresql", type="sql")
+
     if st.button("🚀 Avvia Creazione/Verifica Tabelle", type="primary"):
         try:
-            conn = st.connection("postgresql", type="sql")
-            
-            with conn.session as s:
-                st.info("Connessione al database stabilita...")
-                for command in CREATE_TABLE_COMMANDS:
-                    table_name = command.split("TABLE IF NOT EXISTS ")[1].split(" ")[0]
-                    st.write(f"Verificando/Creando la tabella `{table_name}`...")
-                    s.execute(command)
-                s.commit()
-            
-            st.success("✅ Tutte le tabelle sono state create/verificate con successo!")
+            st.info("Connessione al database stabilita...")
+            applied = run_migrations(conn.engine, log=st.write)
+            if applied:
+                st.success(f"✅ Applicate {len(applied)} migrazioni (schema alla versione {MIGRATIONS[-1][0]}).")
+            else:
+                st.success(f"✅ Lo schema è già aggiornato alla versione {MIGRATIONS[-1][0]}.")
             st.balloons()
             st.info("Ora puoi chiudere questa pagina e avviare l'app principale con `streamlit run app.py`")
 
         except Exception as e:
             st.error(f"❌ Si è verificato un errore: {e}")
 
+    if st.button("🔍 Verifica Uso degli Indici (EXPLAIN)"):
+        try:
+            results = pd.DataFrame(check_query_plans(conn.engine))
+            st.dataframe(results, use_container_width=True, hide_index=True)
+            if results['ok'].all(): st.success("✅ Tutte le query principali usano l'indice previsto.")
+            else: st.warning("⚠️ Alcune query non usano l'indice previsto: esegui prima la creazione/verifica tabelle.")
+        except Exception as e:
+            st.error(f"❌ Si è verificato un errore: {e}")
+
 if __name__ == "__main__":
-    setup()
\ No newline at end of file
+    setup()
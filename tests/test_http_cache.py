@@ -0,0 +1,26 @@
+import pandas as pd
+import pytest
+from services import http_cache
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(http_cache, "CACHE_DIR", tmp_path)
+    return http_cache
+
+def _freeze_today(monkeypatch, day):
+    monkeypatch.setattr(pd.Timestamp, "today", classmethod(lambda cls: pd.Timestamp(day)))
+
+def test_replay_uses_latest_recording_for_open_ended_download(cache, monkeypatch):
+    recorded = pd.DataFrame({"Close": [10.0, 11.0]}, index=pd.to_datetime(["2026-01-02", "2026-01-05"]))
+    monkeypatch.setattr(cache.yf, "download", lambda *a, **kw: recorded)
+    monkeypatch.setattr(cache, "MODE", "record")
+    _freeze_today(monkeypatch, "2026-01-06")
+    cache.cached_download(["SWDA.MI"], start="2026-01-01", progress=False)
+
+    monkeypatch.setattr(cache.yf, "download", lambda *a, **kw: pytest.fail("la rete non va usata in replay"))
+    monkeypatch.setattr(cache, "MODE", "replay")
+    _freeze_today(monkeypatch, "2026-02-10")
+    pd.testing.assert_frame_equal(cache.cached_download(["SWDA.MI"], start="2026-01-01", progress=False), recorded)
+
+    with pytest.raises(cache.HTTPCacheMiss):
+        cache.cached_download(["SWDA.MI"], start="2025-06-01", progress=False)
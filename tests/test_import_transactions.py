@@ -0,0 +1,48 @@
+"""
+Test dell'import transazioni su un database PostgreSQL reale: vengono eseguiti solo se
+PORTFOLIO_TEST_DATABASE_URL punta a un database di prova (la tabella transactions viene svuotata).
+"""
+import os
+import pandas as pd
+import pytest
+from types import SimpleNamespace
+from sqlalchemy import create_engine, text
+from database import connection
+from database.migrations import run_migrations
+
+DATABASE_URL = os.environ.get("PORTFOLIO_TEST_DATABASE_URL")
+pytestmark = pytest.mark.skipif(not DATABASE_URL, reason="PORTFOLIO_TEST_DATABASE_URL non impostata")
+
+ROW = dict(date=pd.Timestamp('2025-03-03'), product='ISHARES CORE MSCI WORLD', isin='IE00B4L5Y983',
+           quantity=2.0, local_value=-180.5, fees=1.0, currency='EUR')
+
+@pytest.fixture
+def engine(monkeypatch):
+    engine = create_engine(DATABASE_URL)
+    run_migrations(engine, log=lambda _: None)
+    with engine.begin() as c:
+        c.execute(text("TRUNCATE transactions;"))
+    monkeypatch.setattr(connection, "get_db_connection", lambda: SimpleNamespace(engine=engine))
+    yield engine
+    engine.dispose()
+
+def _trades(*ids):
+    return pd.DataFrame([{'id': i, **ROW} for i in ids])
+
+def _stored_ids(engine):
+    with engine.connect() as c:
+        return sorted(c.execute(text("SELECT id FROM transactions;")).scalars())
+
+def test_new_trade_identical_to_existing_one_is_imported(engine):
+    connection.import_transactions(_trades('z'))
+    # La nuova 'a' viene prima di 'z' nell'ordinamento per ID: senza escludere gli ID già presenti
+    # 'a' riceveva l'occorrenza 0, già coperta da 'z', e veniva scartata come duplicato.
+    stats = connection.import_transactions(_trades('a', 'z'))
+    assert (stats['rows'], stats['skipped']) == (1, 1)
+    assert _stored_ids(engine) == ['a', 'z']
+
+def test_reimport_and_legacy_ids_are_not_duplicated(engine):
+    connection.import_transactions(_trades('posizionale'))
+    assert connection.import_transactions(_trades('a'))['rows'] == 0
+    assert connection.import_transactions(_trades('posizionale'))['rows'] == 0
+    assert _stored_ids(engine) == ['posizionale']
@@ -0,0 +1,85 @@
+import pandas as pd
+from datetime import date
+from services.price_sync import (PRICE_COLUMNS, GAP_DAYS, PriceProvider, StaticPriceProvider, SyncTask,
+                                 build_sync_plan, fetch_prices, find_empty_ranges)
+
+TODAY = date(2026, 1, 3)
+
+def _closes(ticker, days):
+    return pd.DataFrame({'ticker': ticker, 'date': pd.to_datetime(days), 'close_price': 100.0})[PRICE_COLUMNS]
+
+def _coverage(prices):
+    """Stesso calcolo di get_price_coverage (MIN/MAX e LAG) fatto in pandas."""
+    prices = prices.sort_values(['ticker', 'date'])
+    last_dates = prices.groupby('ticker')['date'].agg(first_date='min', last_date='max').reset_index()
+    prev = prices.groupby('ticker')['date'].shift()
+    gaps = prices.assign(prev_date=prev).rename(columns={'date': 'next_date'})
+    gaps = gaps[(gaps['next_date'] - gaps['prev_date']).dt.days > GAP_DAYS][['ticker', 'prev_date', 'next_date']]
+    return last_dates, gaps
+
+# Chiusura natalizia: nessuna seduta tra il 23 e il 29 dicembre 2025
+STORED = _closes('SWDA.MI', ['2025-12-22', '2025-12-23', '2025-12-29', '2025-12-30', '2025-12-31', '2026-01-02'])
+
+def test_christmas_gap_is_planned_until_checked():
+    last_dates, gaps = _coverage(STORED)
+    plan = build_sync_plan(['SWDA.MI'], last_dates, gaps, today=TODAY)
+    assert [(t.reason, t.start, t.end) for t in plan.tasks] == [("buco", date(2025, 12, 24), date(2025, 12, 29))]
+    assert plan.up_to_date == []
+
+    # Il provider non ha sedute in più: l'intervallo resta vuoto e viene registrato
+    df_new, errors = fetch_prices(plan.tasks, provider=StaticPriceProvider(STORED))
+    assert df_new.empty and errors == {}
+    checked = find_empty_ranges(plan.tasks, df_new, errors)
+    assert list(checked.itertuples(index=False, name=None)) == [('SWDA.MI', date(2025, 12, 24), date(2025, 12, 29))]
+
+    plan = build_sync_plan(['SWDA.MI'], last_dates, gaps, today=TODAY, checked=checked)
+    assert plan.tasks == []
+    assert plan.up_to_date == ['SWDA.MI']
+
+def test_filled_or_failed_gaps_are_not_checked():
+    last_dates, gaps = _coverage(STORED)
+    plan = build_sync_plan(['SWDA.MI'], last_dates, gaps, today=TODAY)
+
+    provider = StaticPriceProvider(pd.concat([STORED, _closes('SWDA.MI', ['2025-12-24'])], ignore_index=True))
+    df_new, errors = fetch_prices(plan.tasks, provider=provider)
+    assert len(df_new) == 1
+    assert find_empty_ranges(plan.tasks, df_new, errors).empty
+
+    assert find_empty_ranges(plan.tasks, df_new.iloc[0:0], {'SWDA.MI': 'timeout'}).empty
+
+def test_checked_head_counts_as_up_to_date():
+    # Quotato dal 2024: lo storico richiesto dal 2020 non esiste presso il provider
+    last_dates = pd.DataFrame({'ticker': ['NEW.MI'], 'first_date': pd.to_datetime(['2024-03-01']), 'last_date': pd.to_datetime(['2026-01-02'])})
+    gaps = pd.DataFrame(columns=['ticker', 'prev_date', 'next_date'])
+    plan = build_sync_plan(['NEW.MI'], last_dates, gaps, today=TODAY, default_start=date(2020, 1, 1), extend_head=True)
+    assert [t.reason for t in plan.tasks] == ["testa"]
+
+    checked = find_empty_ranges(plan.tasks, pd.DataFrame(columns=PRICE_COLUMNS), {})
+    plan = build_sync_plan(['NEW.MI'], last_dates, gaps, today=TODAY, default_start=date(2020, 1, 1),
+                           extend_head=True, checked=checked)
+    assert plan.tasks == [] and plan.up_to_date == ['NEW.MI']
+
+class _WholeHistoryProvider(StaticPriceProvider):
+    """Ignora l'intervallo richiesto e restituisce tutto lo storico dei ticker."""
+    def download(self, tickers, start, end=None):
+        return self.prices[self.prices['ticker'].isin(tickers)].reset_index(drop=True)
+
+def test_fetch_prices_clips_to_task_ranges():
+    history = pd.concat([STORED, _closes('SWDA.MI', ['2025-12-24']), _closes('CSPX.MI', ['2025-12-30', '2026-01-02'])], ignore_index=True)
+    tasks = [SyncTask('SWDA.MI', date(2025, 12, 24), date(2025, 12, 29), "buco"), SyncTask('CSPX.MI', date(2026, 1, 1), None, "coda")]
+    df_new, errors = fetch_prices(tasks, provider=_WholeHistoryProvider(history))
+    assert errors == {}
+    assert sorted(zip(df_new['ticker'], df_new['date'].dt.date)) == [('CSPX.MI', date(2026, 1, 2)), ('SWDA.MI', date(2025, 12, 24))]
+
+class _FlakyProvider(PriceProvider):
+    """Fallisce le chiamate di lotto e, sempre, il ticker BAD.MI."""
+    def download(self, tickers, start, end=None):
+        if len(tickers) > 1 or tickers == ['BAD.MI']:
+            raise ConnectionError("timeout")
+        return _closes(tickers[0], ['2026-01-02'])
+
+def test_fetch_prices_retries_failed_batches_per_ticker():
+    tasks = [SyncTask('SWDA.MI', date(2026, 1, 1)), SyncTask('BAD.MI', date(2026, 1, 1))]
+    df_new, errors = fetch_prices(tasks, provider=_FlakyProvider(), backoff=0)
+    assert df_new['ticker'].tolist() == ['SWDA.MI']
+    assert list(errors) == ['BAD.MI']
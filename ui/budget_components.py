@@ -3,14 +3,14 @@ import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
 from database.connection import save_data
-from services.budget_service import calculate_net_worth_trend
-from ui.components import style_chart_for_mobile
+from typing import List
+from services.budget_service import calculate_net_worth_trend, propagate_goals, BudgetCube
+from ui.components import style_chart_for_mobile, editor_changes
 
-def render_month_selector(df_budget: pd.DataFrame) -> str:
-    """Renderizza il selettore del mese e il messaggio di aiuto."""
-    df_budget['mese_anno'] = df_budget['date'].dt.strftime('%Y-%m')
-    mesi_disponibili = sorted(df_budget['mese_anno'].unique(), reverse=True)
-    
+MONTH_LABELS = ["Gen", "Feb", "Mar", "Apr", "Mag", "Giu", "Lug", "Ago", "Set", "Ott", "Nov", "Dic"]
+
+def render_month_selector(mesi_disponibili: List[str]) -> str:
+    """Renderizza il selettore del mese (mesi del cubo, dal più recente) e il messaggio di aiuto."""
     col_sel, col_msg = st.columns([1, 3])
     selected_month = col_sel.selectbox("Seleziona Mese:", mesi_disponibili)
     col_msg.caption("💡 Per aggiungere nuovi movimenti, vai alla pagina 'Gestione Dati'.")
@@ -25,12 +25,12 @@ def render_monthly_kpis(summary: dict, liquidity: float, liquidity_help: str):
     k4.metric("Investito Mese", f"€ {summary['investito_mese']:,.2f}", delta=f"{(summary['investito_mese']/summary['risparmio'])*100:.1f}% del risparmio" if summary['risparmio'] > 0 else "")
     k5.metric("Liquidità Totale", f"€ {liquidity:,.2f}", help=liquidity_help)
 
-def render_monthly_charts(df_month: pd.DataFrame, summary: dict):
-    """Renderizza i grafici a torta e a barre per il mese."""
+def render_monthly_charts(cube: BudgetCube, selected_month: str, summary: dict):
+    """Renderizza i grafici a torta e a barre per il mese, letti dal cubo."""
     c1, c2 = st.columns(2)
     with c1:
         st.write("###### Spese per Categoria")
-        df_spese = df_month[df_month['type'] == 'Uscita']
+        df_spese = cube.categories(selected_month, 'Uscita')
         if not df_spese.empty:
             fig_pie = px.pie(df_spese, values='amount', names='category', hole=0.4)
             fig_pie.update_layout(showlegend=False, margin=dict(l=10, r=10, t=10, b=10))
@@ -46,6 +46,36 @@ def render_monthly_charts(df_month: pd.DataFrame, summary: dict):
         fig_bar.update_layout(barmode='group', margin=dict(l=10, r=10, t=10, b=10))
         st.plotly_chart(style_chart_for_mobile(fig_bar), use_container_width=True)
 
+YOY_METRICS = {"Uscite": "uscite", "Entrate": "entrate", "Risparmio": "risparmio", "Investito": "investito_mese", "Tasso di Risparmio (%)": "savings_rate"}
+
+def render_year_over_year(cube: BudgetCube):
+    """Renderizza il confronto anno su anno di una metrica mensile e i totali annui su tutto lo storico."""
+    st.subheader("📅 Confronto Anno su Anno")
+    if cube.monthly.empty:
+        st.info("Nessun dato sufficiente per il confronto.")
+        return
+    label = st.selectbox("Metrica:", list(YOY_METRICS), key="yoy_metric")
+    df_yoy = cube.year_over_year(YOY_METRICS[label])
+    df_yoy.index = [MONTH_LABELS[m - 1] for m in df_yoy.index]
+
+    fig_yoy = go.Figure()
+    for year in df_yoy.columns:
+        fig_yoy.add_trace(go.Scatter(x=df_yoy.index, y=df_yoy[year], name=str(year), mode='lines+markers'))
+    fig_yoy.update_layout(title=f"{label} per mese", margin=dict(l=10, r=10, t=40, b=10))
+    st.plotly_chart(style_chart_for_mobile(fig_yoy), use_container_width=True)
+
+    st.write("###### Totali Annui")
+    st.dataframe(cube.yearly().sort_index(ascending=False), use_container_width=True,
+        column_config={
+            "year": "Anno",
+            "entrate": st.column_config.NumberColumn("Entrate (€)", format="€ %.2f"),
+            "uscite": st.column_config.NumberColumn("Uscite (€)", format="€ %.2f"),
+            "risparmio": st.column_config.NumberColumn("Risparmio (€)", format="€ %.2f"),
+            "investito_mese": st.column_config.NumberColumn("Investito (€)", format="€ %.2f"),
+            "savings_rate": st.column_config.NumberColumn("Tasso di Risparmio", format="%.1f%%")
+        }
+    )
+
 def render_net_worth_section(df_nw: pd.DataFrame):
     """Renderizza la sezione completa del patrimonio netto (grafici e tabella)."""
     st.subheader("📈 Andamento Patrimonio Netto")
@@ -53,7 +83,8 @@ def render_net_worth_section(df_nw: pd.DataFrame):
         st.info("Nessun dato storico sul patrimonio. Vai in 'Gestione Dati' per salvarli.")
         return
 
-    df_nw = df_nw.sort_values('date').reset_index(drop=True)
+    # Ogni punto del patrimonio mostra l'obiettivo successivo: i salvataggi dell'editor scrivono solo le date modificate
+    df_nw = propagate_goals(df_nw)
     df_nw['monthly_increase'] = df_nw['net_worth'].diff()
     
     df_chart = df_nw.dropna(subset=['net_worth']).copy()
@@ -85,23 +116,22 @@ def render_net_worth_section(df_nw: pd.DataFrame):
         }
     )
 
-def render_transactions_editor(df_month: pd.DataFrame, df_budget_full: pd.DataFrame):
+def render_transactions_editor(df_month: pd.DataFrame):
     """Renderizza l'editor per eliminare i movimenti del mese."""
     st.subheader("📝 Dettaglio Movimenti del Mese")
     with st.expander("Visualizza o Elimina Movimenti"):
         df_edit = df_month.copy()
         df_edit.insert(0, "Elimina", False)
-        edited_df = st.data_editor(
+        st.data_editor(
             df_edit,
             column_config={"Elimina": st.column_config.CheckboxColumn(default=False), "date": st.column_config.DateColumn("Data", format="DD-MM-YYYY"), "amount": st.column_config.NumberColumn("Importo", format="€ %.2f")},
-            disabled=["date", "type", "category", "amount", "note"],
-            hide_index=True, use_container_width=True
+            disabled=["id", "date", "type", "category", "amount", "note"],
+            hide_index=True, use_container_width=True, key="month_movements_editor"
         )
-        to_delete = edited_df[edited_df["Elimina"] == True]
+        # Dallo stato dell'editor si leggono solo le righe spuntate, cancellate poi per id
+        _, to_delete = editor_changes("month_movements_editor", df_edit, ['id'])
         if not to_delete.empty:
             if st.button("🗑️ CONFERMA ELIMINAZIONE", type="primary"):
-                indexes_to_drop = to_delete.index
-                df_budget_updated = df_budget_full.drop(indexes_to_drop)
-                save_data(df_budget_updated, "budget", method='replace') 
+                save_data(pd.DataFrame(), "budget", method='upsert', delete_keys=to_delete)
                 st.success("✅ Eliminato! La pagina si aggiornerà.") 
                 st.rerun()
\ No newline at end of file
@@ -1,5 +1,8 @@
 import streamlit as st
+import pandas as pd
 from datetime import datetime
+from typing import Sequence, Tuple
+from services.sync import apply_external_sync
 
 def make_sidebar():
     """
@@ -13,6 +16,10 @@ def make_sidebar():
         st.page_link("pages/4_Bilancio.py", label="Bilancio", icon="💰")
         
         st.divider()
+        # Se il processo di sync in background ha scritto nuovi prezzi, invalida le cache prima di leggere i dati
+        status = apply_external_sync()
+        if status and status.get('finished_at'):
+            st.caption(f"Prezzi sincronizzati il {status['finished_at']:%d/%m/%Y %H:%M}")
         st.caption(f"Portfolio Pro v1.2\n© {datetime.now().year}")
 
 def style_chart_for_mobile(fig):
@@ -40,4 +47,42 @@ def color_pnl(val):
         text_color = '#155724' if v >= 0 else '#721c24'
         return f'background-color: {color}; color: {text_color}'
     except (ValueError, TypeError): 
-        return ''
\ No newline at end of file
+        return ''
+
+def editor_changes(editor_key: str, df_shown: pd.DataFrame, key_cols: Sequence[str],
+                   delete_col: str = "Elimina") -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Legge da st.session_state[editor_key] le sole modifiche fatte in uno st.data_editor
+    (edited_rows, added_rows, deleted_rows) e le traduce in operazioni per chiave.
+
+    'df_shown' è il DataFrame passato all'editor, nello stesso ordine di righe:
+    le posizioni dello stato dell'editor si riferiscono a lui.
+    Restituisce:
+    - le righe complete da inserire/aggiornare (modificate o aggiunte, senza 'delete_col');
+    - le chiavi originali da cancellare: righe eliminate, spuntate in 'delete_col'
+      o la cui chiave è stata modificata (la riga viene reinserita con la chiave nuova).
+    Da passare a save_data(..., method='upsert', delete_keys=...): il costo dipende
+    dalle righe toccate e non dalla dimensione della tabella.
+    """
+    state = st.session_state.get(editor_key) or {}
+    base = df_shown.reset_index(drop=True)
+    key_cols = list(key_cols)
+    columns = [c for c in base.columns if c != delete_col]
+
+    edited = {int(pos): values for pos, values in (state.get("edited_rows") or {}).items()}
+    removed = {int(pos) for pos in (state.get("deleted_rows") or [])}
+    removed |= {pos for pos, values in edited.items() if values.get(delete_col) is True}
+
+    changed = base.loc[sorted(set(edited) - removed), columns].copy()
+    for pos in changed.index:
+        for col, val in edited[pos].items():
+            if col in columns:
+                changed.at[pos, col] = val
+    # Chiave modificata: la vecchia riga va cancellata, la nuova inserita
+    renamed = changed.index[(changed[key_cols].astype(str) != base.loc[changed.index, key_cols].astype(str)).any(axis=1)]
+    to_delete = base.loc[sorted(removed | set(renamed)), key_cols]
+
+    added = [row for row in (state.get("added_rows") or []) if row.get(delete_col) is not True]
+    added_df = pd.DataFrame(added).reindex(columns=columns)
+    upserts = pd.concat([changed, added_df], ignore_index=True) if not added_df.empty else changed.reset_index(drop=True)
+    return upserts, to_delete.reset_index(drop=True)
@@ -2,8 +2,8 @@ import streamlit as st
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
-import json
 from ui.components import style_chart_for_mobile, color_pnl
+from services.portfolio_service import calculate_exposure
 
 def render_kpis(assets_view: pd.DataFrame):
     """Renderizza i KPI principali basandosi SOLO sugli asset."""
@@ -16,14 +16,14 @@ def render_kpis(assets_view: pd.DataFrame):
     c3.metric("📈 P&L Netto (Asset)", f"€ {tot_pnl_assets:,.2f}", delta=f"{(tot_pnl_assets/tot_inv_assets)*100:.2f}%" if tot_inv_assets else "0%")
     st.divider()
 
-def render_composition_tabs(full_view: pd.DataFrame, df_alloc: pd.DataFrame):
+def render_composition_tabs(full_view: pd.DataFrame, df_exposure: pd.DataFrame):
     """Renderizza i tab con i grafici di composizione (inclusa liquidità)."""
     st.subheader("🔬 Analisi Composizione Portafoglio")
     tab1, tab2, tab3, tab4, tab5, tab6 = st.tabs(["Asset Class", "Azioni/Obbligazioni/Gold", "Tutti gli Asset", "Dettaglio Azionario", "Dettaglio Obbligazionario", "🌍 Allocazione (X-Ray)"])
     color_map = {'Azionario': '#3B82F6', 'Obbligazionario': '#EF4444', 'Gold': '#D4AF37', 'Liquidità': '#10B981', 'Altro': '#9CA3AF'}
     
     with tab1:
-        composition_data = full_view.groupby('category')['mkt_val'].sum().reset_index()
+        composition_data = full_view.groupby('category', observed=True)['mkt_val'].sum().reset_index()
         fig_cat = px.pie(composition_data, values='mkt_val', names='category', title='Suddivisione per Asset Class', color='category', color_discrete_map=color_map)
         fig_cat.update_traces(textinfo='percent+value', texttemplate='%{percent} <br>€%{value:,.0f}', hovertemplate='<b>%{label}</b><br>Valore: €%{value:,.2f}<br>(%{percent})<extra></extra>')
         st.plotly_chart(style_chart_for_mobile(fig_cat), use_container_width=True)
@@ -31,7 +31,7 @@ def render_composition_tabs(full_view: pd.DataFrame, df_alloc: pd.DataFrame):
     with tab2:
         categories_to_show = ['Azionario', 'Obbligazionario', 'Gold']
         filtered_data = full_view[full_view['category'].isin(categories_to_show)]
-        composition_data = filtered_data.groupby('category')['mkt_val'].sum().reset_index()
+        composition_data = filtered_data.groupby('category', observed=True)['mkt_val'].sum().reset_index()
         fig_simple = px.pie(composition_data, values='mkt_val', names='category', title='Ripartizione: Azioni / Obbligazioni / Gold', color='category', color_discrete_map=color_map)
         fig_simple.update_traces(textinfo='percent+value', texttemplate='%{percent} <br>€%{value:,.0f}', hovertemplate='<b>%{label}</b><br>Valore: €%{value:,.2f}<br>(%{percent})<extra></extra>')
         st.plotly_chart(style_chart_for_mobile(fig_simple), use_container_width=True)
@@ -66,40 +66,21 @@ def render_composition_tabs(full_view: pd.DataFrame, df_alloc: pd.DataFrame):
         
     with tab6:
         st.caption("Questa analisi mostra l'esposizione geografica e settoriale aggregata, pesata per il valore di ogni asset.")
-        view_alloc = full_view.merge(df_alloc, on='ticker', how='left') if not df_alloc.empty else full_view.copy()
-        total_val = view_alloc['mkt_val'].sum()
+        total_val = full_view['mkt_val'].sum()
         if total_val > 0:
-            total_geo, total_sec = {}, {}
-            for _, row in view_alloc.iterrows():
-                val_etf = row['mkt_val']
-                if val_etf == 0 or pd.isna(val_etf): continue
-                
-                try:
-                    geo_raw = row.get('geography_json', '{}')
-                    sec_raw = row.get('sector_json', '{}')
-                    g_map = geo_raw if isinstance(geo_raw, dict) else json.loads(geo_raw or '{}')
-                    s_map = sec_raw if isinstance(sec_raw, dict) else json.loads(sec_raw or '{}')
-                except (json.JSONDecodeError, TypeError): 
-                    g_map, s_map = {}, {}
+            exposure = calculate_exposure(full_view, df_exposure)
+            df_g = exposure.get('geo', pd.DataFrame()).rename(columns={'key': 'Paese', 'value': 'Valore'})
+            df_s = exposure.get('sec', pd.DataFrame()).rename(columns={'key': 'Settore', 'value': 'Valore'})
 
-                for country, perc in g_map.items():
-                    euro_exposure = val_etf * (float(perc) / 100)
-                    total_geo[country] = total_geo.get(country, 0) + euro_exposure
-                for sector, perc in s_map.items():
-                    euro_exposure = val_etf * (float(perc) / 100)
-                    total_sec[sector] = total_sec.get(sector, 0) + euro_exposure
-            
             c_geo, c_sec = st.columns(2)
             with c_geo:
-                if total_geo:
-                    df_g = pd.DataFrame(list(total_geo.items()), columns=['Paese', 'Valore'])
+                if not df_g.empty:
                     fig1 = px.pie(df_g, values='Valore', names='Paese', hole=0.4, title="Esposizione Geografica Totale")
                     fig1.update_traces(textinfo='percent', hovertemplate='<b>%{label}</b><br>€%{value:,.0f}<br>%{percent}<extra></extra>', showlegend=False)
                     st.plotly_chart(style_chart_for_mobile(fig1), use_container_width=True)
                 else: st.info("Nessun dato geografico. Vai su 'Gestione Dati' per scaricarlo.")
             with c_sec:
-                if total_sec:
-                    df_s = pd.DataFrame(list(total_sec.items()), columns=['Settore', 'Valore'])
+                if not df_s.empty:
                     fig2 = px.pie(df_s, values='Valore', names='Settore', hole=0.4, title="Esposizione Settoriale Totale")
                     fig2.update_traces(textinfo='percent', hovertemplate='<b>%{label}</b><br>€%{value:,.0f}<br>%{percent}<extra></extra>', showlegend=False)
                     st.plotly_chart(style_chart_for_mobile(fig2), use_container_width=True)
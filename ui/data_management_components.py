@@ -1,15 +1,18 @@
 import streamlit as st
 import pandas as pd
 import json
-import numpy as np
 from datetime import date
 from database.connection import get_data, save_data, save_allocation_json
+from services.portfolio_frame import get_portfolio_frame
 from services.data_service import (
-    process_new_transactions, 
+    import_degiro_file,
     calculate_net_worth_snapshot,
-    sync_prices,
+    update_portfolio_daily,
     fetch_justetf_allocation_robust
 )
+from services.sync import run_sync, get_sync_status
+from services.allocation_refresh import find_stale_allocations, refresh_allocations, STALE_AFTER_DAYS
+from ui.components import editor_changes
 
 CATEGORIE_ASSET = ["Azionario", "Obbligazionario", "Gold", "Liquidità"]
 
@@ -18,11 +21,12 @@ def render_import_tab():
     up = st.file_uploader("Upload CSV", type=['csv'], key="csv_uploader")
     if up and st.button("Importa Transazioni"):
         with st.spinner("Importazione in corso..."):
-            df_trans = get_data("transactions")
-            new_df = process_new_transactions(up, df_trans)
-            if not new_df.empty:
-                save_data(new_df, "transactions", method='append')
-                st.success(f"✅ Importate {len(new_df)} nuove transazioni!")
+            stats = import_degiro_file(up)
+            if stats is None:
+                return
+            if stats['rows'] > 0:
+                st.success(f"✅ Importate {stats['rows']} nuove transazioni!")
+                st.toast(f"Import in {stats['seconds']:.2f}s, {stats['skipped']} righe già presenti.")
                 st.rerun()
             else:
                 st.info("Nessuna nuova transazione trovata.")
@@ -31,11 +35,11 @@ def render_mapping_tab():
     st.subheader("Modifica, Aggiungi o Elimina Mappature")
     st.caption("Fai doppio clic su una cella per modificarla. Aggiungi una riga in fondo per una nuova mappatura.")
 
-    df_map = get_data("mapping")
-    df_trans = get_data("transactions")
+    pf = get_portfolio_frame()
+    df_map = pf.mapping
     # Filtra solo gli ISIN posseduti (quantità > 0)
-    if not df_trans.empty:
-        holdings = df_trans.groupby('isin')['quantity'].sum()
+    if not pf.holdings.empty:
+        holdings = pf.holdings.groupby('isin', observed=True)['quantity'].sum()
         owned_isin = holdings[holdings > 0].index.tolist()
         df_map = df_map[df_map['isin'].isin(owned_isin)]
 
@@ -52,7 +56,7 @@ def render_mapping_tab():
     df_map_edit.insert(0, "Elimina", False)
     
     # 3. Aggiungi "id": None nella configurazione per nasconderla forzatamente
-    edited_df = st.data_editor(df_map_edit, num_rows="dynamic", use_container_width=True, hide_index=True,
+    st.data_editor(df_map_edit, num_rows="dynamic", use_container_width=True, hide_index=True, key="mapping_editor",
         column_config={
             "Elimina": st.column_config.CheckboxColumn(required=True),
             "isin": st.column_config.TextColumn("ISIN (Obbligatorio)", required=True),
@@ -62,22 +66,43 @@ def render_mapping_tab():
             "id": None  # <--- Nascondi forzatamente se dovesse ancora esserci
         })
     if st.button("💾 Salva Modifiche Mappatura", type="primary"):
-        df_to_process = edited_df.copy()
-        df_to_process = df_to_process[df_to_process["Elimina"] == False].drop(columns=["Elimina"])
-        df_to_process.dropna(subset=['isin'], inplace=True)
+        # Solo le righe toccate nell'editor: ISIN modificati/aggiunti in upsert, eliminati (o rinominati) cancellati
+        df_to_process, removed_isins = editor_changes("mapping_editor", df_map_edit, ['isin'])
+        df_to_process = df_to_process.dropna(subset=['isin'])
         df_to_process = df_to_process[df_to_process['isin'].str.strip() != '']
-        df_to_process.drop_duplicates(subset=['isin'], keep='last', inplace=True)
-        save_data(df_to_process, "mapping", method='replace')
+        if df_to_process.empty and removed_isins.empty:
+            st.info("Nessuna modifica da salvare.")
+            return
+        save_data(df_to_process, "mapping", method='upsert', delete_keys=removed_isins)
+        # Ticker e categorie possono essere cambiati: la valorizzazione va ricostruita da capo
+        update_portfolio_daily()
         st.success("✅ Mappatura aggiornata con successo!")
         st.rerun()
 
 def render_prices_tab():
     st.write("Scarica gli ultimi prezzi di chiusura da Yahoo Finance **solo per gli asset che possiedi**.")
+    st.caption("I prezzi vengono aggiornati in background da `python -m services.sync`; il pulsante forza una sincronizzazione immediata.")
+    status = get_sync_status()
+    if status:
+        when = status['finished_at'] or status['started_at']
+        msg = f"Ultima sincronizzazione: **{status['status']}** il {when:%d/%m/%Y %H:%M} ({status['host']})"
+        if status.get('rows_written') is not None: msg += f" — {status['rows_written']} nuovi prezzi"
+        st.info(msg)
+        if status.get('message') and status['status'] != 'ok': st.caption(status['message'])
+    else:
+        st.info("Nessuna sincronizzazione registrata.")
+
     if st.button("Avvia Sincronizzazione Prezzi"):
-        df_trans, df_map = get_data("transactions"), get_data("mapping")
-        if not df_map.empty and not df_trans.empty:
-            n = sync_prices(df_trans, df_map)
-            if n > 0: st.success(f"✅ Aggiornamento completato: {n} nuovi prezzi salvati.")
+        df_holdings = get_portfolio_frame().holdings
+        if not df_holdings.empty and df_holdings['ticker'].notna().any():
+            bar = st.progress(0, text="Sincronizzazione prezzi...")
+            result = run_sync(on_progress=lambda done, total, msg: bar.progress(done / total, text=msg))
+            if result is None:
+                st.warning("Una sincronizzazione è già in corso su un altro processo. Riprova tra qualche minuto.")
+                return
+            if result['errors']:
+                st.warning(f"Problemi con alcuni ticker: {', '.join(f'{t}: {e}' for t, e in result['errors'].items())}")
+            if result['rows'] > 0: st.success(f"✅ Aggiornamento completato: {result['rows']} nuovi prezzi salvati.")
             else: st.info("Tutti i prezzi per gli asset posseduti sono già aggiornati.")
         else:
             st.error("Database transazioni o mappatura vuoto. Impossibile aggiornare i prezzi.")
@@ -115,11 +140,13 @@ def render_budget_tab(initial_balance_exists: bool):
     st.subheader("Storico Movimenti (Modifica o Elimina)")
     df_budget_all = get_data("budget")
     if not df_budget_all.empty:
+        # Tipo e categoria arrivano come category: l'editor deve poter scrivere valori nuovi
+        df_budget_all = df_budget_all.astype({'type': object, 'category': object})
         df_budget_all['date'] = pd.to_datetime(df_budget_all['date']).dt.date
         df_edit = df_budget_all.sort_values('date', ascending=False).copy()
         df_edit.insert(0, "Elimina", False)
         all_categories = sorted(list(set(CATEGORIE_ENTRATE_BASE + CATEGORIE_USCITE + ["Saldo Iniziale"])))
-        edited_budget = st.data_editor(df_edit, use_container_width=True, hide_index=True, num_rows="dynamic", key="budget_editor",
+        st.data_editor(df_edit, use_container_width=True, hide_index=True, num_rows="dynamic", key="budget_editor", disabled=["id"],
             column_config={
                 "Elimina": st.column_config.CheckboxColumn(required=True),
                 "date": st.column_config.DateColumn("Data", format="DD/MM/YYYY", required=True),
@@ -129,22 +156,34 @@ def render_budget_tab(initial_balance_exists: bool):
                 "note": st.column_config.TextColumn("Note")
             })
         if st.button("💾 Salva Modifiche Movimenti", type="primary"):
-            df_to_save = pd.DataFrame(edited_budget)
-            df_to_save = df_to_save[df_to_save["Elimina"] == False].drop(columns=["Elimina"])
-            save_data(df_to_save, "budget", method='replace')
+            # Righe nuove senza id: le inserisce upsert_data lasciando generare l'id al database
+            df_to_save, removed_ids = editor_changes("budget_editor", df_edit, ['id'])
+            if df_to_save.empty and removed_ids.empty:
+                st.info("Nessuna modifica da salvare.")
+                return
+            save_data(df_to_save, "budget", method='upsert', delete_keys=removed_ids)
             st.success("✅ Movimenti aggiornati!")
             st.rerun()
 
 def render_allocation_tab():
     st.subheader("Scarica e Modifica Dati di Allocazione (X-Ray)")
-    df_map, df_trans, df_alloc = get_data("mapping"), get_data("transactions"), get_data("asset_allocation")
-    if df_map.empty or df_trans.empty:
+    pf, df_alloc = get_portfolio_frame(), get_data("asset_allocation")
+    if pf.holdings.empty or pf.holdings['ticker'].isna().all():
         st.warning("Mancano transazioni o mappatura.")
         return
-    df_full = df_trans.merge(df_map, on='isin', how='left')
-    holdings = df_full.groupby(['product', 'ticker', 'isin']).agg(quantity=('quantity', 'sum')).reset_index()
-    view = holdings[holdings['quantity'] > 0.001].copy()
+    view = pf.owned_assets
     options = view.apply(lambda x: f"{x['product']} ({x['ticker']})", axis=1).unique()
+
+    st.subheader("Aggiornamento in blocco")
+    stale = find_stale_allocations(pf, df_alloc, STALE_AFTER_DAYS)
+    st.caption(f"{len(stale)} asset senza allocazione o con dati più vecchi di {STALE_AFTER_DAYS} giorni.")
+    if st.button("🔄 Aggiorna tutte le allocazioni obsolete", disabled=stale.empty):
+        bar = st.progress(0, text="Scraping in corso...")
+        report = refresh_allocations(stale, on_progress=lambda done, total, msg: bar.progress(done / total, text=msg))
+        ok = (report['status'] == 'ok').sum()
+        (st.success if ok == len(report) else st.warning)(f"Aggiornati {ok} asset su {len(report)}.")
+        st.dataframe(report, hide_index=True, use_container_width=True)
+
     st.subheader("1. Scarica Nuovi Dati")
     col_sel, col_btn = st.columns([3, 1])
     selected_option = col_sel.selectbox("Seleziona un asset da analizzare:", options, key="asset_selector_alloc")
@@ -196,6 +235,23 @@ def render_allocation_tab():
     else:
         st.info("Nessun dato di allocazione ancora salvato.")
 
+def _history_dates(df_history: pd.DataFrame, column: str) -> pd.Series:
+    """Date dello storico patrimonio in cui 'column' (net_worth o goal) è valorizzata."""
+    if df_history.empty or column not in df_history.columns:
+        return pd.Series(dtype='datetime64[ns]')
+    return pd.to_datetime(df_history.dropna(subset=[column])['date'])
+
+def _split_clear_delete(df_changes: pd.DataFrame, removed: pd.DataFrame, other_dates: pd.Series, column: str):
+    """
+    networth_history tiene patrimonio e obiettivo sulla stessa riga: una data rimossa da uno dei due
+    editor viene cancellata solo se l'altra colonna è vuota, altrimenti 'column' viene azzerata.
+    Restituisce le righe da aggiornare e le date da cancellare.
+    """
+    removed = pd.to_datetime(removed['date'])
+    cleared = pd.DataFrame({'date': removed[removed.isin(other_dates)], column: None})
+    changes = df_changes[['date', column]].assign(date=pd.to_datetime(df_changes['date']))
+    return pd.concat([changes, cleared], ignore_index=True), removed[~removed.isin(other_dates)].to_frame(name='date')
+
 def render_net_worth_tab():
     st.subheader("🎯 Gestione Patrimonio Netto")
     
@@ -206,8 +262,8 @@ def render_net_worth_tab():
     if st.button("Calcola Patrimonio a questa data"):
         with st.spinner("Calcolo in corso..."):
             snapshot_date = pd.to_datetime(snapshot_date_input).normalize()
-            dfs = {name: get_data(name) for name in ["transactions", "mapping", "prices", "budget"]}
-            st.session_state.calculated_snapshot = {"date": snapshot_date, "values": calculate_net_worth_snapshot(snapshot_date, **dfs)}
+            values = calculate_net_worth_snapshot(snapshot_date, get_data("portfolio_daily", end_date=snapshot_date), get_portfolio_frame(), get_data("budget"))
+            st.session_state.calculated_snapshot = {"date": snapshot_date, "values": values}
             
     if st.session_state.get('calculated_snapshot'):
         snap = st.session_state.calculated_snapshot
@@ -215,10 +271,8 @@ def render_net_worth_tab():
         st.metric(f"Patrimonio Calcolato al {snap['date'].strftime('%d-%m-%Y')}", f"€ {net_worth:,.2f}", f"Asset: € {assets_val:,.2f} | Liquidità: € {liquidity_val:,.2f}")
         
         if st.button("💾 Salva questo Snapshot", type="primary"):
-            df_history = get_data("networth_history")
             new_snapshot = pd.DataFrame([{'date': snap['date'], 'net_worth': net_worth}])
-            df_merged = pd.concat([df_history, new_snapshot]).drop_duplicates(subset='date', keep='last')
-            save_data(df_merged.sort_values('date'), "networth_history", method='replace')
+            save_data(new_snapshot, "networth_history", method='upsert')
             st.success("Snapshot salvato!"); st.session_state.calculated_snapshot = None; st.rerun()
             
     st.divider()
@@ -231,10 +285,8 @@ def render_net_worth_tab():
         manual_nw = c2.number_input("Patrimonio Netto (€)", min_value=0.0, format="%.2f")
         
         if st.form_submit_button("➕ Aggiungi Valore Manuale") and manual_nw > 0:
-            df_history = get_data("networth_history")
             new_entry = pd.DataFrame([{'date': pd.to_datetime(manual_date), 'net_worth': manual_nw}])
-            df_merged = pd.concat([df_history, new_entry]).drop_duplicates(subset='date', keep='last')
-            save_data(df_merged.sort_values('date'), "networth_history", method='replace')
+            save_data(new_entry, "networth_history", method='upsert')
             st.success("Valore aggiunto!"); st.rerun()
             
     st.divider()
@@ -254,9 +306,10 @@ def render_net_worth_tab():
     if cols_to_drop: df_nw_edit = df_nw_edit.drop(columns=cols_to_drop)
     
     df_nw_edit.insert(0, "Elimina", False)
+    df_nw_edit = df_nw_edit.sort_values('date', ascending=False)
 
-    edited_nw = st.data_editor(
-        df_nw_edit.sort_values('date', ascending=False), 
+    st.data_editor(
+        df_nw_edit, 
         num_rows="dynamic", 
         use_container_width=True, 
         hide_index=True, 
@@ -270,22 +323,15 @@ def render_net_worth_tab():
     )
 
     if st.button("💾 Salva Modifiche Storico", type="primary"):
-        df_new_nw = pd.DataFrame(edited_nw)
-        df_new_nw = df_new_nw[df_new_nw["Elimina"] == False].drop(columns=["Elimina"])
-        if "id" in df_new_nw.columns: df_new_nw = df_new_nw.drop(columns=["id"])
-
-        df_goals_only = pd.DataFrame(columns=['date', 'goal'])
-        if not df_history_full.empty and 'goal' in df_history_full.columns:
-            df_goals_only = df_history_full[['date', 'goal']].dropna(subset=['goal'])
-
-        if not df_new_nw.empty:
-            df_new_nw['date'] = pd.to_datetime(df_new_nw['date'])
-            df_final = pd.merge(df_new_nw, df_goals_only, on='date', how='outer')
+        df_new_nw, removed = editor_changes("nw_editor", df_nw_edit, ['date'])
+        other_dates = _history_dates(df_history_full, 'goal')
+        # Le date con un obiettivo perdono solo il valore di patrimonio, le altre vengono cancellate.
+        df_new_nw, removed_dates = _split_clear_delete(df_new_nw, removed, other_dates, 'net_worth')
+        if df_new_nw.empty and removed_dates.empty:
+            st.info("Nessuna modifica da salvare.")
         else:
-            df_final = df_goals_only
-
-        save_data(df_final.sort_values('date'), "networth_history", method='replace')
-        st.success("Storico aggiornato!"); st.rerun()
+            save_data(df_new_nw, "networth_history", method='upsert', delete_keys=removed_dates)
+            st.success("Storico aggiornato!"); st.rerun()
             
     st.divider()
 
@@ -305,9 +351,10 @@ def render_net_worth_tab():
     if cols_to_drop_g: df_goals_edit = df_goals_edit.drop(columns=cols_to_drop_g)
 
     df_goals_edit.insert(0, "Elimina", False)
+    df_goals_edit = df_goals_edit.sort_values('date')
 
-    edited_goals = st.data_editor(
-        df_goals_edit.sort_values('date'), 
+    st.data_editor(
+        df_goals_edit, 
         num_rows="dynamic", 
         use_container_width=True, 
         hide_index=True, 
@@ -321,34 +368,12 @@ def render_net_worth_tab():
     )
 
     if st.button("💾 Salva Obiettivi"):
-        # Filtra eliminati e pulisci
-        df_new_goals = pd.DataFrame(edited_goals)
-        df_new_goals = df_new_goals[df_new_goals["Elimina"] == False].drop(columns=["Elimina"])
-        if "id" in df_new_goals.columns: df_new_goals = df_new_goals.drop(columns=["id"])
-
-        # Ricarica per sicurezza lo stato attuale
-        df_history_curr = get_data("networth_history")
-        
-        if not df_new_goals.empty: 
-            df_new_goals['date'] = pd.to_datetime(df_new_goals['date']).dt.normalize()
-        
-        # Logica di merge complessa per mantenere i dati esistenti
-        df_combined = pd.concat([df_history_curr, df_new_goals]).drop_duplicates(subset=['date'], keep='last').sort_values('date')
-        
-        # Ricostruzione pulita
-        df_nw_points = df_combined[['date', 'net_worth']].dropna()
-        df_goal_points = df_combined[['date', 'goal']].dropna()
-        
-        if not df_goal_points.empty:
-            df_final = pd.merge_asof(df_nw_points.sort_values('date'), df_goal_points.sort_values('date'), on='date', direction='forward')
-            # Aggiungi anche i goal futuri che non hanno ancora un net_worth corrispondente
-            df_final = pd.concat([df_final, df_goal_points]).drop_duplicates(subset=['date'], keep='last').sort_values('date')
+        df_new_goals, removed = editor_changes("goal_editor", df_goals_edit, ['date'])
+        other_dates = _history_dates(df_history_full, 'net_worth')
+        # Le date con un patrimonio registrato perdono solo l'obiettivo, le altre vengono cancellate.
+        df_new_goals, removed_dates = _split_clear_delete(df_new_goals, removed, other_dates, 'goal')
+        if df_new_goals.empty and removed_dates.empty:
+            st.info("Nessuna modifica da salvare.")
         else:
-            df_final = df_nw_points
-            df_final['goal'] = np.nan
-            
-        # Pulizia finale: rimuovi righe vuote o goal passati inutili
-        future_goals = df_final['date'] > pd.Timestamp.now().normalize()
-        df_final = df_final[df_final['net_worth'].notna() | (df_final['goal'].notna() & future_goals)]
-        save_data(df_final, "networth_history", method='replace')
-        st.success("Obiettivi salvati e propagati!"); st.rerun()
\ No newline at end of file
+            save_data(df_new_goals, "networth_history", method='upsert', delete_keys=removed_dates)
+            st.success("Obiettivi salvati!"); st.rerun()